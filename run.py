@@ -4,30 +4,72 @@
 import json
 import logging
 import os
-import shutil
 import sys
+from functools import partial
 from pathlib import Path
 
-import flywheel_gear_toolkit
-from flywheel_gear_toolkit.interfaces.command_line import (
-    build_command_list,
-    exec_command,
-)
-from flywheel_gear_toolkit.utils.zip_tools import zip_output
-
+from utils.bids.archive_input import MAX_RATIO
+from utils.bids.decompress import decompress_bids
 from utils.bids.download_run_level import download_bids_for_runlevel
+from utils.bids.prefetch import Prefetcher
 from utils.bids.run_level import get_analysis_run_level_and_hierarchy
+from utils.checkpoint import (
+    CHECKPOINT_NAME,
+    Checkpoint,
+    fingerprint,
+    get_run_key,
+    list_files,
+)
+from utils.cleanup import remove_tree, remove_tree_in_background
 from utils.dry_run import pretend_it_ran
+from utils.fly.disk_budget import (
+    check_disk_budget,
+    estimate_run_bytes,
+    get_dir_size,
+    inventory_dir,
+)
 from utils.fly.environment import get_and_log_environment
 from utils.fly.make_file_name_safe import make_file_name_safe
-from utils.fly.set_performance_config import set_mem_gb, set_n_cpus
-from utils.freesurfer import install_freesurfer_license
+from utils.fly.metrics import (
+    record_app_usage,
+    record_output_files,
+    set_metric,
+    write_textfile,
+)
+from utils.fly.progress import ProgressTracker
+from utils.fly.queued_logging import (
+    flush_logging,
+    start_queued_logging,
+    stop_queued_logging,
+)
+from utils.fly.set_performance_config import (
+    set_mem_gb,
+    set_n_cpus,
+    set_thread_environment,
+)
+from utils.fly.supervisor import exec_supervised, get_memory_limits
+from utils.freesurfer import (
+    get_freesurfer_version,
+    harvest_subjects,
+    install_freesurfer_license,
+    mount_cached_subjects,
+)
+from utils.profiling import profile_stage, start_profiling, stop_profiling
+from utils.results.dedup import load_content_index, save_to_content_index
 from utils.results.zip_htmls import zip_htmls
 from utils.results.zip_intermediate import (
     zip_all_intermediate_output,
     zip_intermediate_selected,
 )
+from utils.results.zip_output import write_manifest, zip_output
+from utils.results.zip_parts import zip_output_parts
+from utils.scratch import (
+    estimate_scratch_bytes,
+    get_scratch_candidates,
+    place_work_on_tmpfs,
+)
 from utils.singularity import run_in_tmp_dir
+from utils.stages import log_stage_times, run_stages, stage_times, timed_stage
 
 log = logging.getLogger(__name__)
 
@@ -40,6 +82,10 @@ CONTAINER = f"{REPO}/{GEAR}]"
 # The BIDS App command to run, e.g. "mriqc"
 BIDS_APP = "./algorithm-to-gearify.sh"
 
+# The name of the BIDS App that BIDS_APP runs, to look up its thread settings in
+# utils/fly/set_performance_config.py APP_THREAD_OVERRIDES, e.g. "fmriprep"
+BIDS_APP_NAME = Path(BIDS_APP).stem
+
 # What level to run at (positional_argument #3)
 ANALYSIS_LEVEL = "participant"  # "group"
 
@@ -52,6 +98,9 @@ DOWNLOAD_SOURCE = False
 # Constants that do not need to be changed
 FREESURFER_LICENSE = "./freesurfer/license.txt"
 
+# Reference data that is not put in the output archive unless gear-keep-fsaverage
+FSAVERAGE_PATTERNS = ["freesurfer/fsaverage*"]
+
 
 def generate_command(config, work_dir, output_analysis_id_dir, errors, warnings):
     """Build the main command line command to run.
@@ -67,6 +116,9 @@ def generate_command(config, work_dir, output_analysis_id_dir, errors, warnings)
         cmd (list of str): command to execute
     """
 
+    # importing the gear toolkit imports the Flywheel SDK so wait until needed
+    from flywheel_gear_toolkit.interfaces.command_line import build_command_list
+
     # start with the command itself:
     cmd = [
         BIDS_APP,
@@ -123,7 +175,132 @@ def generate_command(config, work_dir, output_analysis_id_dir, errors, warnings)
     return cmd
 
 
-def main(gtk_context):
+def set_performance(config):
+    """Set the number of threads and max memory the BIDS App can use in config."""
+
+    config["n_cpus"] = set_n_cpus(config.get("n_cpus"))
+    config["mem_gb"] = set_mem_gb(config.get("mem_gb"))
+
+
+def set_up_subjects_dir(environ, fwv0):
+    """Create a writeable FreeSurfer subjects directory and point environ at it.
+
+    All writeable directories need to be set up in the current working directory
+    for compatibility with Singularity.
+
+    Args:
+        environ (dict): environment the BIDS App will be run with
+        fwv0 (Path): the directory the gear is running in
+
+    Returns:
+        subjects_dir (Path): the new subjects directory
+    """
+
+    orig_subject_dir = Path(environ["SUBJECTS_DIR"])
+    subjects_dir = fwv0 / "freesurfer/subjects"
+    environ["SUBJECTS_DIR"] = str(subjects_dir)
+    if not subjects_dir.exists():  # needs to be created unless testing
+        subjects_dir.mkdir(parents=True)
+        (subjects_dir / "fsaverage").symlink_to(orig_subject_dir / "fsaverage")
+        (subjects_dir / "fsaverage5").symlink_to(orig_subject_dir / "fsaverage5")
+        (subjects_dir / "fsaverage6").symlink_to(orig_subject_dir / "fsaverage6")
+
+    environ["FS_LICENSE"] = str(fwv0 / "freesurfer/license.txt")
+
+    return subjects_dir
+
+
+def remove_output(output_analysis_id_dir, work_dir, keep_output):
+    """Remove output that has been zipped.
+
+    Args:
+        output_analysis_id_dir (Path): output/<destination_id>
+        work_dir (Path): it is moved here so it is not uploaded while being deleted
+        keep_output (bool): do not remove it
+    """
+
+    if not Path(output_analysis_id_dir).exists():
+        log.info("Output directory does not exist so it cannot be removed")
+
+    elif keep_output:
+        log.info('NOT removing output directory "%s"', str(output_analysis_id_dir))
+
+    else:
+        log.debug('removing output directory "%s"', str(output_analysis_id_dir))
+        remove_tree_in_background(output_analysis_id_dir, trash_dir=work_dir)
+
+
+def write_metadata(output_dir, run_label, destination_id, output_index=None):
+    """Save .metadata.json so information is added to Flywheel containers.
+
+    Args:
+        output_dir (Path): the gear's output directory
+        run_label (str): label of the project, subject or session
+        destination_id (str): ID of the destination analysis container
+        output_index (dict): which output archive part holds which subjects and
+            which files were passed through, from zip_output_parts()
+    """
+
+    metadata_works_but_causes_clutter_when_testing_this_template = {
+        "project": {
+            "info": {
+                "test": "Hello project",
+                f"{run_label} {destination_id}": "put this here",
+            },
+            "tags": [run_label, destination_id],
+        },
+        "subject": {
+            "info": {
+                "test": "Hello subject",
+                f"{run_label} {destination_id}": "put this here",
+            },
+            "tags": [run_label, destination_id],
+        },
+        "session": {
+            "info": {
+                "test": "Hello session",
+                f"{run_label} {destination_id}": "put this here",
+            },
+            "tags": [run_label, destination_id],
+        },
+    }
+    metadata = {
+        "analysis": {
+            "info": {
+                "test": "Hello analysis",
+                f"{run_label} {destination_id}": "put this here",
+            },
+            "files": [
+                {
+                    "name": "bids_tree.html",
+                    "info": {
+                        "value1": "foo",
+                        "value2": "bar",
+                        f"{run_label} {destination_id}": "put this here",
+                    },
+                    "tags": ["ein", "zwei"],
+                }
+            ],
+            "tags": [run_label, destination_id],
+        },
+    }
+    if output_index:
+        metadata["analysis"]["info"]["output_index"] = output_index
+    with open(f"{output_dir}/.metadata.json", "w") as fff:
+        json.dump(metadata, fff)
+        log.info(f"Wrote {output_dir}/.metadata.json")
+
+
+def run_gear(gtk_context, metric_labels):
+    """Run the gear, main() saves metrics however this ends.
+
+    Args:
+        gtk_context (GearToolkitContext) context of the job
+        metric_labels (dict) labels of the metrics, "run_level" is set here
+
+    Returns:
+        return_code (int) exit code of the gear
+    """
 
     FWV0 = Path.cwd()
     log.debug("Running gear in %s", FWV0)
@@ -147,56 +324,86 @@ def main(gtk_context):
 
     dry_run = config.get("gear-dry-run")
 
+    # editme: optional feature
+    # Skip the stages that finished if this job was restarted (gear-resume)
+    checkpoint = Checkpoint(CHECKPOINT_NAME, get_run_key())
+
     # Given the destination container, figure out if running at the project,
     # subject, or session level.
     destination_id = gtk_context.destination["id"]
-    hierarchy = get_analysis_run_level_and_hierarchy(gtk_context.client, destination_id)
-
-    if "run_level" in config:
-        hierarchy["run_level"] = config["run_level"]
-
-    # This is the label of the project, subject or session and is used
-    # as part of the name of the output files.
-    run_label = make_file_name_safe(hierarchy["run_label"])
 
     # Output will be put into a directory named as the destination id.
     # This allows the raw output to be deleted so that a zipped archive
     # can be returned.
     output_analysis_id_dir = output_dir / destination_id
 
-    environ = get_and_log_environment()
-
-    # editme: optional features -- set # threads and max memory to use
-    config["n_cpus"] = set_n_cpus(config.get("n_cpus"))
-    config["mem_gb"] = set_mem_gb(config.get("mem_gb"))
-
-    # All writeable directories need to be set up in the current working directory
-    # for compatibility with Singularity
-
-    orig_subject_dir = Path(environ["SUBJECTS_DIR"])
-    subjects_dir = FWV0 / "freesurfer/subjects"
-    environ["SUBJECTS_DIR"] = str(subjects_dir)
-    if not subjects_dir.exists():  # needs to be created unless testing
-        subjects_dir.mkdir(parents=True)
-        (subjects_dir / "fsaverage").symlink_to(orig_subject_dir / "fsaverage")
-        (subjects_dir / "fsaverage5").symlink_to(orig_subject_dir / "fsaverage5")
-        (subjects_dir / "fsaverage6").symlink_to(orig_subject_dir / "fsaverage6")
-
-    environ["FS_LICENSE"] = str(FWV0 / "freesurfer/license.txt")
-
-    # editme: if the command needs a Freesurfer license keep this
+    # editme: if the command needs a Freesurfer license keep the "license" stage
     license_list = list(Path("input/freesurfer_license").glob("*"))
     if len(license_list) > 0:
         fs_license_path = license_list[0]
     else:
         fs_license_path = ""
-    install_freesurfer_license(
-        str(fs_license_path),
-        config.get("gear-FREESURFER_LICENSE"),
-        gtk_context.client,
-        destination_id,
-        FREESURFER_LICENSE,
-    )
+
+    # These setup stages only depend on each other as listed so they are run
+    # at the same time: name: (function, [names of stages it needs])
+    stages = {
+        "hierarchy": (
+            partial(
+                get_analysis_run_level_and_hierarchy, gtk_context.client, destination_id
+            ),
+            [],
+        ),
+        "environ": (get_and_log_environment, []),
+        # editme: optional features -- set # threads and max memory to use
+        "performance": (partial(set_performance, config), []),
+        "subjects_dir": (
+            lambda: set_up_subjects_dir(results["environ"], FWV0),
+            ["environ"],
+        ),
+        "license": (
+            partial(
+                install_freesurfer_license,
+                str(fs_license_path),
+                config.get("gear-FREESURFER_LICENSE"),
+                gtk_context.client,
+                destination_id,
+                FREESURFER_LICENSE,
+            ),
+            [],
+        ),
+    }
+    # editme: optional feature -- size libraries' thread pools from n_cpus.
+    # "missing" sets the thread variables that are not set yet, "all" replaces
+    # the ones that are too, "off" leaves the environment as it is
+    thread_environment = config.get("gear-thread-environment", "missing")
+    if thread_environment != "off":
+        stages["thread_environment"] = (
+            lambda: set_thread_environment(
+                results["environ"],
+                config["n_cpus"],
+                BIDS_APP_NAME,
+                replace=thread_environment == "all",
+            ),
+            ["environ", "performance"],
+        )
+    results = {}
+    run_stages(stages, errors, results=results)
+
+    if "hierarchy" not in results or "subjects_dir" not in results:
+        log.critical("Unable to set up the gear: %s", errors)
+        return 1
+
+    hierarchy = results["hierarchy"]
+    environ = results["environ"]
+    if "run_level" in config:
+        hierarchy["run_level"] = config["run_level"]
+    metric_labels["run_level"] = hierarchy["run_level"]
+
+    # This is the label of the project, subject or session and is used
+    # as part of the name of the output files.
+    run_label = make_file_name_safe(hierarchy["run_label"])
+
+    subjects_dir = results["subjects_dir"]
 
     command = generate_command(
         config, work_dir, output_analysis_id_dir, errors, warnings
@@ -213,7 +420,8 @@ def main(gtk_context):
         tree = True
         tree_title = f"{command_name} BIDS Tree"
 
-        error_code = download_bids_for_runlevel(
+        download = partial(
+            download_bids_for_runlevel,
             gtk_context,
             hierarchy,
             tree=tree,
@@ -222,7 +430,14 @@ def main(gtk_context):
             folders=DOWNLOAD_MODALITIES,
             dry_run=dry_run,
             do_validate_bids=config.get("gear-run-bids-validation"),
+            exclude=config.get("gear-download-exclude", "").split(),
+            skip_bidsignored=config.get("gear-skip-bidsignored", True),
+            max_ratio=config.get("gear-bids-archive-max-ratio", MAX_RATIO),
         )
+        with timed_stage("download"):
+            error_code = checkpoint.wrap(
+                "download", download, outputs=[work_dir / "bids"]
+            )()
         if error_code > 0 and not config.get("gear-ignore-bids-errors"):
             errors.append(f"BIDS Error(s) detected.  Did not run {CONTAINER}")
 
@@ -230,8 +445,81 @@ def main(gtk_context):
         log.info("Did not download BIDS because of previous errors")
         print(errors)
 
+    # editme: optional feature
+    # Re-use FreeSurfer subjects that were completed by previous runs
+    fs_cache_dir = config.get("gear-freesurfer-subjects-cache")
+    subject_keys = {}
+    if fs_cache_dir and len(errors) == 0 and not dry_run:
+        fs_version = get_freesurfer_version(
+            environ.get("FREESURFER_HOME", "/opt/freesurfer")
+        )
+        subject_keys = mount_cached_subjects(
+            fs_cache_dir, subjects_dir, work_dir / "bids", fs_version
+        )
+
+    # editme: optional feature
+    # Decompress .nii.gz inputs that the BIDS App reads many times
+    decompress_patterns = config.get("gear-decompress-nifti", "").split()
+    if decompress_patterns and len(errors) == 0 and not dry_run:
+        with timed_stage("decompress"):
+            decompress_bids(work_dir / "bids", decompress_patterns, config["n_cpus"])
+
+    # editme: optional feature
+    # Read the BIDS data into the page cache while the rest of setup runs
+    prefetcher = None
+    if (
+        config.get("gear-prefetch-bids")
+        and not config.get("gear-work-on-tmpfs")  # it will be in memory already
+        and len(errors) == 0
+        and not dry_run
+    ):
+        app_gb = config.get("gear-prefetch-app-gb") or config["mem_gb"]
+        prefetcher = Prefetcher(work_dir / "bids", app_gb)
+        prefetcher.start()
+
+    # editme: optional feature
+    # Fail now instead of after hours of compute if the disk is going to fill up
+    # (only if gear-disk-budget-factor is set, the estimate is rough)
+    footprint_factor = config.get("gear-disk-budget-factor")
+    bids_bytes = get_dir_size(work_dir / "bids")
+    set_metric("gear_bids_bytes", bids_bytes, "Size of the downloaded BIDS data")
+    estimate = {"app": 0, "work": 0, "archives": 0}  # unknown
+    if footprint_factor and len(errors) == 0 and not dry_run:
+        estimate = estimate_run_bytes(
+            bids_bytes, footprint_factor, config.get("gear-save-intermediate-output")
+        )
+        budget = check_disk_budget(
+            f"running {BIDS_APP}",
+            output_dir,
+            estimate["app"] + estimate["archives"],
+            minimum_bytes=estimate["app"],
+        )
+        if budget == "insufficient":
+            errors.append(f"Not enough disk space to run {CONTAINER}")
+        elif budget == "tight":
+            warnings.append("Disk space is tight so optional archives may be skipped")
+
+    # editme: optional feature
+    # Put work/ (the BIDS data and the BIDS App's work directory) on tmpfs.  It
+    # can't be seen by the memory guard so it is only done if its size is estimated
+    tmpfs_work = None
+    if config.get("gear-work-on-tmpfs") and len(errors) == 0 and not dry_run:
+        tmpfs_work = checkpoint.wrap(
+            "work_on_tmpfs",
+            partial(
+                place_work_on_tmpfs,
+                work_dir,
+                config["mem_gb"],
+                bids_bytes + estimate["work"] if estimate["work"] else None,
+            ),
+        )()
+
     # Don't run if there were errors or if this is a dry run
     return_code = 0
+    progress = None
+    exec_fprint = None
+    if checkpoint.key and len(errors) == 0:
+        exec_fprint = fingerprint(command, list_files(work_dir / "bids"))
 
     try:
 
@@ -245,10 +533,15 @@ def main(gtk_context):
             warnings.append(e)
             pretend_it_ran(destination_id)
 
+        elif checkpoint.is_done("exec", exec_fprint) or (
+            checkpoint.is_done("zip_output") and checkpoint.is_done("remove_output")
+        ):
+            log.info("Not running the command again, it finished before a restart")
+
         else:
             # Create output directory
             log.info("Creating output directory %s", output_analysis_id_dir)
-            Path(output_analysis_id_dir).mkdir()
+            Path(output_analysis_id_dir).mkdir(exist_ok=True)
 
             if config["gear-log-level"] != "INFO":
                 # show what's in the current working directory just before running
@@ -259,10 +552,40 @@ def main(gtk_context):
             if "gear-timeout" in config:
                 command = [f"timeout {config['gear-timeout']}"] + command
 
+            # editme: optional feature
+            # Warn when the BIDS App uses more than mem_gb and stop it before the
+            # OOM killer stops the whole gear so the output can still be saved
+            soft_limit, hard_limit = None, None
+            if config.get("gear-memory-guard"):
+                soft_limit, hard_limit = get_memory_limits(
+                    config["mem_gb"], config.get("gear-memory-hard-limit-gb")
+                )
+
+            # editme: optional feature
+            # Log progress and ETA from the BIDS App's output, stop it if it stalls
+            if config.get("gear-stall-minutes"):
+                progress = ProgressTracker(
+                    output_dir / f"progress_{destination_id}.json",
+                    total_subjects=len(list((work_dir / "bids").glob("sub-*"))),
+                    stall_minutes=config["gear-stall-minutes"],
+                )
+
+            # Anything done with the output of a previous run has to be done again
+            checkpoint.keep_only(["download", "work_on_tmpfs"])
+            checkpoint.values.pop("output_manifest", None)
+
             # This is what it is all about
-            exec_command(
-                command, environ=environ, dry_run=dry_run, shell=True, cont_output=True,
+            exec_supervised(
+                command,
+                environ=environ,
+                shell=True,
+                soft_limit=soft_limit,
+                hard_limit=hard_limit,
+                snapshot_file=output_dir / f"memory_snapshot_{destination_id}.txt",
+                line_callback=progress.feed if progress else None,
+                watch_callback=progress.check if progress else None,
             )
+            checkpoint.mark_done("exec", exec_fprint, [output_analysis_id_dir])
 
     except RuntimeError as exc:
         return_code = 1
@@ -272,120 +595,251 @@ def main(gtk_context):
 
     finally:
 
+        if prefetcher:
+            prefetcher.stop()
+
+        if progress:
+            progress.report()
+
         # Cleanup, move all results to the output directory
 
-        # TODO use pybids (or delete from requirements.txt)
-        # see https://github.com/bids-standard/pybids/tree/master/examples
+        # editme: pybids is not in requirements.txt because it (and pandas) are
+        # slow to install and import.  Add it if needed, see
+        # https://github.com/bids-standard/pybids/tree/master/examples
         # for any necessary work on the bids files inside the gear, perhaps
         # to query results or count stuff to estimate how long things will take.
 
+        # Archives can be made by deleting each file as soon as it is archived so
+        # output does not exist twice on disk.  This is done when asked for or when
+        # there is not enough disk space to do it the normal way.
+        can_delete = not config.get("gear-keep-output")
+        delete_archived = can_delete and config.get("gear-delete-while-archiving")
+
         # editme: optional feature
-        # Remove all fsaverage* directories
+        # Leave reference data out of the output archive: all fsaverage*
+        # directories and anything else that is configured
+        exclude_patterns = config.get("gear-exclude-from-output", "").split()
         if not config.get("gear-keep-fsaverage"):
-            path = output_analysis_id_dir / "freesurfer"
-            fsavg_dirs = path.glob("fsaverage*")
-            for fsavg in fsavg_dirs:
-                log.info("deleting %s", str(fsavg))
-                shutil.rmtree(fsavg)
+            exclude_patterns += FSAVERAGE_PATTERNS
         else:
             log.info("Keeping fsaverage directories")
-
-        # zip entire output/<analysis_id> folder into
-        #  <gear_name>_<project|subject|session label>_<analysis.id>.zip
-        zip_file_name = gear_name + f"_{run_label}_{destination_id}.zip"
-        zip_output(
-            str(output_dir),
-            destination_id,
-            zip_file_name,
-            dry_run=False,
-            exclude_files=None,
+        exclude_larger_than = int(
+            (config.get("gear-exclude-larger-than-mb") or 0) * 1024 * 1024
         )
 
         # editme: optional feature
-        # zip any .html files in output/<analysis_id>/
-        zip_htmls(output_dir, destination_id, output_analysis_id_dir)
+        # Split the output archive into parts holding whole subjects and leave
+        # very large files out of it so they can be uploaded as they are
+        part_bytes = int((config.get("gear-output-part-size-gb") or 0) * 1024 ** 3)
+        pass_through_bytes = int(
+            (config.get("gear-pass-through-larger-than-mb") or 0) * 1024 ** 2
+        )
+        split_output = part_bytes or pass_through_bytes
+        n_workers = max(1, config.get("n_cpus") or 1)
+
+        # Make sure the output archive will fit before making it.  Files are only
+        # deleted once the archive (part) holding them is complete so deleting
+        # only needs less space when the output is split into parts.
+        output_bytes, largest_bytes, _ = inventory_dir(output_analysis_id_dir)
+        minimum_bytes = None
+        if can_delete and part_bytes:
+            part_peak = max(part_bytes, largest_bytes) * n_workers
+            minimum_bytes = min(output_bytes, part_peak)
+        output_budget = check_disk_budget(
+            "archiving output", output_dir, output_bytes, minimum_bytes=minimum_bytes
+        )
+        if output_budget == "insufficient":
+            msg = "There might not be enough disk space to archive output"
+            if footprint_factor:  # disk budgets were asked for so enforce them
+                errors.append(msg)
+            else:
+                warnings.append(msg)
 
         # editme: optional feature
         # possibly save ALL intermediate output
-        if config.get("gear-save-intermediate-output"):
-            zip_all_intermediate_output(
-                destination_id, gear_name, output_dir, work_dir, run_label
+        save_intermediate = config.get("gear-save-intermediate-output")
+        if save_intermediate:
+            # the output archive is made at the same time so leave room for it
+            reserved_bytes = output_bytes if output_budget == "ok" else 0
+            work_bytes, _, _ = inventory_dir(work_dir)
+            intermediate_budget = check_disk_budget(
+                "archiving intermediate output", output_dir, reserved_bytes + work_bytes
             )
-
-        # possibly save intermediate files and folders
-        zip_intermediate_selected(
-            config.get("gear-intermediate-files"),
-            config.get("gear-intermediate-folders"),
-            destination_id,
-            gear_name,
-            output_dir,
-            work_dir,
-            run_label,
+            if intermediate_budget == "insufficient":
+                warnings.append("Not enough disk space to save intermediate output")
+                save_intermediate = False
+        # "zip" or "tar.zst" which is faster and can be extracted one file at a time
+        archive_format = config.get("gear-intermediate-archive-format", "zip")
+        # selected intermediate files are zipped at the same time so keep them around
+        keep_work = config.get("gear-intermediate-files") or config.get(
+            "gear-intermediate-folders"
         )
 
-        # clean up: remove output that was zipped
-        if Path(output_analysis_id_dir).exists():
-            if not config.get("gear-keep-output"):
-
-                log.debug('removing output directory "%s"', str(output_analysis_id_dir))
-                shutil.rmtree(output_analysis_id_dir)
+        # zip entire output/<analysis_id> folder into
+        #  <gear_name>_<project|subject|session label>_<analysis.id>.zip
+        zip_file_name = gear_name + f"_{run_label}_{destination_id}.zip"
+        delete_output = delete_archived or (can_delete and output_budget != "ok")
 
-            else:
-                log.info(
-                    'NOT removing output directory "%s"', str(output_analysis_id_dir)
-                )
+        # Sizes and hashes of everything archived are saved in manifest.json
+        output_manifest = checkpoint.values.setdefault("output_manifest", {})
+        sha256 = config.get("gear-manifest-sha256")
 
+        # editme: optional feature
+        # Don't archive files that previous analyses already saved
+        content_index_dir = config.get("gear-content-index")
+        content_index = None
+        if content_index_dir:
+            content_index = load_content_index(content_index_dir, destination_id)
+
+        if split_output:
+            zip_output_stage = partial(
+                zip_output_parts,
+                str(output_dir),
+                destination_id,
+                zip_file_name,
+                max_part_bytes=part_bytes,
+                pass_through_larger_than=pass_through_bytes,
+                delete_source=delete_output,
+                exclude_patterns=exclude_patterns,
+                exclude_larger_than=exclude_larger_than,
+                max_workers=n_workers,
+                manifest=output_manifest,
+                sha256=sha256,
+                content_index=content_index,
+            )
         else:
-            log.info("Output directory does not exist so it cannot be removed")
+            zip_output_stage = partial(
+                zip_output,
+                str(output_dir),
+                destination_id,
+                zip_file_name,
+                dry_run=False,
+                exclude_files=None,
+                delete_source=delete_output,
+                exclude_patterns=exclude_patterns,
+                exclude_larger_than=exclude_larger_than,
+                manifest=output_manifest,
+                sha256=sha256,
+                content_index=content_index,
+            )
 
-        # editme: optional feature
-        # save .metadata file
-        metadata_works_but_causes_clutter_when_testing_this_template = {
-            "project": {
-                "info": {
-                    "test": "Hello project",
-                    f"{run_label} {destination_id}": "put this here",
-                },
-                "tags": [run_label, destination_id],
-            },
-            "subject": {
-                "info": {
-                    "test": "Hello subject",
-                    f"{run_label} {destination_id}": "put this here",
-                },
-                "tags": [run_label, destination_id],
-            },
-            "session": {
-                "info": {
-                    "test": "Hello session",
-                    f"{run_label} {destination_id}": "put this here",
-                },
-                "tags": [run_label, destination_id],
-            },
-        }
-        metadata = {
-            "analysis": {
-                "info": {
-                    "test": "Hello analysis",
-                    f"{run_label} {destination_id}": "put this here",
-                },
-                "files": [
-                    {
-                        "name": "bids_tree.html",
-                        "info": {
-                            "value1": "foo",
-                            "value2": "bar",
-                            f"{run_label} {destination_id}": "put this here",
-                        },
-                        "tags": ["ein", "zwei"],
-                    }
+        # Packaging steps that read different trees run at the same time.  Output
+        # is only archived once nothing else needs to change it and it is only
+        # removed after it has been archived.
+        # name: (function, [names of steps that have to finish first])
+        post_processing = {
+            # editme: optional feature
+            # Save newly completed FreeSurfer subjects for future runs
+            "harvest_subjects": (
+                partial(
+                    harvest_subjects,
+                    fs_cache_dir,
+                    subject_keys,
+                    [subjects_dir, output_analysis_id_dir / "freesurfer"],
+                )
+                if subject_keys
+                else lambda: None,
+                [],
+            ),
+            # editme: optional feature
+            # zip any .html files in output/<analysis_id>/
+            "zip_htmls": (
+                partial(
+                    zip_htmls,
+                    output_dir,
+                    destination_id,
+                    output_analysis_id_dir,
+                    manifest=output_manifest,
+                    sha256=sha256,
+                ),
+                [],
+            ),
+            "zip_output": (zip_output_stage, ["harvest_subjects", "zip_htmls"]),
+            "zip_all_intermediate_output": (
+                partial(
+                    zip_all_intermediate_output,
+                    destination_id,
+                    gear_name,
+                    output_dir,
+                    work_dir,
+                    run_label,
+                    delete_source=delete_archived and not keep_work,
+                    archive_format=archive_format,
+                    threads=n_workers,
+                )
+                if save_intermediate
+                else lambda: None,
+                [],
+            ),
+            # possibly save intermediate files and folders
+            "zip_intermediate_selected": (
+                partial(
+                    zip_intermediate_selected,
+                    config.get("gear-intermediate-files"),
+                    config.get("gear-intermediate-folders"),
+                    destination_id,
+                    gear_name,
+                    output_dir,
+                    work_dir,
+                    run_label,
+                    delete_source=delete_archived,
+                    archive_format=archive_format,
+                    threads=n_workers,
+                ),
+                # don't delete files while they are being archived with all of work/
+                ["zip_all_intermediate_output"] if delete_archived else [],
+            ),
+            # clean up: remove output that was zipped.  It is moved into work/ so
+            # wait until nothing is archiving work/
+            "remove_output": (
+                partial(
+                    remove_output, output_analysis_id_dir, work_dir, not can_delete
+                ),
+                [
+                    "zip_output",
+                    "zip_all_intermediate_output",
+                    "zip_intermediate_selected",
                 ],
-                "tags": [run_label, destination_id],
-            },
+            ),
+            "remove_tmpfs_work": (
+                partial(remove_tree, tmpfs_work) if tmpfs_work else lambda: None,
+                ["zip_all_intermediate_output", "zip_intermediate_selected"],
+            ),
+            "manifest": (
+                partial(write_manifest, output_dir, output_manifest, sha256),
+                ["zip_htmls", "zip_output"],
+            ),
+            "save_to_content_index": (
+                partial(
+                    save_to_content_index,
+                    content_index_dir,
+                    destination_id,
+                    output_manifest,
+                )
+                if content_index_dir and not dry_run
+                else lambda: None,
+                ["zip_htmls", "zip_output"],
+            ),
+            # editme: optional feature
+            # save .metadata file
+            "metadata": (
+                lambda: write_metadata(
+                    output_dir,
+                    run_label,
+                    destination_id,
+                    post_results["zip_output"] if split_output else None,
+                ),
+                ["zip_output"],
+            ),
+        }
+        # steps that finished before a restart are skipped
+        post_processing = {
+            name: (checkpoint.wrap(name, function, watch_dir=output_dir), needs)
+            for name, (function, needs) in post_processing.items()
         }
-        with open(f"{output_dir}/.metadata.json", "w") as fff:
-            json.dump(metadata, fff)
-            log.info(f"Wrote {output_dir}/.metadata.json")
+        post_results = {}
+        run_stages(post_processing, errors, max_workers=n_workers, results=post_results)
+        log_stage_times()
 
         # Report errors and warnings at the end of the log so they can be easily seen.
         if len(warnings) > 0:
@@ -406,6 +860,52 @@ def main(gtk_context):
             log.info(msg)
             return_code = 1
 
+        # make sure the end of the log is written even if the gear is killed now
+        flush_logging()
+
+    return return_code
+
+
+def save_metrics(metrics_dir, output_dir, return_code, labels):
+    """Write the metrics of this run for the node_exporter textfile collector.
+
+    Args:
+        metrics_dir (str) directory read by the textfile collector
+        output_dir (Path) the gear's output directory
+        return_code (int) exit code of the gear
+        labels (dict) "gear", "run_level" and "destination" of this run
+    """
+
+    for stage, seconds in stage_times.items():
+        set_metric("gear_stage_seconds", seconds, "Stage duration", {"stage": stage})
+    record_app_usage()
+    record_output_files(output_dir)
+    set_metric("gear_return_code", return_code, "Exit code of the gear")
+    file_name = f"{labels['gear']}_{labels['destination']}.prom"
+    write_textfile(metrics_dir, file_name, labels)
+
+
+def main(gtk_context):
+    """Run the gear and save its metrics, see run_gear()."""
+
+    metric_labels = {
+        "gear": gtk_context.manifest["name"],
+        "run_level": "unknown",
+        "destination": gtk_context.destination["id"],
+    }
+    return_code = 1  # if run_gear() raises
+    try:
+        return_code = run_gear(gtk_context, metric_labels)
+    finally:
+        # editme: optional feature
+        # Save metrics for the Prometheus node_exporter textfile collector, also
+        # when the gear stops early
+        metrics_dir = gtk_context.config.get("gear-metrics-dir")
+        if metrics_dir:
+            save_metrics(
+                metrics_dir, gtk_context.output_dir, return_code, metric_labels
+            )
+
     log.info("%s Gear is done.  Returning %s", CONTAINER, return_code)
 
     return return_code
@@ -413,9 +913,16 @@ def main(gtk_context):
 
 if __name__ == "__main__":
 
-    # always run in a newly created "scratch" directory in /tmp/...
-    # to be compatible with Singularity
-    scratch_dir = run_in_tmp_dir()
+    import flywheel_gear_toolkit
+
+    # always run in a newly created "scratch" directory in /tmp/... (or in the
+    # fastest of the configured places with room for the run) to be compatible
+    # with Singularity
+    scratch_dir = run_in_tmp_dir(
+        get_scratch_candidates(),
+        resume_key=get_run_key(),
+        min_free_bytes=estimate_scratch_bytes(),
+    )
 
     gtk_context = flywheel_gear_toolkit.GearToolkitContext()
 
@@ -425,14 +932,26 @@ if __name__ == "__main__":
     else:
         gtk_context.init_logging("debug")
 
-    return_code = main(gtk_context)
+    # Write log messages from a background thread so logging does not wait on I/O
+    start_queued_logging()
+
+    # editme: optional feature
+    # Profile the Python parts of the gear, profiles are saved in the output
+    start_profiling(gtk_context.config.get("gear-profile"))
+    with profile_stage("main"):
+        return_code = main(gtk_context)
+    stop_profiling(
+        gtk_context.output_dir, f"gear_profile_{gtk_context.destination['id']}"
+    )
 
     # clean up (might be necessary when running in a shared computing environment)
     for thing in scratch_dir.glob("*"):
         if thing.is_symlink():
             thing.unlink()  # don't remove anything links point to
             log.debug("unlinked %s", thing.name)
-    shutil.rmtree(scratch_dir)
-    log.debug("Removed %s", scratch_dir)
+    # finish removing it after the gear has exited
+    remove_tree_in_background(scratch_dir, detach=True)
+
+    stop_queued_logging()
 
     sys.exit(return_code)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Run the gear for each destination listed in a file, see utils/batch.py.
+
+Usage:
+    run_batch.py destinations.txt [--max-parallel N]
+
+Each line of destinations.txt is the ID of an analysis container to run for.
+Results are written to output/<destination id>/ and the return code of each
+pipeline to output/batch_results.json.
+"""
+
+import argparse
+import logging
+import sys
+
+from run import main
+from utils.batch import read_destination_ids, run_batch
+from utils.cleanup import remove_tree_in_background
+from utils.scratch import get_scratch_candidates
+from utils.singularity import run_in_tmp_dir
+
+log = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("destinations", help="file with one destination ID per line")
+    parser.add_argument(
+        "--max-parallel",
+        type=int,
+        default=0,
+        help="most destinations to run at the same time (default: as many as "
+        "CPUs and memory allow)",
+    )
+    args = parser.parse_args()
+
+    destination_ids = read_destination_ids(args.destinations)
+
+    import flywheel_gear_toolkit
+
+    scratch_dir = run_in_tmp_dir(get_scratch_candidates())
+
+    gtk_context = flywheel_gear_toolkit.GearToolkitContext()
+
+    if gtk_context.config["gear-log-level"] == "INFO":
+        gtk_context.init_logging("info")
+    else:
+        gtk_context.init_logging("debug")
+
+    return_codes = run_batch(gtk_context, destination_ids, main, args.max_parallel)
+
+    for thing in scratch_dir.glob("*"):
+        if thing.is_symlink():
+            thing.unlink()  # don't remove anything links point to
+    remove_tree_in_background(scratch_dir, detach=True)
+
+    sys.exit(0 if all(code == 0 for code in return_codes.values()) else 1)
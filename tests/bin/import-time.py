@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Measure how long it takes to import run.py using "python -X importtime".
+
+The slowest imports are listed and the script exits with an error if
+importing run.py takes longer than the budget or if it imports any of the
+heavy packages that should only be imported by the stage that needs them.
+
+Run this from the main repository directory.
+
+Example:
+    tests/bin/import-time.py --budget 100 --top 15
+
+"""
+
+import argparse
+import os
+import subprocess as sp
+import sys
+
+# These are imported only when they are needed (and not when run.py is imported),
+# tests/unit_tests/test_import_time.py checks the same list
+DEFERRED = [
+    "flywheel",
+    "flywheel_bids",
+    "flywheel_gear_toolkit",
+    "psutil",
+    "pandas",
+    "zstandard",
+]
+
+
+def parse_importtime(stderr):
+    """Return {module: (self_us, cumulative_us)} from "python -X importtime" output."""
+
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--module", default="run", help="module to import")
+    parser.add_argument(
+        "--budget", type=float, default=100.0, help="maximum import time in ms"
+    )
+    parser.add_argument("--top", type=int, default=10, help="how many to list")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    command = [sys.executable, "-X", "importtime", "-c", f"import {args.module}"]
+    result = sp.run(command, env=env, stderr=sp.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        return 1
+
+    times = parse_importtime(result.stderr)
+    total_ms = times[args.module][1] / 1000
+
+    print(f"Slowest {args.top} imports (cumulative ms):")
+    slowest = sorted(times.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (_, cumulative_us) in slowest[: args.top]:
+        print(f"  {cumulative_us / 1000:8.1f}  {name}")
+    print(f"import {args.module} took {total_ms:.1f} ms (budget {args.budget} ms)")
+
+    exit_code = 0
+
+    not_deferred = [name for name in DEFERRED if name in times]
+    if not_deferred:
+        print(f"ERROR: these should not be imported by {args.module}: {not_deferred}")
+        exit_code = 1
+
+    if total_ms > args.budget:
+        print(f"ERROR: import {args.module} is over budget")
+        exit_code = 1
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -68,6 +68,9 @@ main() {
 
     python -m pytest tests/unit_tests tests/integration_tests --exitfirst $COV  "$@"
 
+    log "INFO: Checking start-up import time ..."
+    python tests/bin/import-time.py
+
     if [ -w "." ]; then
         log "INFO: Reporting coverage ..."
         local COVERAGE_ARGS="--skip-covered"
@@ -0,0 +1,142 @@
+import io
+import logging
+import tarfile
+import zipfile
+
+import pytest
+
+from utils.bids.archive_input import (
+    UnsafeArchiveError,
+    extract_bids_archive,
+    find_bids_root,
+)
+
+
+def make_zip(path, members):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+
+
+def make_tar(path, members, mode="w:gz"):
+    with tarfile.open(path, mode) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+DATASET = {
+    "my_study/dataset_description.json": b'{"Name": "test"}',
+    "my_study/sub-01/anat/sub-01_T1w.nii.gz": b"t1w" * 100,
+    "my_study/sub-01/func/sub-01_task-rest_bold.nii.gz": b"bold" * 100,
+    "README.txt": b"outside the dataset",
+}
+
+
+def test_find_bids_root():
+
+    assert str(find_bids_root(list(DATASET))) == "my_study"
+    assert str(find_bids_root(["dataset_description.json", "a/b/x"])) == "."
+
+
+def test_extract_zip_strips_top_directory(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+    archive = tmp_path / "bids.zip"
+    make_zip(archive, DATASET)
+    bids_dir = tmp_path / "work/bids"
+
+    extract_bids_archive(archive, bids_dir, max_workers=2)
+
+    assert (bids_dir / "dataset_description.json").exists()
+    t1w = bids_dir / "sub-01/anat/sub-01_T1w.nii.gz"
+    assert t1w.read_bytes() == b"t1w" * 100
+    assert not (bids_dir / "README.txt").exists()
+    assert search_caplog(caplog, "Extracted 3 files")
+
+
+def test_extract_tar_skips_unsafe_members(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+    archive = tmp_path / "bids.tar.gz"
+    make_tar(
+        archive,
+        {
+            "dataset_description.json": b"{}",
+            "sub-01/anat/sub-01_T1w.nii.gz": b"t1w",
+            "../escaped.txt": b"bad",
+        },
+    )
+    bids_dir = tmp_path / "work/bids"
+
+    extract_bids_archive(archive, bids_dir)
+
+    assert (bids_dir / "sub-01/anat/sub-01_T1w.nii.gz").read_bytes() == b"t1w"
+    assert not (tmp_path / "work/escaped.txt").exists()
+    assert search_caplog(caplog, "Not extracting unsafe member ../escaped.txt")
+
+
+def test_extract_zip_bomb_is_refused(tmp_path):
+
+    archive = tmp_path / "bomb.zip"
+    make_zip(archive, {"dataset_description.json": b"\0" * 10000000})
+    bids_dir = tmp_path / "work/bids"
+
+    with pytest.raises(UnsafeArchiveError, match="zip bomb"):
+        extract_bids_archive(archive, bids_dir, max_ratio=200)
+
+    assert not bids_dir.exists()
+
+
+def test_extract_highly_compressible_zip(tmp_path):
+
+    archive = tmp_path / "bids.zip"
+    mask = b"\0" * 10000000  # deflates ~1000 times, like an empty mask
+    make_zip(archive, {"dataset_description.json": b"{}", "sub-01/mask.nii": mask})
+    bids_dir = tmp_path / "work/bids"
+
+    extract_bids_archive(archive, bids_dir)
+
+    assert (bids_dir / "sub-01/mask.nii").stat().st_size == len(mask)
+
+
+def test_extract_too_big_is_refused(tmp_path):
+
+    archive = tmp_path / "bids.tar"
+    make_tar(archive, {"dataset_description.json": b"x" * 5000}, mode="w")
+    bids_dir = tmp_path / "work/bids"
+
+    with pytest.raises(UnsafeArchiveError, match="bigger than"):
+        extract_bids_archive(archive, bids_dir, max_bytes=1000)
+
+    assert not bids_dir.exists()
+
+
+def test_extract_skips_excluded_files(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+    archive = tmp_path / "bids.zip"
+    make_zip(archive, DATASET)
+    bids_dir = tmp_path / "work/bids"
+
+    extract_bids_archive(archive, bids_dir, exclude=["func/"])
+
+    assert (bids_dir / "sub-01/anat/sub-01_T1w.nii.gz").exists()
+    assert not (bids_dir / "sub-01/func").exists()
+    assert search_caplog(caplog, "Skipped 1 ignored files")
+
+
+def test_extract_corrupt_tar_zst_is_a_tar_error(tmp_path):
+
+    import zstandard
+
+    archive = tmp_path / "bids.tar.zst"
+    good = zstandard.ZstdCompressor().compress(b"x" * 100000)
+    archive.write_bytes(good[:20] + b"\xff" * 200)  # a valid header, then junk
+    bids_dir = tmp_path / "work/bids"
+
+    with pytest.raises(tarfile.ReadError, match="zstd"):
+        extract_bids_archive(archive, bids_dir)
+
+    assert not bids_dir.exists()
@@ -0,0 +1,132 @@
+import json
+import os
+from pathlib import Path
+
+import flywheel
+import pytest
+from flywheel_gear_toolkit import GearToolkitContext
+
+from utils.batch import plan_batch, read_destination_ids, run_batch
+from utils.bids.download_run_level import download_bids_for_runlevel
+
+
+class FakeClient:
+    """Stands in for flywheel.Client, remembers the process that made it."""
+
+    def __init__(self, *args):
+        self.pid = os.getpid()
+
+    def get(self, container_id):
+        return {"parents": {"project": f"project of {container_id}"}}
+
+
+def fake_download_bids_dir(client, parent_id, container_type, target_dir, **kwargs):
+    """Save what would have been downloaded instead of downloading it."""
+
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+    (Path(target_dir) / "dataset_description.json").write_text("{}")
+    (Path(target_dir) / "download.json").write_text(
+        json.dumps({"parent_id": parent_id, "client_pid": client.pid})
+    )
+
+
+@pytest.fixture
+def batch_context(tmp_path, monkeypatch):
+    """A gear toolkit context for a batch job in tmp_path/fwv0."""
+
+    fwv0 = tmp_path / "fwv0"
+    for path in [fwv0, tmp_path / "gear_files"]:
+        path.mkdir()
+    (fwv0 / "run.py").symlink_to(tmp_path / "gear_files")
+    (fwv0 / "manifest.json").write_text(json.dumps({"name": "gear"}))
+    config = {"n_cpus": 1, "mem_gb": 0.001, "gear-log-level": "INFO"}
+    (fwv0 / "config.json").write_text(
+        json.dumps(
+            {
+                "config": config,
+                "inputs": {},
+                "destination": {"id": "batch", "type": "analysis"},
+            }
+        )
+    )
+    monkeypatch.chdir(fwv0)
+    monkeypatch.setattr(flywheel, "Client", FakeClient)
+    monkeypatch.setattr(
+        GearToolkitContext, "_load_download_bids", lambda self: fake_download_bids_dir
+    )
+
+    return GearToolkitContext(gear_path=fwv0, input_args=[])
+
+
+def fake_main(context):
+    """Save what this pipeline was given, fail for "bad"."""
+
+    Path(context.output_dir / "result.json").write_text(
+        json.dumps(
+            {
+                "id": context.destination["id"],
+                "cwd": os.getcwd(),
+                "client_pid": context.client.pid,
+            }
+        )
+    )
+    return 3 if context.destination["id"] == "bad" else 0
+
+
+def test_read_destination_ids(tmp_path):
+
+    ids_file = tmp_path / "ids.txt"
+    ids_file.write_text("aaa\n\n# comment\nbbb  # second\naaa\n")
+
+    assert read_destination_ids(ids_file) == ["aaa", "bbb"]
+
+
+def test_plan_batch_is_limited_by_cpus():
+
+    parallel, n_cpus, mem_gb = plan_batch(1000, n_cpus=os.cpu_count(), mem_gb=0.001)
+
+    assert parallel == 1
+    assert n_cpus == os.cpu_count()
+
+
+def test_run_batch(batch_context):
+
+    fwv0 = Path.cwd()
+    output_dir = batch_context.output_dir
+    batch_client = batch_context.client
+
+    return_codes = run_batch(batch_context, ["good", "bad"], fake_main)
+
+    assert return_codes == {"good": 0, "bad": 3}
+    result = json.loads((output_dir / "good/result.json").read_text())
+    assert result["cwd"] == str(fwv0 / "batch/good")
+    # each pipeline makes its own client after the fork
+    assert result["client_pid"] != batch_client.pid
+    assert (fwv0 / "batch/good/run.py").is_symlink()
+    assert json.loads((output_dir / "batch_results.json").read_text()) == return_codes
+
+
+def download_main(context):
+    hierarchy = {
+        "run_level": "session",
+        "run_label": "ses-1",
+        "subject_label": "sub-01",
+        "session_label": "ses-1",
+    }
+    return download_bids_for_runlevel(context, hierarchy, do_validate_bids=False)
+
+
+def test_run_batch_downloads_for_each_destination(batch_context):
+
+    fwv0 = Path.cwd()
+    batch_client = batch_context.client
+
+    return_codes = run_batch(batch_context, ["aaa", "bbb"], download_main)
+
+    assert return_codes == {"aaa": 0, "bbb": 0}
+    for destination_id in ["aaa", "bbb"]:
+        bids_dir = fwv0 / "batch" / destination_id / "work/bids"
+        download = json.loads((bids_dir / "download.json").read_text())
+        assert download["parent_id"] == f"project of {destination_id}"
+        assert download["client_pid"] != batch_client.pid
+    assert not (batch_context.work_dir / "bids").exists()
@@ -0,0 +1,75 @@
+import json
+import logging
+
+from utils.checkpoint import Checkpoint, get_run_key
+from utils.singularity import FWV0, find_previous_run
+
+
+def write_config(path, resume=True, subject="sub-01"):
+    config = {
+        "config": {"gear-resume": resume, "subject": subject},
+        "inputs": {},
+        "destination": {"id": "dest123"},
+    }
+    path.write_text(json.dumps(config))
+    return path
+
+
+def test_get_run_key(tmp_path):
+
+    key = get_run_key(write_config(tmp_path / "a.json"))
+
+    assert key == get_run_key(write_config(tmp_path / "b.json"))
+    assert key != get_run_key(write_config(tmp_path / "c.json", subject="sub-02"))
+    assert get_run_key(write_config(tmp_path / "d.json", resume=False)) is None
+    assert get_run_key(tmp_path / "missing.json") is None
+
+
+def test_checkpoint_skips_finished_stages(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+    checkpoint_file = tmp_path / "gear_checkpoint.json"
+    output = tmp_path / "out.zip"
+    calls = []
+
+    def zip_it():
+        calls.append("zip")
+        output.write_text("zip")
+        return {"parts": 1}
+
+    checkpoint = Checkpoint(checkpoint_file, "key")
+    checkpoint.values["output_manifest"] = {"out.zip": []}
+    assert checkpoint.wrap("zip_output", zip_it, outputs=[output])() == {"parts": 1}
+
+    restarted = Checkpoint(checkpoint_file, "key")
+    assert restarted.values["output_manifest"] == {"out.zip": []}
+    assert restarted.wrap("zip_output", zip_it, outputs=[output])() == {"parts": 1}
+    assert calls == ["zip"]
+    assert search_caplog(caplog, "Skipping zip_output")
+
+    # not skipped if what it made is gone or the key is different
+    output.unlink()
+    assert not Checkpoint(checkpoint_file, "key").is_done("zip_output")
+    assert not Checkpoint(checkpoint_file, "other").is_done("zip_output")
+
+
+def test_checkpoint_fingerprint_must_match(tmp_path):
+
+    checkpoint = Checkpoint(tmp_path / "gear_checkpoint.json", "key")
+    checkpoint.mark_done("exec", "abc")
+
+    assert checkpoint.is_done("exec", "abc")
+    assert not checkpoint.is_done("exec", "def")
+
+
+def test_find_previous_run(tmp_path):
+
+    runs = []
+    for name, key in [("gear-temp-dir-a", "one"), ("gear-temp-dir-b", "two")]:
+        fwv0 = tmp_path / name / FWV0.lstrip("/")
+        fwv0.mkdir(parents=True)
+        Checkpoint(fwv0 / "gear_checkpoint.json", key).mark_done("download")
+        runs.append(tmp_path / name)
+
+    assert find_previous_run(runs, "two") == runs[1]
+    assert find_previous_run(runs, "three") is None
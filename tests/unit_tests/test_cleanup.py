@@ -0,0 +1,71 @@
+import logging
+import time
+
+from utils.cleanup import (
+    TRASH_NAME,
+    move_aside,
+    remove_tree,
+    remove_tree_in_background,
+    wait_for_cleanup,
+)
+
+
+def make_tree(path):
+    for dd in ["one/two", "three", "four/five/six"]:
+        (path / dd).mkdir(parents=True)
+        (path / dd / "file.txt").touch()
+    return path
+
+
+def test_move_aside_works(tmp_path):
+
+    tree = make_tree(tmp_path / "tree")
+
+    trash = move_aside(tree)
+
+    assert not tree.exists()
+    assert trash.name.startswith(TRASH_NAME)
+    assert (trash / "tree/one/two/file.txt").exists()
+
+
+def test_remove_tree_does_not_follow_symlinks(tmp_path):
+
+    tree = make_tree(tmp_path / "tree")
+    keep = make_tree(tmp_path / "keep")
+    (tree / "link").symlink_to(keep)
+    (tree / "three/link").symlink_to(keep / "three/file.txt")
+
+    remove_tree(tree)
+
+    assert not tree.exists()
+    assert (keep / "three/file.txt").exists()
+
+
+def test_remove_tree_in_background_works(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+
+    tree = make_tree(tmp_path / "tree")
+
+    trash = remove_tree_in_background(tree)
+    assert not tree.exists()
+
+    wait_for_cleanup()
+
+    assert not trash.exists()
+    assert search_caplog(caplog, "in the background")
+
+
+def test_remove_tree_in_background_detached_works(tmp_path):
+
+    tree = make_tree(tmp_path / "tree")
+
+    trash = remove_tree_in_background(tree, detach=True)
+
+    for _ in range(100):
+        if not trash.exists():
+            break
+        time.sleep(0.1)
+
+    assert not tree.exists()
+    assert not trash.exists()
@@ -0,0 +1,88 @@
+import gzip
+import json
+import logging
+
+from utils.bids.decompress import decompress_bids, get_uncompressed_size
+
+
+def make_nifti(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(path, "wb") as fp:
+        fp.write(data)
+
+
+def test_decompress_bids_matching_files(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+    bold = tmp_path / "sub-01/func/sub-01_task-rest_bold.nii.gz"
+    t1w = tmp_path / "sub-01/anat/sub-01_T1w.nii.gz"
+    make_nifti(bold, b"bold" * 1000)
+    make_nifti(t1w, b"t1w" * 1000)
+    (tmp_path / "sub-01/func/sub-01_task-rest_bold.json").write_text("{}")
+
+    assert get_uncompressed_size(bold) == 4000
+
+    decompressed = decompress_bids(tmp_path, ["*_bold.nii.gz"], max_workers=2)
+
+    nii = tmp_path / "sub-01/func/sub-01_task-rest_bold.nii"
+    assert decompressed == [nii]
+    assert nii.read_bytes() == b"bold" * 1000
+    assert not bold.exists()
+    assert t1w.exists()
+    assert search_caplog(caplog, "Decompressed 1 files")
+
+
+def test_decompress_bids_nothing_matches(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+    make_nifti(tmp_path / "sub-01/anat/sub-01_T1w.nii.gz", b"t1w")
+
+    assert decompress_bids(tmp_path, ["*_bold.nii.gz"]) == []
+    assert search_caplog(caplog, "No .nii.gz files match")
+
+
+def test_decompress_bids_updates_references(tmp_path):
+
+    bold = tmp_path / "sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz"
+    make_nifti(bold, b"bold" * 1000)
+    make_nifti(tmp_path / "sub-01/ses-1/anat/sub-01_ses-1_T1w.nii.gz", b"t1w")
+    fmap = tmp_path / "sub-01/ses-1/fmap/sub-01_ses-1_epi.json"
+    fmap.parent.mkdir(parents=True)
+    fmap.write_text(
+        json.dumps(
+            {
+                "IntendedFor": [
+                    "ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz",
+                    "ses-1/anat/sub-01_ses-1_T1w.nii.gz",
+                ],
+                "TotalReadoutTime": 0.05,
+            }
+        )
+    )
+    uri_fmap = tmp_path / "sub-01/ses-1/fmap/sub-01_ses-1_phasediff.json"
+    uri = "bids::sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii.gz"
+    uri_fmap.write_text(json.dumps({"IntendedFor": uri}))
+    scans = tmp_path / "sub-01/ses-1/sub-01_ses-1_scans.tsv"
+    scans.write_text(
+        "filename\tacq_time\n"
+        "func/sub-01_ses-1_task-rest_bold.nii.gz\t2020-01-01T00:00:00\n"
+        "anat/sub-01_ses-1_T1w.nii.gz\t2020-01-01T00:10:00\n"
+    )
+
+    decompress_bids(tmp_path, ["*_bold.nii.gz"])
+
+    assert json.loads(fmap.read_text()) == {
+        "IntendedFor": [
+            "ses-1/func/sub-01_ses-1_task-rest_bold.nii",
+            "ses-1/anat/sub-01_ses-1_T1w.nii.gz",
+        ],
+        "TotalReadoutTime": 0.05,
+    }
+    assert json.loads(uri_fmap.read_text())["IntendedFor"] == (
+        "bids::sub-01/ses-1/func/sub-01_ses-1_task-rest_bold.nii"
+    )
+    assert scans.read_text() == (
+        "filename\tacq_time\n"
+        "func/sub-01_ses-1_task-rest_bold.nii\t2020-01-01T00:00:00\n"
+        "anat/sub-01_ses-1_T1w.nii.gz\t2020-01-01T00:10:00\n"
+    )
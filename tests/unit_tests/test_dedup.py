@@ -0,0 +1,49 @@
+import logging
+
+from flywheel_gear_toolkit.utils.zip_tools import zip_info
+
+from utils.results.dedup import load_content_index, save_to_content_index
+from utils.results.zip_output import zip_output
+
+
+def make_output(tmp_path, destination_id):
+
+    (tmp_path / destination_id).mkdir()
+    (tmp_path / destination_id / "template.nii").write_bytes(b"t" * 100000)
+    result = destination_id.encode() * 100000
+    (tmp_path / destination_id / "result.nii").write_bytes(result)
+
+
+def test_second_analysis_points_to_first(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+    index_dir = tmp_path / "index"
+
+    make_output(tmp_path, "first")
+    manifest = {}
+    zip_output(str(tmp_path), "first", "first.zip", manifest=manifest)
+    save_to_content_index(index_dir, "first", manifest)
+
+    make_output(tmp_path, "second")
+    content_index = load_content_index(index_dir, exclude_analysis="second")
+    manifest = {}
+    zip_output(
+        str(tmp_path),
+        "second",
+        "second.zip",
+        manifest=manifest,
+        content_index=content_index,
+    )
+
+    assert zip_info(tmp_path / "second.zip") == ["second/result.nii"]
+    pointer = [m for m in manifest["second.zip"] if "stored_in" in m][0]
+    assert pointer["path"] == "second/template.nii"
+    assert pointer["stored_in"] == {
+        "analysis": "first",
+        "archive": "first.zip",
+        "path": "first/template.nii",
+    }
+    assert search_caplog(caplog, "Not archiving 1 files")
+
+    # an analysis that is run again does not point to itself
+    assert load_content_index(index_dir, exclude_analysis="first") == {}
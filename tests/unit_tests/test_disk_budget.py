@@ -0,0 +1,52 @@
+import logging
+
+import utils.fly.disk_budget
+from utils.fly.disk_budget import (
+    check_disk_budget,
+    estimate_run_bytes,
+    format_bytes,
+    inventory_dir,
+)
+
+
+def test_inventory_dir_skips_symlinks(tmp_path):
+
+    (tmp_path / "adir").mkdir()
+    (tmp_path / "adir/big").write_bytes(b"x" * 100)
+    (tmp_path / "small").write_bytes(b"x" * 10)
+    (tmp_path / "link").symlink_to(tmp_path / "adir/big")
+
+    total_bytes, largest_bytes, num_files = inventory_dir(tmp_path)
+
+    assert total_bytes == 110
+    assert largest_bytes == 100
+    assert num_files == 2
+    assert inventory_dir(tmp_path / "missing") == (0, 0, 0)
+
+
+def test_estimate_run_bytes_includes_intermediate():
+
+    estimate = estimate_run_bytes(100, 8)
+    estimate_intermediate = estimate_run_bytes(100, 8, save_intermediate=True)
+
+    assert estimate == {"app": 800, "work": 400, "archives": 400}
+    assert estimate_intermediate["archives"] == 800
+
+
+def test_check_disk_budget_levels(tmp_path, monkeypatch, caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+
+    monkeypatch.setattr(utils.fly.disk_budget, "get_free_bytes", lambda path: 1000)
+
+    assert check_disk_budget("stage 1", tmp_path, 500) == "ok"
+    assert check_disk_budget("stage 2", tmp_path, 2000, minimum_bytes=500) == "tight"
+    assert check_disk_budget("stage 3", tmp_path, 2000) == "insufficient"
+    assert search_caplog(caplog, "Disk budget for stage 2 is tight")
+    assert search_caplog(caplog, "Not enough disk space for stage 3")
+
+
+def test_format_bytes():
+
+    assert format_bytes(512) == "512.00 B"
+    assert format_bytes(3 * 1024 ** 3 // 2) == "1.50 GiB"
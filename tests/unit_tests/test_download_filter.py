@@ -0,0 +1,55 @@
+import logging
+
+from flywheel_bids import export_bids
+
+from utils.bids.download_filter import (
+    make_matcher,
+    read_ignore_patterns,
+    skip_ignored_files,
+)
+
+
+def test_read_ignore_patterns(tmp_path):
+
+    bidsignore = tmp_path / ".bidsignore"
+    bidsignore.write_text("# comment\n\nderivatives/\n  *_sbref.nii.gz \n")
+
+    assert read_ignore_patterns(bidsignore) == ["derivatives/", "*_sbref.nii.gz"]
+
+
+def test_make_matcher():
+
+    matcher = make_matcher(
+        ["derivatives/", "*_sbref.nii.gz", "/extra", "sub-*/**/*.tsv", "!keep.tsv"]
+    )
+
+    assert matcher("derivatives/fmriprep/x.nii.gz") == "derivatives/"
+    assert matcher("derivatives") is None  # a file, not a directory
+    assert matcher("sub-01/func/sub-01_sbref.nii.gz") == "*_sbref.nii.gz"
+    assert matcher("extra/notes.txt") == "/extra"
+    assert matcher("sub-01/extra/notes.txt") is None
+    assert matcher("sub-01/ses-1/func/events.tsv") == "sub-*/**/*.tsv"
+    assert matcher("sub-01/keep.tsv") is None
+    assert matcher("sub-01/anat/sub-01_T1w.nii.gz") is None
+
+
+def test_skip_ignored_files(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+    original = export_bids.is_file_excluded_options
+    bids_dir = tmp_path / "bids"
+
+    def bids_file(name, size):
+        return {"name": name, "size": size, "info": {"BIDS": {"Filename": name}}}
+
+    with skip_ignored_files(bids_dir, ["*_sbref.nii.gz"]) as skipped:
+        is_file_excluded = export_bids.is_file_excluded_options("BIDS", False, False)
+        sbref = bids_file("sub-01_sbref.nii.gz", 2048)
+        bold = bids_file("sub-01_bold.nii.gz", 4096)
+        assert is_file_excluded(sbref, str(bids_dir / "sub-01/func" / sbref["name"]))
+        assert not is_file_excluded(bold, str(bids_dir / "sub-01/func" / bold["name"]))
+
+    assert export_bids.is_file_excluded_options is original
+    assert skipped.count == 1
+    assert skipped.num_bytes == 2048
+    assert search_caplog(caplog, "Skipped 1 ignored files")
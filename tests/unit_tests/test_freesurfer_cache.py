@@ -0,0 +1,108 @@
+import gzip
+import logging
+
+from utils.bids.decompress import decompress_bids
+from utils.freesurfer import (
+    RECON_ALL_DONE,
+    get_freesurfer_version,
+    get_subject_cache_key,
+    harvest_subjects,
+    mount_cached_subjects,
+)
+
+SUBJECT = "sub-TOME3024"
+
+
+def make_bids(bids_path, contents=b"T1w data"):
+    anat = bids_path / SUBJECT / "ses-Session2" / "anat"
+    anat.mkdir(parents=True)
+    (anat / f"{SUBJECT}_ses-Session2_T1w.nii.gz").write_bytes(gzip.compress(contents))
+    (anat / f"{SUBJECT}_ses-Session2_T1w.json").write_text("{}")
+
+
+def make_recon_all_subject(subjects_dir):
+    subject_dir = subjects_dir / SUBJECT
+    (subject_dir / "scripts").mkdir(parents=True)
+    (subject_dir / "mri").mkdir()
+    (subject_dir / "mri/orig.mgz").touch()
+    (subject_dir / RECON_ALL_DONE).touch()
+
+
+def test_harvest_then_mount_works(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+
+    bids_path = tmp_path / "work/bids"
+    make_bids(bids_path)
+    cache_dir = tmp_path / "cache"
+
+    # first run: nothing cached, recon-all creates the subject
+    first_subjects = tmp_path / "first/subjects"
+    first_subjects.mkdir(parents=True)
+    subject_keys = mount_cached_subjects(cache_dir, first_subjects, bids_path, "7.1.1")
+    make_recon_all_subject(first_subjects)
+    harvested = harvest_subjects(cache_dir, subject_keys, [first_subjects])
+
+    # second run: subject is linked into the new SUBJECTS_DIR
+    second_subjects = tmp_path / "second/subjects"
+    second_subjects.mkdir(parents=True)
+    mount_cached_subjects(cache_dir, second_subjects, bids_path, "7.1.1")
+
+    assert harvested == [SUBJECT]
+    key = subject_keys[SUBJECT]
+    cached = cache_dir / key / SUBJECT / "mri/orig.mgz"
+    mounted = second_subjects / SUBJECT / "mri/orig.mgz"
+    assert mounted.stat().st_ino == cached.stat().st_ino
+    assert not cached.stat().st_mode & 0o222
+    assert not (second_subjects / SUBJECT / "mri").is_symlink()
+    assert search_caplog(caplog, "is not in the cache")
+    assert search_caplog(caplog, "Using cached FreeSurfer subject")
+
+
+def test_incomplete_subject_is_not_harvested(tmp_path):
+
+    bids_path = tmp_path / "work/bids"
+    make_bids(bids_path)
+    subjects_dir = tmp_path / "subjects"
+    (subjects_dir / SUBJECT / "scripts").mkdir(parents=True)
+    cache_dir = tmp_path / "cache"
+
+    subject_keys = mount_cached_subjects(cache_dir, subjects_dir, bids_path, "7.1.1")
+    harvested = harvest_subjects(cache_dir, subject_keys, [subjects_dir])
+
+    assert harvested == []
+    assert list(cache_dir.glob("*")) == []
+
+
+def test_cache_key_depends_on_inputs_and_version(tmp_path):
+
+    make_bids(tmp_path / "a")
+    make_bids(tmp_path / "b", contents=b"different T1w data")
+
+    key_a = get_subject_cache_key(tmp_path / "a", SUBJECT, "7.1.1")
+
+    assert key_a == get_subject_cache_key(tmp_path / "a", SUBJECT, "7.1.1")
+    assert key_a != get_subject_cache_key(tmp_path / "a", SUBJECT, "6.0.1")
+    assert key_a != get_subject_cache_key(tmp_path / "b", SUBJECT, "7.1.1")
+    assert get_subject_cache_key(tmp_path / "a", "sub-missing", "7.1.1") is None
+
+
+def test_cache_key_is_the_same_after_decompression(tmp_path):
+
+    bids_path = tmp_path / "work/bids"
+    make_bids(bids_path)
+    key = get_subject_cache_key(bids_path, SUBJECT, "7.1.1")
+
+    decompress_bids(bids_path, ["*_T1w.nii.gz"])
+
+    assert list(bids_path.rglob("*_T1w.nii.gz")) == []
+    assert get_subject_cache_key(bids_path, SUBJECT, "7.1.1") == key
+
+
+def test_get_freesurfer_version_missing_is_unknown(tmp_path):
+
+    assert get_freesurfer_version(tmp_path) == "unknown"
+
+    (tmp_path / "build-stamp.txt").write_text("freesurfer-linux-7.1.1\n")
+
+    assert get_freesurfer_version(tmp_path) == "freesurfer-linux-7.1.1"
@@ -0,0 +1,32 @@
+"""Make sure heavy packages are only imported by the stage that needs them."""
+
+import importlib.util
+import json
+import os
+import subprocess as sp
+import sys
+from pathlib import Path
+
+# the list of packages to defer is kept in tests/bin/import-time.py
+spec = importlib.util.spec_from_file_location(
+    "import_time", Path(__file__).parents[1] / "bin/import-time.py"
+)
+import_time = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(import_time)
+DEFERRED = import_time.DEFERRED
+
+
+def test_import_run_defers_heavy_packages():
+
+    code = (
+        "import json, sys, run; "
+        f"print(json.dumps([m for m in {DEFERRED} if m in sys.modules]))"
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+
+    result = sp.run(
+        [sys.executable, "-c", code], env=env, stdout=sp.PIPE, universal_newlines=True
+    )
+
+    assert result.returncode == 0
+    assert json.loads(result.stdout) == []
@@ -0,0 +1,45 @@
+from utils.fly import metrics
+from utils.fly.metrics import (
+    format_metrics,
+    format_value,
+    set_metric,
+    write_textfile,
+)
+
+
+def test_write_textfile(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(metrics, "metrics", {})
+
+    set_metric("gear_stage_seconds", 1.5, "Stage duration", {"stage": "zip"})
+    set_metric("gear_stage_seconds", 2, "Stage duration", {"stage": "zip"})
+    set_metric("gear_return_code", 0, "Exit code of the gear")
+
+    prom_file = write_textfile(tmp_path, "gear_dest.prom", {"gear": 'a "b"'})
+
+    assert prom_file.read_text() == (
+        "# HELP gear_return_code Exit code of the gear\n"
+        "# TYPE gear_return_code gauge\n"
+        'gear_return_code{gear="a \\"b\\""} 0\n'
+        "# HELP gear_stage_seconds Stage duration\n"
+        "# TYPE gear_stage_seconds gauge\n"
+        'gear_stage_seconds{gear="a \\"b\\"",stage="zip"} 2\n'
+    )
+    assert list(tmp_path.iterdir()) == [prom_file]
+
+
+def test_format_metrics_empty(monkeypatch):
+
+    monkeypatch.setattr(metrics, "metrics", {})
+
+    assert format_metrics({}) == ""
+
+
+def test_format_value_keeps_precision():
+
+    assert format_value(12345678901) == "12345678901"
+    assert format_value(True) == "1"
+    assert format_value(0.1 + 0.2) == "0.30000000000000004"
+    assert format_value(1.5) == "1.5"
+    assert format_value(float("inf")) == "+Inf"
+    assert format_value(float("nan")) == "NaN"
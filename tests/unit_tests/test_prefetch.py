@@ -0,0 +1,61 @@
+import logging
+
+from utils.bids.prefetch import (
+    Prefetcher,
+    get_prefetch_budget,
+    list_prefetch_files,
+)
+
+
+def make_bids(bids_dir):
+    for name, size in [
+        ("dataset_description.json", 10),
+        ("sub-01/func/sub-01_task-rest_bold.nii.gz", 300),
+        ("sub-01/anat/sub-01_T1w.nii.gz", 200),
+        ("sub-01/dwi/sub-01_dwi.nii.gz", 400),
+    ]:
+        path = bids_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+
+
+def test_list_prefetch_files_anat_first(tmp_path):
+
+    make_bids(tmp_path)
+
+    files = [path for path, _ in list_prefetch_files(tmp_path)]
+
+    assert files == [
+        str(tmp_path / "sub-01/anat/sub-01_T1w.nii.gz"),
+        str(tmp_path / "sub-01/func/sub-01_task-rest_bold.nii.gz"),
+        str(tmp_path / "sub-01/dwi/sub-01_dwi.nii.gz"),
+        str(tmp_path / "dataset_description.json"),
+    ]
+
+
+def test_prefetcher_stays_in_budget(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+    make_bids(tmp_path)
+
+    prefetcher = Prefetcher(tmp_path, app_gb=0, max_workers=2, budget=550)
+    prefetcher.start()
+    prefetcher.wait()
+    prefetcher.stop()
+
+    assert sorted(prefetcher.prefetched) == [
+        str(tmp_path / "dataset_description.json"),
+        str(tmp_path / "sub-01/anat/sub-01_T1w.nii.gz"),
+        str(tmp_path / "sub-01/func/sub-01_task-rest_bold.nii.gz"),
+    ]
+    assert prefetcher.skipped == 1
+    assert search_caplog(caplog, "Prefetched 3 files")
+
+
+def test_prefetch_budget_warns_when_app_needs_everything(caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+
+    assert get_prefetch_budget(app_gb=0) > 0
+    assert get_prefetch_budget(app_gb=10 ** 6) == 0
+    assert search_caplog(caplog, "Not prefetching: the BIDS App is expected to use")
@@ -0,0 +1,48 @@
+import time
+
+from flywheel_gear_toolkit.utils.zip_tools import zip_info
+
+from utils.profiling import profile_stage, start_profiling, stop_profiling
+from utils.stages import run_stages
+
+
+def busy():
+    return sum(ii * ii for ii in range(10000))
+
+
+def test_cprofile_profiles_main_and_stages(tmp_path):
+
+    assert start_profiling("cprofile", tmp_path / "profile") == "cprofile"
+    with profile_stage("main"):
+        run_stages({"one": (busy, []), "two": (busy, [])}, [])
+        time.sleep(0.05)  # let the sampler see something
+    zip_file = stop_profiling(tmp_path, "gear_profile")
+
+    names = zip_info(zip_file)
+    assert "profile/main.prof" in names
+    assert "profile/main.collapsed" in names
+    assert "profile/one.prof" in names
+    assert "profile/two.prof" in names
+    assert not (tmp_path / "profile").exists()
+
+
+def test_tracemalloc_saves_peak_memory(tmp_path):
+
+    start_profiling("tracemalloc", tmp_path / "profile")
+    with profile_stage("allocate"):
+        big = [bytearray(1000) for _ in range(1000)]
+    zip_file = stop_profiling(tmp_path)
+
+    assert len(big) == 1000
+    assert sorted(zip_info(zip_file)) == [
+        "profile/allocate.allocations.txt",
+        "profile/peak_memory.txt",
+    ]
+
+
+def test_profiling_off_by_default(tmp_path):
+
+    assert start_profiling("none") is None
+    with profile_stage("main"):
+        busy()
+    assert stop_profiling(tmp_path) is None
@@ -0,0 +1,86 @@
+import json
+import logging
+import re
+import time
+
+import pytest
+
+from utils.fly import progress as progress_module
+from utils.fly.progress import ProgressTracker, on_subject_finished
+from utils.fly.supervisor import exec_supervised
+
+
+def test_progress_tracker_markers(tmp_path, caplog, search_caplog, monkeypatch):
+
+    caplog.set_level(logging.INFO)
+    monkeypatch.setattr(
+        progress_module,
+        "PROGRESS_PATTERNS",
+        progress_module.PROGRESS_PATTERNS
+        + [(re.compile(r"^Subject sub-(?P<subject>\w+) done$"), on_subject_finished)],
+    )
+    progress_file = tmp_path / "progress.json"
+    tracker = ProgressTracker(progress_file, total_subjects=2)
+
+    for line in [
+        '[Node] Setting-up "fmriprep_wf.single_subject_01_wf.anat.t1w_ref" in "/w"',
+        '[Node] Finished "fmriprep_wf.single_subject_01_wf.anat.t1w_ref", elapsed 1s.',
+        '[Node] Finished "wf.anat.brain_mask", elapsed time 1.5s.',
+        "Subject sub-01 done",
+    ]:
+        tracker.feed(line)
+
+    progress = tracker.report()
+
+    assert progress["nodes_finished"] == 2
+    assert progress["subjects_started"] == ["sub-01"]
+    assert progress["subjects_finished"] == ["sub-01"]
+    assert progress["eta_seconds"] is not None
+    assert json.loads(progress_file.read_text())["nodes_finished"] == 2
+    assert search_caplog(caplog, "1/2 subjects finished")
+
+
+def test_progress_tracker_percent():
+
+    tracker = ProgressTracker()
+
+    tracker.feed("Registering:  75%|#######5  | 3/4 [00:30<00:10,  9.8s/it]")
+
+    assert tracker.percent == 75
+    assert tracker.get_eta(30) == 10
+
+
+def test_progress_tracker_ignores_other_output():
+
+    tracker = ProgressTracker()
+
+    for line in [
+        "Processing sub-01",
+        "Finished sub-01 with 3 warnings",
+        "Step 3 of 4: 75% done",
+        "Smoothing done for sub-02, 12% of voxels changed",
+    ]:
+        tracker.feed(line)
+
+    assert tracker.state_key() == (0, 0, 0, None)
+    assert tracker.last_progress == tracker.start
+
+
+def test_stalled_command_is_stopped(monkeypatch):
+
+    monkeypatch.setattr("utils.fly.supervisor.POLL_INTERVAL", 0.05)
+    monkeypatch.setattr("utils.fly.supervisor.TERM_GRACE", 2)
+    monkeypatch.setattr(progress_module, "REPORT_INTERVAL", 0.1)
+    tracker = ProgressTracker(stall_minutes=0.01)  # 0.6 seconds
+
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match="made no progress"):
+        exec_supervised(
+            ["echo '[Node] Setting-up \"wf.single_subject_01_wf.a\"'; sleep 30"],
+            shell=True,
+            line_callback=tracker.feed,
+            watch_callback=tracker.check,
+        )
+
+    assert tracker.subjects_started == {"sub-01"}
+    assert time.monotonic() - start < 10
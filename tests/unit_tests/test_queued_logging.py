@@ -0,0 +1,84 @@
+import logging
+import threading
+
+from utils.fly.queued_logging import (
+    LimitedLog,
+    flush_logging,
+    start_queued_logging,
+    stop_queued_logging,
+)
+
+log = logging.getLogger(__name__)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_queued_logging_writes_everything():
+
+    root = logging.getLogger()
+    handler = ListHandler()
+    old_handlers = root.handlers
+    root.handlers = [handler]
+    try:
+        start_queued_logging()
+        assert handler not in root.handlers
+        for ii in range(50):
+            log.warning("message %d", ii)
+        flush_logging()
+        assert len(handler.messages) == 50
+        log.warning("last one")
+        stop_queued_logging()
+        assert root.handlers == [handler]
+        assert handler.messages[-1] == "last one"
+    finally:
+        stop_queued_logging()
+        root.handlers = old_handlers
+
+
+def test_limited_log(caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+
+    zipping = LimitedLog(log, "Zipping %s", first_n=2)
+    for name in ["a", "b", "c", "d"]:
+        zipping.log(name)
+    zipping.summary()
+
+    assert [rec.getMessage() for rec in caplog.records if rec.levelname == "INFO"] == [
+        "Zipping a",
+        "Zipping b",
+        "... and 2 more like 'Zipping %s' (logged at DEBUG level)",
+    ]
+
+
+def test_flush_logging_from_many_threads():
+
+    errors = []
+
+    def flush():
+        try:
+            for _ in range(20):
+                log.info("flushing")
+                flush_logging()
+        except Exception as exc:
+            errors.append(exc)
+
+    start_queued_logging()
+    try:
+        threads = [threading.Thread(target=flush) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=30)
+        assert not any(thread.is_alive() for thread in threads)
+    finally:
+        stop_queued_logging()
+
+    assert errors == []
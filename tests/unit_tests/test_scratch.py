@@ -0,0 +1,155 @@
+import json
+import logging
+import zipfile
+
+import utils.scratch
+import utils.singularity
+from utils.scratch import (
+    SCRATCH_MIN_FREE_BYTES,
+    choose_scratch_parent,
+    estimate_scratch_bytes,
+    get_scratch_candidates,
+    place_work_on_tmpfs,
+    probe_write_speed,
+)
+from utils.singularity import FWV0, get_tmpfs_work
+
+
+def test_probe_write_speed_works(tmp_path):
+
+    speed = probe_write_speed(tmp_path, probe_bytes=1024 * 1024)
+
+    assert speed > 0
+    assert list(tmp_path.glob("*")) == []
+    assert probe_write_speed(tmp_path / "missing") == 0.0
+
+
+def test_choose_scratch_parent_picks_fastest(tmp_path, monkeypatch, caplog):
+
+    caplog.set_level(logging.DEBUG)
+
+    slow = tmp_path / "slow"
+    fast = tmp_path / "fast"
+    slow.mkdir()
+    fast.mkdir()
+    speeds = {slow: 10.0, fast: 100.0}
+    monkeypatch.setattr(utils.scratch, "probe_write_speed", lambda path: speeds[path])
+
+    chosen = choose_scratch_parent(
+        [str(slow), str(tmp_path / "missing"), str(fast)], min_free_bytes=0
+    )
+
+    assert chosen == fast
+    assert "Scratch directory will be in " + str(fast) in caplog.messages
+
+
+def test_choose_scratch_parent_needs_free_space(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+
+    chosen = choose_scratch_parent(
+        [str(tmp_path / "a"), str(tmp_path / "b")], min_free_bytes=1024 ** 6
+    )
+
+    assert chosen == tmp_path / "a"
+    assert search_caplog(caplog, "No scratch candidate has enough free space")
+
+
+def test_get_scratch_candidates_reads_config(tmp_path):
+
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"config": {"gear-scratch-dirs": "/a /b"}}))
+
+    assert get_scratch_candidates(config_file) == ["/a", "/b"]
+    assert get_scratch_candidates(tmp_path / "missing.json") is None
+
+
+def test_get_scratch_candidates_expands_variables(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("TMPDIR", "/node/tmp")
+    monkeypatch.delenv("NOT_SET", raising=False)
+    config_file = tmp_path / "config.json"
+    config_file.write_text(
+        json.dumps({"config": {"gear-scratch-dirs": "$TMPDIR $NOT_SET/x /b"}})
+    )
+
+    assert get_scratch_candidates(config_file) == ["/node/tmp", "/b"]
+
+
+def test_estimate_scratch_bytes_from_bids_archive(tmp_path):
+
+    config_file = tmp_path / "config.json"
+    input_dir = tmp_path / "input/bids_archive"
+    input_dir.mkdir(parents=True)
+    with zipfile.ZipFile(input_dir / "bids.zip", "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("dataset_description.json", b"\0" * 2 ** 20)
+
+    config_file.write_text(json.dumps({"config": {}}))
+    assert estimate_scratch_bytes(config_file, input_dir) == SCRATCH_MIN_FREE_BYTES
+
+    config_file.write_text(json.dumps({"config": {"gear-disk-budget-factor": 2000}}))
+    # the BIDS data, 2000 times that for the app and part of that for archives
+    assert estimate_scratch_bytes(config_file, input_dir) > 2001 * 2 ** 20
+    assert estimate_scratch_bytes(config_file, tmp_path / "no_input") == (
+        SCRATCH_MIN_FREE_BYTES
+    )
+
+
+def test_place_work_on_tmpfs_needs_headroom(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+
+    work_dir = tmp_path / "work"
+    (work_dir / "bids").mkdir(parents=True)
+
+    tmpfs_work = place_work_on_tmpfs(work_dir, 0, 1024 ** 6)
+
+    assert tmpfs_work is None
+    assert not work_dir.is_symlink()
+    assert search_caplog(caplog, "Not putting work/ on tmpfs")
+
+
+def test_place_work_on_tmpfs_works(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(utils.scratch, "TMPFS", str(tmp_path / "shm"))
+    (tmp_path / "shm").mkdir()
+    work_dir = tmp_path / "work"
+    (work_dir / "bids").mkdir(parents=True)
+    (work_dir / "bids/dataset_description.json").touch()
+
+    tmpfs_work = place_work_on_tmpfs(work_dir, 0, 1024)
+
+    assert work_dir.is_symlink()
+    assert work_dir.resolve() == tmpfs_work.resolve()
+    assert (work_dir / "bids/dataset_description.json").exists()
+
+
+def test_place_work_on_tmpfs_needs_estimate(tmp_path, monkeypatch, caplog):
+
+    monkeypatch.setattr(utils.scratch, "TMPFS", str(tmp_path / "shm"))
+    (tmp_path / "shm").mkdir()
+    work_dir = tmp_path / "work"
+    (work_dir / "bids").mkdir(parents=True)
+
+    assert place_work_on_tmpfs(work_dir, 0, None) is None
+    assert not work_dir.is_symlink()
+    assert "no estimate" in caplog.text
+
+
+def test_get_tmpfs_work_only_finds_this_runs_work(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(utils.singularity, "TMPFS", str(tmp_path / "shm"))
+    tmpfs_work = tmp_path / "shm/gear-work-abc"
+    tmpfs_work.mkdir(parents=True)
+    (tmp_path / "shm/gear-work-other-job").mkdir()
+    fwv0 = tmp_path / "gear-temp-dir-a" / FWV0.lstrip("/")
+    fwv0.mkdir(parents=True)
+
+    assert get_tmpfs_work(tmp_path / "gear-temp-dir-a") is None
+
+    (fwv0 / "work").symlink_to(tmpfs_work)
+
+    assert get_tmpfs_work(tmp_path / "gear-temp-dir-a") == tmpfs_work
@@ -1,6 +1,10 @@
 import logging
 
-from utils.fly.set_performance_config import set_mem_gb, set_n_cpus
+from utils.fly.set_performance_config import (
+    set_mem_gb,
+    set_n_cpus,
+    set_thread_environment,
+)
 
 
 def test_set_performance_config_0_is_max(caplog, print_caplog, search_caplog_contains):
@@ -57,3 +61,30 @@ def test_set_performance_config_1_is_1(caplog, search_caplog, print_caplog):
     assert n_cpus == 1
     assert mem_gb == 1
     assert search_caplog(caplog, "from config")
+
+
+def test_set_thread_environment_overrides(caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+
+    environ = {"OMP_NUM_THREADS": "16", "PATH": "/bin"}
+    set_thread_environment(environ, 4, "fmriprep", replace=True)
+
+    assert environ["OMP_NUM_THREADS"] == "1"
+    assert environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] == "4"
+    assert environ["PATH"] == "/bin"
+    assert search_caplog(caplog, "fmriprep overrides OMP_NUM_THREADS")
+
+
+def test_set_thread_environment_keeps_existing_values(caplog, search_caplog):
+
+    caplog.set_level(logging.INFO)
+
+    environ = {"OMP_NUM_THREADS": "16", "MKL_NUM_THREADS": "1"}
+    set_thread_environment(environ, 4, "fmriprep")
+
+    assert environ["OMP_NUM_THREADS"] == "16"
+    assert environ["MKL_NUM_THREADS"] == "1"
+    assert environ["OPENBLAS_NUM_THREADS"] == "1"
+    assert environ["MRTRIX_NTHREADS"] == "4"
+    assert search_caplog(caplog, "Kept the values already set for OMP_NUM_THREADS")
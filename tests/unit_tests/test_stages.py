@@ -0,0 +1,72 @@
+import logging
+import threading
+
+import pytest
+
+from utils.stages import run_stages, stage_times, timed_stage
+
+
+def test_run_stages_runs_in_parallel_and_in_order():
+
+    errors = []
+    started = threading.Barrier(2, timeout=5)
+
+    def first():
+        started.wait()  # only returns if "second" is running at the same time
+        return 1
+
+    def second():
+        started.wait()
+        return 2
+
+    results = {}
+    stages = {
+        "first": (first, []),
+        "second": (second, []),
+        "sum": (lambda: results["first"] + results["second"], ["first", "second"]),
+    }
+
+    run_stages(stages, errors, results=results)
+
+    assert results == {"first": 1, "second": 2, "sum": 3}
+    assert errors == []
+    assert "sum" in stage_times
+
+
+def test_run_stages_skips_stages_after_failure(caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+    errors = []
+
+    def broken():
+        raise FileNotFoundError("no license")
+
+    stages = {
+        "broken": (broken, []),
+        "needs_broken": (lambda: "not run", ["broken"]),
+        "independent": (lambda: "ok", []),
+    }
+
+    results = run_stages(stages, errors)
+
+    assert results == {"independent": "ok"}
+    assert isinstance(errors[0], FileNotFoundError)
+    assert "needs_broken was skipped" in errors[1]
+    assert search_caplog(caplog, "Stage broken failed")
+
+
+def test_run_stages_rejects_bad_dependencies():
+
+    with pytest.raises(ValueError, match="unknown"):
+        run_stages({"a": (lambda: 1, ["b"])}, [])
+
+    with pytest.raises(ValueError, match="depend on each other"):
+        run_stages({"a": (lambda: 1, ["b"]), "b": (lambda: 2, ["a"])}, [])
+
+
+def test_timed_stage_records_time():
+
+    with timed_stage("nap"):
+        pass
+
+    assert stage_times["nap"] >= 0.0
@@ -0,0 +1,119 @@
+import subprocess as sp
+import sys
+import time
+
+import pytest
+
+from utils.fly import metrics, supervisor
+from utils.fly.supervisor import exec_supervised, get_memory_limits, terminate_tree
+
+
+def hog(mib, seconds):
+    """Return a command that holds on to mib MiB for a while."""
+
+    code = f"import time; x = bytearray({mib} * 2**20); time.sleep({seconds})"
+    return [sys.executable, "-c", f"'{code}'"]
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(supervisor, "POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(supervisor, "TERM_GRACE", 2)
+    monkeypatch.setattr(metrics, "metrics", {})
+
+
+def test_exec_supervised_ok(capsys, caplog, search_caplog):
+
+    caplog.set_level("INFO")
+    exec_supervised(["echo", "hello"], shell=True)
+
+    assert "hello" in capsys.readouterr().out
+    assert search_caplog(caplog, "Command return code: 0")
+    assert "gear_app_peak_tree_pss_bytes" in metrics.metrics
+
+
+def test_exec_supervised_fails():
+
+    with pytest.raises(RuntimeError, match="has failed"):
+        exec_supervised(["exit 3"], shell=True)
+
+
+def test_exec_supervised_soft_limit_warns(caplog, search_caplog_contains):
+
+    exec_supervised(hog(100, 1), shell=True, soft_limit=50 * 2 ** 20)
+
+    assert search_caplog_contains(caplog, "BIDS App is using", "more than mem_gb")
+
+
+def test_exec_supervised_hard_limit_stops_tree(tmp_path, caplog, search_caplog):
+
+    snapshot_file = tmp_path / "memory_snapshot.txt"
+
+    # the shell is the parent so this also checks that children are counted
+    with pytest.raises(RuntimeError, match="too much memory"):
+        exec_supervised(
+            hog(200, 30),
+            shell=True,
+            hard_limit=100 * 2 ** 20,
+            snapshot_file=snapshot_file,
+        )
+
+    assert search_caplog(caplog, "Stopping it before")
+    assert "processes by resident memory" in snapshot_file.read_text()
+
+
+def test_exec_supervised_counts_shared_pages_once(caplog, search_caplog):
+
+    # 3 forked workers share 150 MiB, RSS would count it 4 times
+    code = (
+        "import os, time; x = bytearray(150 * 2**20); "
+        "[os.fork() or time.sleep(3) or os._exit(0) for _ in range(3)]; "
+        "time.sleep(1); [os.wait() for _ in range(3)]"
+    )
+    exec_supervised(
+        [sys.executable, "-c", f"'{code}'"], shell=True, hard_limit=400 * 2 ** 20
+    )
+
+    assert not search_caplog(caplog, "Stopping it before")
+
+
+def test_exec_supervised_undecodable_output(capsys):
+
+    exec_supervised(["printf 'bad \\377 byte\\n'"], shell=True)
+
+    assert "bad \ufffd byte" in capsys.readouterr().out
+
+
+def test_terminate_tree_after_leader_is_reaped():
+
+    import psutil
+
+    popen = sp.Popen(
+        "sleep 30 & echo $!",
+        shell=True,
+        stdout=sp.PIPE,
+        universal_newlines=True,
+        start_new_session=True,
+    )
+    child = psutil.Process(int(popen.stdout.readline()))
+    popen.wait()
+
+    terminate_tree(popen)
+
+    # the shell has exited so its child can't be waited for, only polled
+    for _ in range(50):
+        if not child.is_running() or child.status() == psutil.STATUS_ZOMBIE:
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("the rest of the process group was not stopped")
+
+
+def test_get_memory_limits():
+
+    soft, hard = get_memory_limits(2, 4)
+    assert soft == 2 * 1024 ** 3
+    assert hard == 4 * 1024 ** 3
+
+    soft, hard = get_memory_limits(8, 4)
+    assert soft is None
@@ -0,0 +1,98 @@
+import json
+import tarfile
+
+import pytest
+
+zstandard = pytest.importorskip("zstandard")
+
+from utils.results import tar_zst
+from utils.results.tar_zst import extract_member, write_tar_zst
+from utils.results.zip_intermediate import zip_intermediate_selected
+from utils.results.zip_output import list_archive_entries
+
+
+def test_write_tar_zst_and_extract_one_member(tmp_path):
+
+    (tmp_path / "work/one").mkdir(parents=True)
+    (tmp_path / "work/one/hey").write_bytes(b"hey" * 1000)
+    (tmp_path / "work/two").write_bytes(b"two")
+    (tmp_path / "work/link").symlink_to("two")
+    archive = str(tmp_path / "work.tar.zst")
+
+    entries, _, _ = list_archive_entries(str(tmp_path), "work")
+    index_filename = write_tar_zst(archive, entries, threads=2)
+
+    members = json.load(open(index_filename))["members"]
+    assert {m["name"]: m["type"] for m in members} == {
+        "work/one/": "dir",
+        "work/one/hey": "file",
+        "work/two": "file",
+        "work/link": "link",
+    }
+
+    # the whole archive is a normal .tar.zst
+    with open(archive, "rb") as fp:
+        reader = zstandard.ZstdDecompressor().stream_reader(fp)
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            names = sorted(tar.getnames())
+    assert names == ["work/link", "work/one", "work/one/hey", "work/two"]
+
+    extract_member(archive, "work/one/hey", tmp_path / "extracted")
+    assert (tmp_path / "extracted/work/one/hey").read_bytes() == b"hey" * 1000
+    assert not (tmp_path / "extracted/work/two").exists()
+
+    # small members share one frame
+    assert len({(m["offset"], m["length"]) for m in members}) == 1
+
+
+def test_write_tar_zst_in_frames(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(tar_zst, "FRAME_BYTES", 4096)
+    (tmp_path / "work").mkdir()
+    for i in range(10):
+        (tmp_path / f"work/{i}.txt").write_bytes(str(i).encode() * (1000 + i))
+    archive = str(tmp_path / "work.tar.zst")
+
+    entries, _, _ = list_archive_entries(str(tmp_path), "work")
+    index_filename = write_tar_zst(archive, entries, threads=2)
+
+    members = json.load(open(index_filename))["members"]
+    assert 1 < len({m["offset"] for m in members}) < len(members)
+
+    for i in range(10):
+        extract_member(archive, f"work/{i}.txt", tmp_path / "extracted")
+        extracted = tmp_path / f"extracted/work/{i}.txt"
+        assert extracted.read_bytes() == str(i).encode() * (1000 + i)
+    assert len(list((tmp_path / "extracted/work").iterdir())) == 10
+
+
+def test_extract_member_refuses_link_out_of_dest_dir(tmp_path):
+
+    (tmp_path / "work").mkdir()
+    (tmp_path / "work/passwd").symlink_to("/etc/passwd")
+    archive = str(tmp_path / "work.tar.zst")
+
+    entries, _, _ = list_archive_entries(str(tmp_path), "work")
+    write_tar_zst(archive, entries)
+
+    with pytest.raises(tarfile.FilterError):
+        extract_member(archive, "work/passwd", tmp_path / "extracted")
+    assert not (tmp_path / "extracted/work/passwd").exists()
+
+
+def test_zip_intermediate_selected_tar_zst(tmp_path):
+
+    work_dir = tmp_path / "work"
+    (work_dir / "sub").mkdir(parents=True)
+    (work_dir / "sub/keep.txt").write_text("keep")
+    (work_dir / "sub/other.txt").write_text("other")
+
+    zip_intermediate_selected(
+        "keep.txt", "", "dest", "gear", tmp_path, work_dir, "label", True, "tar.zst"
+    )
+
+    archive = tmp_path / "gear_work_selected_label_dest.tar.zst"
+    members = json.load(open(str(archive) + ".index.json"))["members"]
+    assert [m["name"] for m in members] == ["work/sub/keep.txt"]
+    assert not (work_dir / "sub/keep.txt").exists()
+    assert (work_dir / "sub/other.txt").exists()
@@ -1,11 +1,15 @@
+import hashlib
 import json
 import logging
+import shutil
 from pathlib import Path
 
 import pytest
-from flywheel_gear_toolkit.utils.zip_tools import unzip_archive
+from flywheel_gear_toolkit.utils.zip_tools import unzip_archive, zip_info
 
+from utils.results.zip_htmls import zip_htmls
 from utils.results.zip_intermediate import zip_intermediate_selected, zip_selected
+from utils.results.zip_output import write_manifest, zip_output
 
 
 @pytest.fixture
@@ -56,3 +60,133 @@ def test_zip_selected_works(create_test_files, caplog, search_caplog):
     assert search_caplog(caplog, "Zipping test/two/hee")
     assert search_caplog(caplog, "Looked for missing_file but")
     assert search_caplog(caplog, "Looked for missing_dir but")
+
+
+def test_zip_selected_delete_source_works(create_test_files):
+
+    work_dir = create_test_files
+    work_path = work_dir.parents[0]
+    dest_zip = work_path / "destination_zip.zip"
+
+    zip_selected(work_path, work_dir.name, dest_zip, ["two/hee"], ["one/three"], True)
+
+    assert zip_info(dest_zip) == ["test/one/three/now", "test/two/hee"]
+    assert not (work_dir / "two/hee").exists()
+    assert not (work_dir / "one/three/now").exists()
+    assert (work_dir / "one/hey").exists()
+
+
+def test_zip_output_delete_source_works(create_test_files):
+
+    work_dir = create_test_files
+    work_path = work_dir.parents[0]
+    (work_dir / "link").symlink_to(work_dir / "one/hey")
+    (work_dir / "empty").mkdir()
+
+    zip_output(str(work_path), work_dir.name, "output.zip", delete_source=True)
+
+    unzip_dir = work_path / "unzip"
+    unzip_archive(work_path / "output.zip", unzip_dir)
+
+    assert not work_dir.exists()
+    assert (unzip_dir / "test/four/not_included").exists()
+    assert (unzip_dir / "test/link").exists()
+    assert (unzip_dir / "test/empty").is_dir()
+    assert not (work_path / "output.zip.part").exists()
+
+
+def test_zip_output_delete_source_refuses_existing_archive(create_test_files):
+
+    work_dir = create_test_files
+    work_path = work_dir.parents[0]
+    # an earlier run finished the archive and may have deleted some of its files
+    (work_path / "output.zip").write_bytes(b"complete archive")
+
+    with pytest.raises(FileExistsError, match="already exists"):
+        zip_output(str(work_path), work_dir.name, "output.zip", delete_source=True)
+
+    assert (work_path / "output.zip").read_bytes() == b"complete archive"
+    assert (work_dir / "one/hey").exists()
+
+
+def test_zip_output_keeps_source_and_excluded_files(create_test_files):
+
+    work_dir = create_test_files
+    work_path = work_dir.parents[0]
+
+    zip_output(
+        str(work_path),
+        work_dir.name,
+        str(work_path / "output.zip"),
+        exclude_files=["test/four/not_included"],
+    )
+
+    assert "test/four/not_included" not in zip_info(work_path / "output.zip")
+    assert "test/four/hey" in zip_info(work_path / "output.zip")
+    assert (work_dir / "four/hey").exists()
+
+
+def test_zip_htmls_does_not_change_directory(tmp_path):
+
+    analysis_dir = tmp_path / "dest"
+    analysis_dir.mkdir()
+    (analysis_dir / "index.html").write_text("index")
+    (analysis_dir / "report.html").write_text("report")
+    cwd = Path.cwd()
+
+    zip_htmls(str(tmp_path), "dest", analysis_dir)
+
+    assert Path.cwd() == cwd
+    assert zip_info(tmp_path / "index_dest.html.zip") == ["index.html"]
+    assert zip_info(tmp_path / "report_dest.html.zip") == ["index.html"]
+    assert (analysis_dir / "index.html").read_text() == "index"
+
+
+def test_zip_output_exclusions(tmp_path, caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+
+    source = tmp_path / "dest"
+    (source / "freesurfer/fsaverage/surf").mkdir(parents=True)
+    (source / "freesurfer/fsaverage/surf/lh.white").write_bytes(b"x" * 100)
+    (source / "freesurfer/sub-01").mkdir()
+    (source / "freesurfer/sub-01/big.mgz").write_bytes(b"x" * 50)
+    (source / "freesurfer/sub-01/small.txt").write_bytes(b"x")
+    (tmp_path / "fsaverage5").mkdir()
+    (source / "freesurfer/fsaverage5").symlink_to(tmp_path / "fsaverage5")
+
+    skipped_bytes = zip_output(
+        str(tmp_path),
+        "dest",
+        "out.zip",
+        delete_source=True,
+        exclude_patterns=["freesurfer/fsaverage*"],
+        exclude_larger_than=10,
+    )
+
+    assert zip_info(tmp_path / "out.zip") == ["dest/freesurfer/sub-01/small.txt"]
+    assert skipped_bytes == 150
+    assert search_caplog(caplog, "Excluded 3 files or directories (150.00 B)")
+    # excluded files are not deleted
+    assert (source / "freesurfer/fsaverage/surf/lh.white").exists()
+    assert (source / "freesurfer/sub-01/big.mgz").exists()
+    assert not (source / "freesurfer/sub-01/small.txt").exists()
+
+
+def test_zip_output_manifest_hashes_members(tmp_path):
+
+    (tmp_path / "dest/sub").mkdir(parents=True)
+    (tmp_path / "dest/sub/data.txt").write_bytes(b"data" * 1000)
+    manifest = {}
+
+    zip_output(str(tmp_path), "dest", "out.zip", manifest=manifest, sha256=True)
+    write_manifest(tmp_path, manifest, sha256=True)
+
+    member = manifest["out.zip"][0]
+    assert member["path"] == "dest/sub/data.txt"
+    assert member["size"] == 4000
+    assert member["ratio"] < 1.0
+    assert member["blake2b"] == hashlib.blake2b(b"data" * 1000).hexdigest()
+    assert member["sha256"] == hashlib.sha256(b"data" * 1000).hexdigest()
+    assert json.loads((tmp_path / "manifest.json").read_text())["archives"] == manifest
+    assert zip_info(tmp_path / "out.zip") == ["dest/sub/data.txt"]
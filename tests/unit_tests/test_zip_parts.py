@@ -0,0 +1,74 @@
+import pytest
+from flywheel_gear_toolkit.utils.zip_tools import zip_info
+
+from utils.results.zip_parts import get_group, plan_parts, zip_output_parts
+
+
+def test_get_group():
+
+    assert get_group("dest/sub-01/anat/x.nii.gz") == "sub-01"
+    assert get_group("dest/freesurfer/sub-02/mri/T1.mgz") == "sub-02"
+    assert get_group("dest/dataset_description.json") == "common"
+
+
+def test_plan_parts_keeps_subjects_together():
+
+    entries = [
+        ("", "d/sub-01/a", 60),
+        ("", "d/sub-01/b", 60),
+        ("", "d/sub-02/a", 30),
+        ("", "d/sub-03/a", 30),
+        ("", "d/sub-03/", None),
+    ]
+
+    parts = plan_parts(entries, 100)
+
+    assert [part["groups"] for part in parts] == [["sub-01"], ["sub-02", "sub-03"]]
+    assert len(plan_parts(entries, 0)) == 1
+
+
+def test_zip_output_parts_works(tmp_path):
+
+    for subject in ["sub-01", "sub-02"]:
+        (tmp_path / "dest" / subject).mkdir(parents=True)
+        (tmp_path / "dest" / subject / "small.txt").write_bytes(b"x" * 100)
+    (tmp_path / "dest/sub-02/huge.nii").write_bytes(b"x" * 1000)
+    (tmp_path / "dest/dataset_description.json").write_text("{}")
+
+    index = zip_output_parts(
+        str(tmp_path),
+        "dest",
+        "gear_label_dest.zip",
+        max_part_bytes=150,
+        pass_through_larger_than=500,
+        delete_source=True,
+    )
+
+    assert index == {
+        "parts": {
+            "gear_label_dest_part-01.zip": ["common", "sub-01"],
+            "gear_label_dest_part-02.zip": ["sub-02"],
+        },
+        "passed_through": {"dest_sub-02_huge.nii": "dest/sub-02/huge.nii"},
+    }
+    assert zip_info(tmp_path / "gear_label_dest_part-02.zip") == [
+        "dest/sub-02/small.txt"
+    ]
+    assert (tmp_path / "dest_sub-02_huge.nii").stat().st_size == 1000
+    assert not (tmp_path / "dest").exists()
+
+
+def test_zip_output_parts_delete_source_refuses_existing_part(tmp_path):
+
+    (tmp_path / "dest/sub-02").mkdir(parents=True)
+    (tmp_path / "dest/sub-02/small.txt").write_bytes(b"x" * 100)
+    # sub-01 was archived and deleted by an interrupted run
+    (tmp_path / "gear_label_dest_part-01.zip").write_bytes(b"sub-01")
+
+    with pytest.raises(FileExistsError, match="gear_label_dest_part-01.zip"):
+        zip_output_parts(
+            str(tmp_path), "dest", "gear_label_dest.zip", delete_source=True
+        )
+
+    assert not (tmp_path / "gear_label_dest.zip").exists()
+    assert (tmp_path / "dest/sub-02/small.txt").exists()
@@ -0,0 +1,257 @@
+"""Run the gear for many destinations in one container invocation.
+
+Each job pays for starting the container, importing the Flywheel SDK and
+setting up its scratch directory even for tiny sessions.  run_batch.py reads a
+list of destination (analysis) IDs and runs run.main() for each one, several
+at a time.  Pipelines are forked from a process that has already done the
+imports so they start right away, and each gets its own process so its working
+directory and module-level state (stage times, metrics, ...) are its own.  Each
+pipeline gets a copy of the gear toolkit context with its own destination,
+directories and SDK client: a client created before the fork would share its
+connection pool (sockets and locks) with every child.
+
+Each pipeline runs in <scratch>/batch/<destination id>/ which links to the
+same gear files, has its own work/ and writes its results to
+output/<destination id>/.  The number of pipelines that run at the same time
+is limited by the CPUs and memory each one is given.
+"""
+
+import copy
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+from pathlib import Path
+
+from .fly.queued_logging import start_queued_logging, stop_queued_logging
+
+log = logging.getLogger(__name__)
+
+BATCH_DIR = "batch"
+
+# not linked into the pipeline directories, each pipeline has its own
+PIPELINE_OWN = {"work", "output", "freesurfer", BATCH_DIR}
+
+
+def read_destination_ids(file_name):
+    """Read destination IDs, one per line.  Blank lines and # comments are skipped.
+
+    Args:
+        file_name (str) path of the file
+
+    Returns:
+        destination_ids (list of str) without duplicates, in order
+    """
+
+    destination_ids = []
+    with open(file_name) as fp:
+        for line in fp:
+            destination_id = line.split("#")[0].strip()
+            if destination_id and destination_id not in destination_ids:
+                destination_ids.append(destination_id)
+    return destination_ids
+
+
+def plan_batch(num_destinations, n_cpus=0, mem_gb=0, max_parallel=0):
+    """Decide how many pipelines to run at the same time and what each gets.
+
+    Args:
+        num_destinations (int) number of pipelines to run
+        n_cpus (int) CPUs for each pipeline, 0 to share all of them
+        mem_gb (float) GiB of memory for each pipeline, 0 to share all of it
+        max_parallel (int) most pipelines to run at the same time, 0 for no limit
+
+    Returns:
+        tuple: (parallel, n_cpus, mem_gb) for each pipeline
+    """
+
+    import psutil
+
+    cpu_count = os.cpu_count()
+    available_gb = psutil.virtual_memory().available / 1024 ** 3
+    wanted = min(num_destinations, max_parallel or cpu_count)
+    wanted = max(1, wanted)
+
+    n_cpus = min(n_cpus or max(1, cpu_count // wanted), cpu_count)
+    mem_gb = mem_gb or max(1, int(available_gb / wanted))
+
+    parallel = min(wanted, cpu_count // n_cpus, int(available_gb // mem_gb))
+    parallel = max(1, parallel)
+
+    log.info(
+        "Running %d destinations, %d at a time, each with %d CPUs and %s GiB",
+        num_destinations,
+        parallel,
+        n_cpus,
+        mem_gb,
+    )
+
+    return parallel, n_cpus, mem_gb
+
+
+def make_pipeline_context(gtk_context, destination_id, pipeline_dir, config):
+    """Return a copy of the batch's gear toolkit context for one destination.
+
+    The copy's methods (e.g. download_project_bids()) use the pipeline's
+    destination, work and output directories and its own SDK client, which is
+    made on first use.  A client created before the fork would share its
+    connection pool with every child.
+
+    Args:
+        gtk_context (GearToolkitContext) context of the batch job
+        destination_id (str) ID of the analysis to run for
+        pipeline_dir (Path) directory the pipeline runs in
+        config (dict) config.json options for this pipeline
+
+    Returns:
+        context (GearToolkitContext)
+    """
+
+    context = copy.copy(gtk_context)
+    context.config_json = dict(
+        gtk_context.config_json,
+        config=config,
+        destination={"id": destination_id, "type": "analysis"},
+    )
+    context._path = Path(pipeline_dir)
+    context._work_dir = Path(pipeline_dir) / "work"
+    context._out_dir = Path(pipeline_dir) / "output"
+    context._client = None
+    context._metadata = {}
+
+    return context
+
+
+def prefix_log_records(prefix):
+    """Put prefix in front of every log message from now on."""
+
+    make_record = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs):
+        record = make_record(*args, **kwargs)
+        record.msg = f"[{prefix}] {record.msg}"
+        return record
+
+    logging.setLogRecordFactory(record_factory)
+
+
+def set_up_pipeline_dir(batch_root, fwv0, output_dir, destination_id):
+    """Make the directory that the pipeline for destination_id runs in.
+
+    Args:
+        batch_root (Path) where pipeline directories go
+        fwv0 (Path) the batch's gear directory, its files are linked
+        output_dir (Path) the batch's output directory
+        destination_id (str) ID of the analysis
+
+    Returns:
+        pipeline_dir (Path)
+    """
+
+    pipeline_dir = Path(batch_root) / destination_id
+    pipeline_dir.mkdir(parents=True, exist_ok=True)
+    for entry in Path(fwv0).iterdir():
+        link = pipeline_dir / entry.name
+        if entry.name not in PIPELINE_OWN and not os.path.lexists(link):
+            link.symlink_to(entry.resolve())
+
+    destination_output = Path(output_dir) / destination_id
+    destination_output.mkdir(parents=True, exist_ok=True)
+    if not os.path.lexists(pipeline_dir / "output"):
+        (pipeline_dir / "output").symlink_to(destination_output.resolve())
+    (pipeline_dir / "work").mkdir(exist_ok=True)
+
+    return pipeline_dir
+
+
+def run_pipeline(main, gtk_context, destination_id, pipeline_dir, config):
+    """Run main() for one destination, this is the forked process."""
+
+    prefix_log_records(destination_id)
+    start_queued_logging()
+
+    os.chdir(pipeline_dir)
+    try:
+        context = make_pipeline_context(
+            gtk_context, destination_id, pipeline_dir, config
+        )
+        return_code = main(context)
+    except Exception:  # report it and let the other pipelines go on
+        log.exception("Pipeline for %s failed", destination_id)
+        return_code = 1
+
+    stop_queued_logging()
+    os._exit(return_code)  # skip atexit handlers inherited from the batch
+
+
+def run_batch(gtk_context, destination_ids, main, max_parallel=0):
+    """Run main() for each destination, several at a time in forked processes.
+
+    Args:
+        gtk_context (GearToolkitContext) context of the batch job
+        destination_ids (list of str) IDs of the analyses to run for
+        main (function) run.main
+        max_parallel (int) most pipelines to run at the same time, 0 for no limit
+
+    Returns:
+        return_codes (dict) destination ID: return code of its pipeline
+    """
+
+    fwv0 = Path.cwd()
+    batch_root = fwv0 / BATCH_DIR
+    parallel, n_cpus, mem_gb = plan_batch(
+        len(destination_ids),
+        gtk_context.config.get("n_cpus"),
+        gtk_context.config.get("mem_gb"),
+        max_parallel,
+    )
+    config = dict(gtk_context.config, n_cpus=n_cpus, mem_gb=mem_gb)
+
+    fork = multiprocessing.get_context("fork")
+    waiting = list(destination_ids)
+    running = {}
+    return_codes = {}
+    start = time.perf_counter()
+
+    while waiting or running:
+        while waiting and len(running) < parallel:
+            destination_id = waiting.pop(0)
+            pipeline_dir = set_up_pipeline_dir(
+                batch_root, fwv0, gtk_context.output_dir, destination_id
+            )
+            process = fork.Process(
+                target=run_pipeline,
+                args=(main, gtk_context, destination_id, pipeline_dir, config),
+                name=destination_id,
+            )
+            process.start()
+            running[destination_id] = process
+            log.info("Started pipeline for %s", destination_id)
+
+        # wait for any of the running pipelines to finish
+        multiprocessing.connection.wait([p.sentinel for p in running.values()])
+        for destination_id, process in list(running.items()):
+            if not process.is_alive():
+                process.join()
+                return_codes[destination_id] = process.exitcode
+                del running[destination_id]
+                log.info(
+                    "Pipeline for %s returned %s (%d of %d done)",
+                    destination_id,
+                    process.exitcode,
+                    len(return_codes),
+                    len(destination_ids),
+                )
+
+    log.info(
+        "Batch of %d destinations finished in %.1f seconds, %d failed",
+        len(destination_ids),
+        time.perf_counter() - start,
+        sum(1 for code in return_codes.values() if code != 0),
+    )
+    with open(Path(gtk_context.output_dir) / "batch_results.json", "w") as fp:
+        json.dump(return_codes, fp, indent=2)
+
+    return return_codes
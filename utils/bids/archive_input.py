@@ -0,0 +1,321 @@
+"""Extract a BIDS dataset from a zip or tar archive given as an input file.
+
+Data from outside of Flywheel can be attached to the job as the "bids_archive"
+input instead of being exported from Flywheel.  It is extracted to work/bids
+and then validated and shown in the tree like downloaded data.
+
+Members are streamed to disk (never read into memory whole).  Zip members are
+decompressed in parallel, each thread with its own handle on the archive.  Tar
+archives (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz and .tar.zst) are one
+compressed stream so they are read in order.
+
+Archives are not trusted:
+
+  * members with absolute paths or ".." and links are not extracted
+  * extraction stops if the contents are bigger than max_bytes (by default the
+    free disk space) or if a zip member is compressed more than max_ratio
+    times (a zip bomb, MAX_RATIO by default)
+
+Files matching the exclude patterns (see download_filter.py) are skipped.
+
+If the dataset is inside a directory in the archive (the directory holding
+dataset_description.json), that directory becomes work/bids.
+"""
+
+import contextlib
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+
+from ..fly.disk_budget import format_bytes, get_free_bytes
+from .download_filter import SkippedFiles, make_matcher
+
+log = logging.getLogger(__name__)
+
+BIDS_ARCHIVE_INPUT = "input/bids_archive"
+
+# Larger compression ratios are treated as a zip bomb.  Masks and label volumes
+# can deflate ~1000 times so this is above that, max_bytes still applies.
+MAX_RATIO = 2000
+MAX_MEMBERS = 1000000
+
+COPY_BUFSIZE = 1024 * 1024
+
+
+class UnsafeArchiveError(ValueError):
+    """The archive is too big, too compressed or has unsafe members."""
+
+
+def find_bids_archive(input_dir=BIDS_ARCHIVE_INPUT):
+    """Return the path to the bids_archive input file or None if not given."""
+
+    archives = list(Path(input_dir).glob("*"))
+    return archives[0] if archives else None
+
+
+def get_archive_size(archive):
+    """Return the size of the contents of a zip archive, the size of others.
+
+    Tar archives would have to be read to the end to find out so the size of
+    the archive itself is returned, which is the least the contents take.
+    """
+
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            return sum(info.file_size for info in zf.infolist())
+    return os.path.getsize(archive)
+
+
+def safe_name(name):
+    """Return name as a relative PurePosixPath or None if it is not safe."""
+
+    path = PurePosixPath(name)
+    if path.is_absolute() or ".." in path.parts or name.startswith("\\"):
+        return None
+    return path
+
+
+def find_bids_root(names):
+    """Return the directory in the archive that holds dataset_description.json.
+
+    Args:
+        names (list of str) member names
+
+    Returns:
+        root (PurePosixPath) "." if it is at the top or no description is found
+    """
+
+    roots = [
+        PurePosixPath(name).parent
+        for name in names
+        if PurePosixPath(name).name == "dataset_description.json"
+    ]
+    if not roots:
+        log.warning("No dataset_description.json in the BIDS archive")
+        return PurePosixPath(".")
+    return min(roots, key=lambda root: len(root.parts))
+
+
+def relative_to_root(name, root):
+    """Return where member name goes in bids_dir or None if it is outside root."""
+
+    path = safe_name(name)
+    if path is None:
+        log.warning("Not extracting unsafe member %s", name)
+        return None
+    if root == PurePosixPath("."):
+        return path
+    try:
+        return path.relative_to(root)
+    except ValueError:
+        return None
+
+
+class ByteBudget:
+    """Count bytes written by several threads and stop at max_bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def add(self, num_bytes):
+        with self._lock:
+            self.total += num_bytes
+            if self.total > self.max_bytes:
+                raise UnsafeArchiveError(
+                    "BIDS archive contents are bigger than "
+                    + format_bytes(self.max_bytes)
+                )
+
+
+def copy_limited(fin, dest, budget):
+    """Stream fin to dest, counting bytes against budget."""
+
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    with open(dest, "wb") as fout:
+        while True:
+            chunk = fin.read(COPY_BUFSIZE)
+            if not chunk:
+                break
+            budget.add(len(chunk))
+            fout.write(chunk)
+
+
+def extract_zip(archive, bids_dir, budget, max_workers, is_ignored, max_ratio):
+    """Extract a zip archive, members in parallel."""
+
+    with zipfile.ZipFile(archive) as zf:
+        infos = zf.infolist()
+    if len(infos) > MAX_MEMBERS:
+        raise UnsafeArchiveError(f"BIDS archive has more than {MAX_MEMBERS} members")
+
+    root = find_bids_root([info.filename for info in infos])
+    jobs = []
+    for info in infos:
+        if info.is_dir():
+            continue
+        if (info.external_attr >> 16) & 0o170000 == 0o120000:  # symbolic link
+            log.warning("Not extracting link %s", info.filename)
+            continue
+        relative = relative_to_root(info.filename, root)
+        if relative is None or is_ignored(relative, info.file_size):
+            continue
+        ratio = info.file_size / info.compress_size if info.compress_size else 0
+        if max_ratio and ratio > max_ratio:
+            raise UnsafeArchiveError(
+                f"{info.filename} is compressed {info.file_size // info.compress_size}"
+                " times, which looks like a zip bomb"
+            )
+        jobs.append((info, Path(bids_dir) / relative))
+
+    # each worker opens the archive once and takes the next member until none
+    # are left, the sizes in the archive can lie so bytes are counted as they
+    # are written
+    todo = iter(jobs)
+    lock = threading.Lock()
+
+    def extract_members():
+        with zipfile.ZipFile(archive) as zf:
+            while True:
+                with lock:
+                    job = next(todo, None)
+                if job is None:
+                    return
+                info, dest = job
+                with zf.open(info) as fin:
+                    copy_limited(fin, dest, budget)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        workers = range(min(max_workers, len(jobs)))
+        futures = [executor.submit(extract_members) for _ in workers]
+        for future in futures:
+            future.result()  # raise any exception
+
+    return len(jobs)
+
+
+def open_tar_stream(archive):
+    """Open a tar archive for reading as a stream, .tar.zst included."""
+
+    if str(archive).endswith((".tar.zst", ".tzst")):
+        import zstandard
+
+        fp = open(archive, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(fp, closefd=True)
+        return tarfile.open(fileobj=reader, mode="r|")
+
+    return tarfile.open(archive, mode="r|*")
+
+
+@contextlib.contextmanager
+def zstd_errors_as_tar_errors(archive):
+    """Raise a corrupt .tar.zst's errors as tarfile.ReadError like other tars."""
+
+    if not str(archive).endswith((".tar.zst", ".tzst")):
+        yield
+        return
+
+    import zstandard
+
+    try:
+        yield
+    except zstandard.ZstdError as err:
+        raise tarfile.ReadError(f"bad zstd stream: {err}") from err
+
+
+def extract_tar(archive, bids_dir, budget, is_ignored):
+    """Extract a tar archive in one pass, in order."""
+
+    with zstd_errors_as_tar_errors(archive):
+        # the stream is read once so the BIDS root is found from the names first
+        with open_tar_stream(archive) as tar:
+            names = []
+            for member in tar:
+                names.append(member.name)
+                if len(names) > MAX_MEMBERS:
+                    raise UnsafeArchiveError(
+                        f"BIDS archive has more than {MAX_MEMBERS} members"
+                    )
+        root = find_bids_root(names)
+
+        count = 0
+        with open_tar_stream(archive) as tar:
+            for member in tar:
+                if not member.isfile():
+                    if member.issym() or member.islnk():
+                        log.warning("Not extracting link %s", member.name)
+                    continue
+                relative = relative_to_root(member.name, root)
+                if relative is None or is_ignored(relative, member.size):
+                    continue
+                dest = Path(bids_dir) / relative
+                copy_limited(tar.extractfile(member), dest, budget)
+                count += 1
+
+    return count
+
+
+def extract_bids_archive(
+    archive,
+    bids_dir,
+    max_workers=None,
+    max_bytes=None,
+    exclude=None,
+    max_ratio=MAX_RATIO,
+):
+    """Extract a BIDS archive to bids_dir.
+
+    Args:
+        archive (str) path to a zip or tar archive
+        bids_dir (str) where to put the BIDS data, e.g. work/bids
+        max_workers (int) threads decompressing zip members, default CPU count
+        max_bytes (int) most bytes to extract, default the free disk space
+        exclude (list of str) .bidsignore style patterns of files to leave out
+        max_ratio (float) most a zip member may be compressed, 0 for no limit
+
+    Returns:
+        bids_dir (Path)
+
+    Raises:
+        UnsafeArchiveError: if the archive is too big or looks like a zip bomb
+        zipfile.BadZipFile, tarfile.TarError: if the archive is corrupt
+    """
+
+    bids_dir = Path(bids_dir)
+    bids_dir.mkdir(parents=True, exist_ok=True)
+    if max_bytes is None:
+        max_bytes = get_free_bytes(bids_dir)
+    budget = ByteBudget(max_bytes)
+
+    matcher = make_matcher(exclude or [])
+    skipped = SkippedFiles()
+
+    def is_ignored(relative, size):
+        pattern = matcher(relative)
+        if pattern:
+            skipped.add(str(relative), size, pattern)
+        return pattern is not None
+
+    log.info("Extracting BIDS archive %s to %s", archive, bids_dir)
+    try:
+        if zipfile.is_zipfile(archive):
+            max_workers = max_workers or os.cpu_count()
+            count = extract_zip(
+                archive, bids_dir, budget, max_workers, is_ignored, max_ratio
+            )
+        else:
+            count = extract_tar(archive, bids_dir, budget, is_ignored)
+    except Exception:
+        shutil.rmtree(bids_dir, ignore_errors=True)  # don't use part of it
+        raise
+
+    log.info("Extracted %d files (%s)", count, format_bytes(budget.total))
+    skipped.summary()
+
+    return bids_dir
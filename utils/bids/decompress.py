@@ -0,0 +1,255 @@
+"""Decompress selected .nii.gz BIDS inputs so they are not gunzipped on every read.
+
+Some BIDS Apps open the same inputs many times and pay to decompress them each
+time.  decompress_bids() replaces matching .nii.gz files with .nii files using
+several threads (zlib releases the GIL).  BIDS allows either extension and
+sidecars are matched without the extension.  References to the files by name
+("IntendedFor" in fieldmap sidecars and the filename column of *_scans.tsv)
+are changed to the new names so the data stays valid.
+
+work/ is already on the fastest local scratch (see utils/scratch.py) so files
+are decompressed in place.
+"""
+
+import csv
+import gzip
+import json
+import logging
+import os
+import shutil
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePath, PurePosixPath
+
+from ..fly.disk_budget import check_disk_budget, format_bytes
+from ..fly.metrics import set_metric
+
+log = logging.getLogger(__name__)
+
+# editme: how many times the BIDS App is expected to read each input
+EXPECTED_READS = 3
+
+COPY_BUFSIZE = 1024 * 1024
+
+BIDS_URI = "bids::"
+
+
+def get_uncompressed_size(path):
+    """Return the size of a gzip file's contents from its trailer.
+
+    The trailer holds the size modulo 2**32 so this is only right for files
+    that are smaller than 4 GiB uncompressed, which NIfTI inputs almost always are.
+    """
+
+    with open(path, "rb") as fp:
+        fp.seek(-4, os.SEEK_END)
+        return struct.unpack("<I", fp.read(4))[0]
+
+
+def select_nifti(bids_dir, patterns):
+    """Return the .nii.gz files in bids_dir that match any pattern.
+
+    Args:
+        bids_dir (str) BIDS directory
+        patterns (list of str) glob patterns matched against the path relative
+            to bids_dir like pathlib.PurePath.match(), e.g. "*_bold.nii.gz"
+
+    Returns:
+        paths (list of Path) sorted, symbolic links are skipped
+    """
+
+    paths = []
+    for path in sorted(Path(bids_dir).rglob("*.nii.gz")):
+        if path.is_symlink():
+            continue
+        relative = PurePath(path.relative_to(bids_dir))
+        if any(relative.match(pattern) for pattern in patterns):
+            paths.append(path)
+    return paths
+
+
+def decompress_file(path):
+    """Replace path (a .nii.gz file) with its decompressed .nii file.
+
+    If it cannot be decompressed it is left as it is.
+
+    Returns:
+        seconds (float) time it took or None if it was not decompressed
+    """
+
+    start = time.perf_counter()
+    nii = path.with_suffix("")  # removes ".gz"
+    part = nii.with_name(nii.name + ".part")
+    try:
+        with gzip.open(path, "rb") as fin, open(part, "wb") as fout:
+            shutil.copyfileobj(fin, fout, COPY_BUFSIZE)
+    except (OSError, EOFError) as err:
+        log.warning("Could not decompress %s: %s", path, err)
+        part.unlink(missing_ok=True)
+        return None
+    shutil.copystat(path, part)
+    os.rename(part, nii)
+    os.remove(path)
+    return time.perf_counter() - start
+
+
+def rename_reference(reference, base, renamed):
+    """Return reference with ".gz" removed if it names a renamed file.
+
+    Args:
+        reference (str) path relative to base or a BIDS URI ("bids::<path>")
+        base (PurePosixPath) what reference is relative to, within bids_dir
+        renamed (set of str) paths relative to bids_dir that lost their ".gz"
+
+    Returns:
+        reference (str) changed or not
+    """
+
+    if reference.startswith(BIDS_URI):
+        relative = reference[len(BIDS_URI) :]
+    else:
+        relative = str(base / reference)
+    if relative in renamed:
+        return reference[: -len(".gz")]
+    return reference
+
+
+def update_intended_for(sidecar, bids_dir, renamed):
+    """Fix IntendedFor in a sidecar, return True if it was changed."""
+
+    try:
+        with open(sidecar) as fp:
+            data = json.load(fp)
+    except ValueError as err:
+        log.warning("Could not read %s: %s", sidecar, err)
+        return False
+    if not isinstance(data, dict) or "IntendedFor" not in data:
+        return False
+
+    # IntendedFor paths are relative to the subject directory
+    subject_dir = PurePosixPath(sidecar.relative_to(bids_dir).parts[0])
+    intended_for = data["IntendedFor"]
+    if isinstance(intended_for, str):
+        new = rename_reference(intended_for, subject_dir, renamed)
+    else:
+        new = [rename_reference(ref, subject_dir, renamed) for ref in intended_for]
+    if new == intended_for:
+        return False
+
+    data["IntendedFor"] = new
+    with open(sidecar, "w") as fp:
+        json.dump(data, fp, indent=4)
+    return True
+
+
+def update_scans_tsv(scans_tsv, bids_dir, renamed):
+    """Fix the filename column of a *_scans.tsv, return True if it was changed."""
+
+    with open(scans_tsv, newline="") as fp:
+        rows = list(csv.reader(fp, delimiter="\t"))
+    if not rows or "filename" not in rows[0]:
+        return False
+
+    # file names are relative to the directory the scans file is in
+    column = rows[0].index("filename")
+    base = PurePosixPath(scans_tsv.parent.relative_to(bids_dir).as_posix())
+    changed = False
+    for row in rows[1:]:
+        if len(row) > column:
+            new = rename_reference(row[column], base, renamed)
+            changed = changed or new != row[column]
+            row[column] = new
+    if not changed:
+        return False
+
+    with open(scans_tsv, "w", newline="") as fp:
+        csv.writer(fp, delimiter="\t", lineterminator="\n").writerows(rows)
+    return True
+
+
+def update_references(bids_dir, paths):
+    """Change references to paths in sidecars and scans files to their .nii names.
+
+    Args:
+        bids_dir (str) BIDS directory
+        paths (list of Path) the .nii.gz files that were decompressed
+
+    Returns:
+        updated (int) number of files that were changed
+    """
+
+    bids_dir = Path(bids_dir)
+    renamed = {path.relative_to(bids_dir).as_posix() for path in paths}
+    updated = 0
+    for subject_dir in sorted(bids_dir.glob("sub-*")):
+        for sidecar in sorted(subject_dir.rglob("*.json")):
+            updated += update_intended_for(sidecar, bids_dir, renamed)
+        for scans_tsv in sorted(subject_dir.rglob("*_scans.tsv")):
+            updated += update_scans_tsv(scans_tsv, bids_dir, renamed)
+    if updated:
+        log.info("Changed the names of decompressed files in %d files", updated)
+    return updated
+
+
+def decompress_bids(bids_dir, patterns, max_workers=1):
+    """Decompress the .nii.gz files in bids_dir that match patterns.
+
+    Nothing is done if there is not enough disk space for the result.
+
+    Args:
+        bids_dir (str) BIDS directory
+        patterns (list of str) see select_nifti()
+        max_workers (int) number of files to decompress at the same time
+
+    Returns:
+        decompressed (list of Path) the new .nii files
+    """
+
+    paths = select_nifti(bids_dir, patterns)
+    if not paths:
+        log.info("No .nii.gz files match %s", " ".join(patterns))
+        return []
+
+    compressed_bytes = sum(path.stat().st_size for path in paths)
+    uncompressed_bytes = sum(get_uncompressed_size(path) for path in paths)
+    needed = uncompressed_bytes - compressed_bytes
+    budget = check_disk_budget("decompressing NIfTI files", bids_dir, needed)
+    if budget != "ok":
+        log.warning("Not decompressing %d NIfTI files to save disk space", len(paths))
+        return []
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        seconds = list(executor.map(decompress_file, paths))
+    elapsed = time.perf_counter() - start
+    paths = [path for path, secs in zip(paths, seconds) if secs is not None]
+    update_references(bids_dir, paths)
+
+    # each later read of a .nii.gz would have taken about this long to decompress
+    saved_per_read = sum(secs for secs in seconds if secs is not None)
+    log.info(
+        "Decompressed %d files (%s to %s) in %.1f seconds with %d threads.  "
+        "Each read of all of them now saves about %.1f CPU seconds, %.1f if "
+        "they are read %d times",
+        len(paths),
+        format_bytes(compressed_bytes),
+        format_bytes(uncompressed_bytes),
+        elapsed,
+        max_workers,
+        saved_per_read,
+        saved_per_read * EXPECTED_READS,
+        EXPECTED_READS,
+    )
+    set_metric(
+        "gear_decompress_seconds",
+        elapsed,
+        "Time spent decompressing NIfTI inputs",
+    )
+    set_metric(
+        "gear_decompress_saved_seconds_per_read",
+        saved_per_read,
+        "Estimated CPU seconds saved each time the decompressed inputs are read",
+    )
+
+    return [path.with_suffix("") for path in paths]
@@ -0,0 +1,186 @@
+"""Leave files that would be ignored out of the BIDS download.
+
+The bidsignore input used to be installed in work/bids/ only after everything
+had been downloaded so files the validator and BIDS App ignore (derivatives,
+extra sidecars, unused acquisitions, ...) were still transferred.  Now its
+patterns, along with any in gear-download-exclude, are checked while the
+download is planned and matching files are never fetched.
+
+Patterns use .bidsignore (gitignore) syntax:
+
+  * "*" and "?" do not match "/", "**" matches across directories
+  * a pattern with a "/" (other than at the end) is relative to the top of
+    the dataset, otherwise it matches a file or directory name at any depth
+  * a pattern ending with "/" only matches directories
+  * "!" in front of a pattern includes files that an earlier pattern excluded
+
+flywheel_bids decides which files to download with the is_file_excluded()
+function made by export_bids.is_file_excluded_options() and has no other way
+to pass a filter so skip_ignored_files() wraps that function while the
+download runs.
+"""
+
+import contextlib
+import logging
+import os
+import re
+import threading
+
+from ..fly.disk_budget import format_bytes
+from ..fly.queued_logging import LimitedLog
+
+log = logging.getLogger(__name__)
+
+
+def read_ignore_patterns(file_name):
+    """Return the patterns in a .bidsignore file, without blanks and comments."""
+
+    patterns = []
+    with open(file_name) as fp:
+        for line in fp:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                patterns.append(line)
+    return patterns
+
+
+def pattern_to_regex(pattern):
+    """Return a compiled regular expression for one .bidsignore pattern."""
+
+    directory_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+
+    prefix = "" if anchored else "(?:.*/)?"
+    # a directory that matches excludes everything in it
+    suffix = "/.*" if directory_only else "(?:/.*)?"
+    return re.compile(f"^{prefix}{regex}{suffix}$")
+
+
+def make_matcher(patterns):
+    """Return a function that tells which pattern excludes a relative path.
+
+    Args:
+        patterns (list of str) .bidsignore style patterns
+
+    Returns:
+        matcher (function) relative path -> the pattern that excludes it or None
+    """
+
+    compiled = []
+    for pattern in patterns:
+        negated = pattern.startswith("!")
+        compiled.append((pattern, negated, pattern_to_regex(pattern.lstrip("!"))))
+
+    def matcher(relative_path):
+        relative_path = str(relative_path).replace(os.sep, "/")
+        excluded_by = None
+        for pattern, negated, regex in compiled:  # the last match wins
+            if regex.match(relative_path):
+                excluded_by = None if negated else pattern
+        return excluded_by
+
+    return matcher
+
+
+class SkippedFiles:
+    """Count the files left out and the bytes that were not transferred."""
+
+    def __init__(self):
+        self.count = 0
+        self.num_bytes = 0
+        self.by_pattern = {}
+        self._skipping = LimitedLog(log, "Skipping %s (matches '%s')")
+        self._lock = threading.Lock()
+
+    def add(self, relative_path, size, pattern):
+        with self._lock:
+            self.count += 1
+            self.num_bytes += size or 0
+            self.by_pattern[pattern] = self.by_pattern.get(pattern, 0) + 1
+            self._skipping.log(relative_path, pattern)
+
+    def summary(self):
+        """Log how many files and bytes were skipped."""
+
+        if not self.count:
+            return
+        self._skipping.summary()
+        log.info(
+            "Skipped %d ignored files (%s): %s",
+            self.count,
+            format_bytes(self.num_bytes),
+            ", ".join(f"'{pat}': {num}" for pat, num in self.by_pattern.items()),
+        )
+
+
+@contextlib.contextmanager
+def skip_ignored_files(bids_dir, patterns):
+    """Leave files matching patterns out of Flywheel BIDS downloads to bids_dir.
+
+    Example:
+        .. code-block:: python
+
+            with skip_ignored_files(bids_dir, patterns):
+                download_bids_dir(...)
+
+    Args:
+        bids_dir (str) directory the BIDS data is downloaded to
+        patterns (list of str) .bidsignore style patterns
+
+    Yields:
+        skipped (SkippedFiles) what was left out
+    """
+
+    skipped = SkippedFiles()
+    if not patterns:
+        yield skipped
+        return
+
+    from flywheel_bids import export_bids
+
+    matcher = make_matcher(patterns)
+    original = export_bids.is_file_excluded_options
+
+    def is_file_excluded_options(namespace, src_data, replace):
+        is_file_excluded = original(namespace, src_data, replace)
+
+        def is_file_excluded_or_ignored(f, fpath):
+            if is_file_excluded(f, fpath):
+                return True
+            relative_path = os.path.relpath(fpath, bids_dir)
+            pattern = matcher(relative_path)
+            if pattern:
+                skipped.add(relative_path, f.get("size"), pattern)
+                return True
+            return False
+
+        return is_file_excluded_or_ignored
+
+    log.info("Not downloading files that match: %s", " ".join(patterns))
+    export_bids.is_file_excluded_options = is_file_excluded_options
+    try:
+        yield skipped
+    finally:
+        export_bids.is_file_excluded_options = original
+        skipped.summary()
@@ -4,12 +4,17 @@
 import json
 import logging
 import shutil
+import tarfile
+import zipfile
 from pathlib import Path
 
-from flywheel import ApiException
-from flywheel_bids.export_bids import download_bids_dir
-from flywheel_bids.supporting_files.errors import BIDSExportError
-
+from .archive_input import (
+    MAX_RATIO,
+    UnsafeArchiveError,
+    extract_bids_archive,
+    find_bids_archive,
+)
+from .download_filter import read_ignore_patterns, skip_ignored_files
 from .tree import tree_bids
 from .validate import validate_bids
 
@@ -29,6 +34,18 @@ DATASET_DESCRIPTION = {
 }
 
 
+def download_bids_dir(*args, **kwargs):
+    """Call flywheel_bids.export_bids.download_bids_dir().
+
+    flywheel_bids (and the Flywheel SDK) are only imported when BIDS data is
+    actually downloaded so that jobs that stop early do not pay for them.
+    """
+
+    from flywheel_bids.export_bids import download_bids_dir as _download_bids_dir
+
+    return _download_bids_dir(*args, **kwargs)
+
+
 def fix_dataset_description(bids_path):
     """Make sure dataset_description.json exists and that "Funding" is a list.
 
@@ -60,9 +77,11 @@ def fix_dataset_description(bids_path):
 
             data = json.load(json_file)
 
-            log.info("type of Funding is: %s", str(type(data["Funding"])))
+            # "Funding" is optional, e.g. it may not be in a bids_archive
+            funding = data.get("Funding", [])
+            log.info("type of Funding is: %s", str(type(funding)))
 
-            if not isinstance(data["Funding"], list):
+            if not isinstance(funding, list):
 
                 log.warning('data["Funding"] is not a list')
                 data["Funding"] = list(data["Funding"])
@@ -89,6 +108,9 @@ def download_bids_for_runlevel(
     folders=[],
     dry_run=False,
     do_validate_bids=True,
+    exclude=[],
+    skip_bidsignored=True,
+    max_ratio=MAX_RATIO,
 ):
     """Figure out run level, download BIDS, validate BIDS, tree work/bids.
 
@@ -103,6 +125,11 @@ def download_bids_for_runlevel(
         folders (list): only include the listed folders, if empty include all
         dry_run (boolean): don't actually download data if True
         do_validate_bids (boolean): run bids-validator after downloading bids data
+        exclude (list): .bidsignore style patterns of files not to download
+        skip_bidsignored (boolean): don't download files that match the
+            patterns in the bidsignore input either
+        max_ratio (float): most a member of a zipped bids_archive input may be
+            compressed, 0 for no limit
 
     Returns:
         err_code (int): tells a bit about the error:
@@ -118,11 +145,18 @@ def download_bids_for_runlevel(
             24   - destination does not exist
             25   - download_bids_dir() ApiException
             26   - no BIDS data was downloaded
+            27   - the bids_archive input could not be extracted
+
+    If the "bids_archive" input is given, it is extracted to work/bids instead
+    of downloading BIDS data from Flywheel.
 
     Note: information on BIDS "folders" (used to limit what is downloaded)
     can be found at https://bids-specification.readthedocs.io/en/stable/99-appendices/04-entity-table.html.
     """
 
+    from flywheel import ApiException
+    from flywheel_bids.supporting_files.errors import BIDSExportError
+
     extra_tree_text = ""  # Text to be added to the end of the tree HTML file
 
     run_level = hierarchy["run_level"]
@@ -192,8 +226,39 @@ def download_bids_for_runlevel(
                 log.info("Downloading BIDS data in all folders.")
 
             bids_dir = Path(gtk_context.work_dir) / "bids"
+            bids_archive = find_bids_archive()
+
+            ignore_patterns = list(exclude)
+            bidsignore_list = list(Path("input/bidsignore").glob("*"))
+            if skip_bidsignored and len(bidsignore_list) > 0:
+                ignore_patterns += read_ignore_patterns(bidsignore_list[0])
 
-            if run_level in ["project", "subject", "session"]:
+            if bids_archive:
+
+                bids_path = bids_dir
+                if Path(bids_dir).exists():
+                    log.info(f"Not extracting {bids_archive} because {bids_dir} exists")
+                else:
+                    try:
+                        extract_bids_archive(
+                            bids_archive,
+                            bids_dir,
+                            exclude=ignore_patterns,
+                            max_ratio=max_ratio,
+                        )
+                    except (
+                        UnsafeArchiveError,
+                        zipfile.BadZipFile,
+                        tarfile.TarError,
+                        OSError,
+                    ) as err:
+                        msg = f"Could not extract {bids_archive.name}: {err}"
+                        log.critical(msg)
+                        extra_tree_text += f"ERROR: {msg}\n"
+                        bids_path = None
+                        err_code = 27
+
+            elif run_level in ["project", "subject", "session"]:
 
                 log.info(
                     'Downloading BIDS for %s "%s"',
@@ -217,13 +282,14 @@ def download_bids_for_runlevel(
                         if "session" in k and v is not None
                     ]
 
-                    bids_path = gtk_context.download_project_bids(
-                        src_data=src_data,
-                        folders=folders,
-                        dry_run=dry_run,
-                        subjects=subjects,
-                        sessions=sessions,
-                    )
+                    with skip_ignored_files(bids_dir, ignore_patterns):
+                        bids_path = gtk_context.download_project_bids(
+                            src_data=src_data,
+                            folders=folders,
+                            dry_run=dry_run,
+                            subjects=subjects,
+                            sessions=sessions,
+                        )
 
             elif run_level == "acquisition":
 
@@ -251,15 +317,16 @@ def download_bids_for_runlevel(
                         )
                     else:
                         # only download acquisition data
-                        download_bids_dir(
-                            gtk_context.client,
-                            gtk_context.destination["id"],
-                            "acquisition",
-                            bids_dir,
-                            src_data=src_data,
-                            folders=folders,
-                            dry_run=dry_run,
-                        )
+                        with skip_ignored_files(bids_dir, ignore_patterns):
+                            download_bids_dir(
+                                gtk_context.client,
+                                gtk_context.destination["id"],
+                                "acquisition",
+                                bids_dir,
+                                src_data=src_data,
+                                folders=folders,
+                                dry_run=dry_run,
+                            )
 
             else:
                 msg = (
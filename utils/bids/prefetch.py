@@ -0,0 +1,189 @@
+"""Read BIDS data into the page cache while the gear is still setting up.
+
+On network storage the BIDS App's first pass over the data waits on I/O.  The
+Prefetcher asks the kernel to read the files ahead of time
+(posix_fadvise(POSIX_FADV_WILLNEED)) in background threads so that happens
+while the rest of setup and the BIDS App's own start-up run.
+
+Files are prefetched in priority order (anatomical data first, then
+functional, then the rest) and only until the memory budget is used up: the
+page cache is only helpful if it does not push out memory the BIDS App needs.
+The budget is part of the memory left after what the BIDS App is expected to
+use, not after mem_gb, which is all available memory unless it is configured.
+
+Example:
+    .. code-block:: python
+
+        prefetcher = Prefetcher("work/bids", app_gb=8)
+        prefetcher.start()
+        ...  # run the BIDS App
+        prefetcher.stop()
+"""
+
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from ..fly.disk_budget import format_bytes
+
+log = logging.getLogger(__name__)
+
+# Datatype directories in the order they are prefetched, others come last
+PRIORITY = ["anat", "func", "fmap", "dwi", "perf"]
+
+# Fraction of the memory the BIDS App will not use that is used for prefetching
+MEMORY_FRACTION = 0.5
+
+# Large files are read this much at a time if posix_fadvise is not available
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def get_priority(path):
+    """Return the position of the file's datatype in PRIORITY."""
+
+    parts = Path(path).parts
+    for index, datatype in enumerate(PRIORITY):
+        if datatype in parts:
+            return index
+    return len(PRIORITY)
+
+
+def list_prefetch_files(bids_dir):
+    """Return [(path, size)] of all files in bids_dir in the order to prefetch.
+
+    Symbolic links are not followed.
+    """
+
+    files = []
+    for root, _, names in os.walk(bids_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                files.append((path, os.path.getsize(path)))
+
+    files.sort(key=lambda item: (get_priority(item[0]), item[0]))
+
+    return files
+
+
+def get_prefetch_budget(app_gb):
+    """Return how many bytes can be prefetched without crowding the BIDS App.
+
+    Args:
+        app_gb (float) GiB of memory the BIDS App is expected to use
+    """
+
+    import psutil
+
+    available = psutil.virtual_memory().available
+    spare = available - (app_gb or 0) * 1024 ** 3
+    if spare <= 0:
+        log.warning(
+            "Not prefetching: the BIDS App is expected to use %s GiB and %s is "
+            "available (set gear-prefetch-app-gb to what it needs)",
+            app_gb,
+            format_bytes(available),
+        )
+        return 0
+    return int(spare * MEMORY_FRACTION)
+
+
+def prefetch_file(path):
+    """Ask the kernel to read path into the page cache."""
+
+    with open(path, "rb") as fp:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        else:
+            while fp.read(CHUNK_SIZE):
+                pass
+
+
+class Prefetcher:
+    """Prefetch the files in a BIDS directory using background threads.
+
+    Args:
+        bids_dir (str) directory with the downloaded BIDS data
+        app_gb (float) GiB of memory the BIDS App is expected to use
+        max_workers (int) number of threads
+        budget (int) bytes to prefetch, by default from get_prefetch_budget()
+    """
+
+    def __init__(self, bids_dir, app_gb, max_workers=4, budget=None):
+        self.bids_dir = bids_dir
+        self.budget = get_prefetch_budget(app_gb) if budget is None else budget
+        self.max_workers = max_workers
+        self.prefetched = []
+        self.prefetched_bytes = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._threads = []
+        self._files = iter(())
+        self._start = None
+        self._end = None
+
+    def start(self):
+        """Start prefetching in daemon threads and return right away."""
+
+        self._start = time.perf_counter()
+        files = list_prefetch_files(self.bids_dir)
+        log.info(
+            "Prefetching up to %s of %d files in %s",
+            format_bytes(self.budget),
+            len(files),
+            self.bids_dir,
+        )
+        self._files = iter(files)
+        for _ in range(self.max_workers):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_file(self):
+        """Return the next (path, size) that fits in the budget or None."""
+
+        with self._lock:
+            for path, size in self._files:
+                if self.prefetched_bytes + size > self.budget:
+                    self.skipped += 1
+                    continue
+                self.prefetched_bytes += size
+                self.prefetched.append(path)
+                return path, size
+        return None
+
+    def _run(self):
+        while not self._done.is_set():
+            item = self._next_file()
+            if item is None:
+                self._end = time.perf_counter()
+                return
+            try:
+                prefetch_file(item[0])
+            except OSError as err:
+                log.debug("Could not prefetch %s: %s", item[0], err)
+
+    def wait(self):
+        """Wait for prefetching to finish."""
+
+        for thread in self._threads:
+            thread.join()
+
+    def stop(self):
+        """Stop prefetching (files being read are finished) and log a summary."""
+
+        self._done.set()
+        self.wait()
+        if self._start is None:
+            return
+        log.info(
+            "Prefetched %d files (%s) in %.1f seconds, %d skipped to stay in budget",
+            len(self.prefetched),
+            format_bytes(self.prefetched_bytes),
+            (self._end or time.perf_counter()) - self._start,
+            self.skipped,
+        )
+        self._start = None
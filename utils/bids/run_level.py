@@ -3,8 +3,6 @@
 
 import logging
 
-from flywheel import ApiException
-
 log = logging.getLogger(__name__)
 
 
@@ -21,6 +19,8 @@ def get_analysis_run_level_and_hierarchy(fw, destination_id):
             acquisition.
     """
 
+    from flywheel import ApiException
+
     hierarchy = {
         "run_level": "no_destination",
         "run_label": "unknown",
@@ -41,8 +41,13 @@ import logging
 import pprint
 import subprocess as sp
 
+from ..fly.metrics import set_metric
+
 log = logging.getLogger(__name__)
 
+# Issues can list thousands of files, only show this many
+MAX_FILES_PER_ISSUE = 20
+
 
 def call_validate_bids(bids_path, out_path):
     """Call command-line version of the bids validator.
@@ -107,6 +112,14 @@ def call_validate_bids(bids_path, out_path):
     return result.returncode, bids_output
 
 
+def more_files(files):
+    """Return a line saying how many files were not listed, if any."""
+
+    if len(files) > MAX_FILES_PER_ISSUE:
+        return f"      ... and {len(files) - MAX_FILES_PER_ISSUE} more files\n"
+    return ""
+
+
 def show_errors_and_warnings(bids_output):
     """Show what is in BIDS validation output"""
 
@@ -119,25 +132,27 @@ def show_errors_and_warnings(bids_output):
         )
         log.info(msg)
 
-    # show all errors
+    # show all errors, listing at most MAX_FILES_PER_ISSUE files for each
     for err in bids_output["issues"]["errors"]:
-        err_msg = err["reason"] + "\n"
-        for ff in err["files"]:
+        lines = [err["reason"] + "\n"]
+        for ff in err["files"][:MAX_FILES_PER_ISSUE]:
+            line = ""
             if ff["file"]:
-                err_msg += "      In file " + ff["file"]["relativePath"]
+                line += "      In file " + ff["file"]["relativePath"]
             if "evidence" in ff and ff["evidence"]:
-                err_msg += ", " + ff["evidence"] + "\n"
-            else:
-                err_msg += "\n"
-        log.error(err_msg)
+                line += ", " + ff["evidence"]
+            lines.append(line + "\n")
+        lines.append(more_files(err["files"]))
+        log.error("".join(lines))
 
     # show all warnings
     for warn in bids_output["issues"]["warnings"]:
-        warn_msg = warn["reason"] + "\n"
-        for ff in warn["files"]:
+        lines = [warn["reason"] + "\n"]
+        for ff in warn["files"][:MAX_FILES_PER_ISSUE]:
             if ff["file"]:
-                warn_msg += "      " + ff["file"]["relativePath"] + "\n"
-        log.warning(warn_msg)
+                lines.append("      " + ff["file"]["relativePath"] + "\n")
+        lines.append(more_files(warn["files"]))
+        log.warning("".join(lines))
 
 
 def validate_bids(bids_path):
@@ -173,6 +188,19 @@ def validate_bids(bids_path):
 
         show_errors_and_warnings(bids_output)
 
+        set_metric(
+            "gear_bids_files_validated",
+            bids_output.get("summary", {}).get("totalFiles", 0),
+            "Number of files checked by the BIDS Validator",
+        )
+        for severity in ["errors", "warnings"]:
+            set_metric(
+                "gear_bids_validator_issues",
+                len(bids_output["issues"][severity]),
+                "Number of BIDS Validator issues",
+                {"severity": severity},
+            )
+
     except TypeError as ter:
         log.critical(str(repr(ter)), exc_info=True)
         err_code = 12
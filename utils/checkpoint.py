@@ -0,0 +1,202 @@
+"""Remember which stages of the gear finished so a restarted job can skip them.
+
+If a job dies (e.g. while packaging) and is started again on the same machine,
+everything would be done again: the download, BIDS validation and the whole
+BIDS App.  With gear-resume, the stages that finish are recorded in a
+checkpoint file in the gear's scratch directory along with a key made from
+the job's config.json (its configuration, inputs and destination).
+run_in_tmp_dir() keeps the scratch directory of a previous run with the same
+key instead of removing it, and main() skips the stages it finished.
+
+A stage is only skipped if its fingerprint (e.g. the command that was run)
+matches and the paths it made still exist.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_NAME = "gear_checkpoint.json"
+
+
+def get_run_key(config_file="config.json"):
+    """Make a key for this job from config.json if "gear-resume" is set.
+
+    This is read directly because it is needed before the gear toolkit
+    context is created.
+
+    Args:
+        config_file (str) path to the gear's config.json
+
+    Returns:
+        key (str) hex digest or None if gear-resume is not set
+    """
+
+    try:
+        with open(config_file) as fp:
+            config_json = json.load(fp)
+    except (OSError, ValueError) as err:
+        log.debug("Could not read %s: %s", config_file, err)
+        return None
+
+    if not config_json.get("config", {}).get("gear-resume"):
+        return None
+
+    job = {
+        "config": config_json.get("config"),
+        "inputs": config_json.get("inputs"),
+        "destination": config_json.get("destination"),
+    }
+    return hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+
+def read_key(checkpoint_file):
+    """Return the key saved in a checkpoint file or None."""
+
+    try:
+        with open(checkpoint_file) as fp:
+            return json.load(fp).get("key")
+    except (OSError, ValueError):
+        return None
+
+
+def fingerprint(*things):
+    """Return a short hash of things (anything json can serialize)."""
+
+    text = json.dumps(things, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def list_files(directory):
+    """Return {relative path: size} of all files in directory (for fingerprints)."""
+
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, directory)] = os.lstat(path).st_size
+    return files
+
+
+class Checkpoint:
+    """Stages that finished, saved in a JSON file after each one.
+
+    Args:
+        checkpoint_file (str) where to save the checkpoint
+        key (str) from get_run_key(), if None nothing is saved or skipped
+    """
+
+    def __init__(self, checkpoint_file=CHECKPOINT_NAME, key=None):
+        self.checkpoint_file = Path(checkpoint_file)
+        self.key = key
+        self.stages = {}
+        # values that need to survive a restart, saved with each stage
+        self.values = {}
+        self._lock = threading.Lock()
+
+        if key and read_key(self.checkpoint_file) == key:
+            with open(self.checkpoint_file) as fp:
+                saved = json.load(fp)
+            self.stages = saved["stages"]
+            self.values = saved["values"]
+            log.info(
+                "Resuming: these stages already finished: %s", ", ".join(self.stages)
+            )
+
+    def is_done(self, name, fprint=None):
+        """Return True if stage name finished with the same fingerprint and the
+        paths it made still exist."""
+
+        stage = self.stages.get(name)
+        if not self.key or stage is None or stage["fingerprint"] != fprint:
+            return False
+        missing = [path for path in stage["outputs"] if not os.path.lexists(path)]
+        if missing:
+            log.info("Running %s again, it made %s which is gone", name, missing[0])
+            return False
+        return True
+
+    def get_result(self, name):
+        """Return what the stage returned when it finished."""
+
+        return self.stages[name]["result"]
+
+    def mark_done(self, name, fprint=None, outputs=(), result=None):
+        """Record that stage name finished and save the checkpoint.
+
+        Args:
+            name (str) stage name
+            fprint (str) fingerprint of the stage's inputs
+            outputs (list of str) paths the stage made
+            result (anything json can serialize) what the stage returned
+        """
+
+        if not self.key:
+            return
+
+        with self._lock:
+            self.stages[name] = {
+                "fingerprint": fprint,
+                "outputs": [str(path) for path in outputs],
+                "result": result,
+                "time": time.time(),
+            }
+            values = {
+                key: dict(value) if isinstance(value, dict) else value
+                for key, value in self.values.items()
+            }
+            tmp_file = self.checkpoint_file.with_name(
+                f".{self.checkpoint_file.name}.{threading.get_ident()}.tmp"
+            )
+            with open(tmp_file, "w") as fp:
+                json.dump(
+                    {"key": self.key, "stages": self.stages, "values": values},
+                    fp,
+                    default=str,
+                )
+            os.rename(tmp_file, self.checkpoint_file)  # never half written
+
+    def keep_only(self, names):
+        """Forget all stages except these, e.g. when an earlier stage runs again."""
+
+        with self._lock:
+            self.stages = {
+                name: stage for name, stage in self.stages.items() if name in names
+            }
+
+    def wrap(self, name, function, fprint=None, outputs=(), watch_dir=None):
+        """Return a function that runs function unless stage name is done.
+
+        Args:
+            name (str) stage name
+            function (function) the stage, called with no arguments
+            fprint (str) fingerprint of the stage's inputs
+            outputs (list of str) paths the stage makes
+            watch_dir (str) anything new in this directory after the stage runs
+                is added to outputs.  Stages running at the same time may add
+                to it too so this can only make outputs longer than needed.
+
+        Returns:
+            stage (function) that returns what function returns (or returned)
+        """
+
+        def stage():
+            if self.is_done(name, fprint):
+                log.info("Skipping %s, it finished before the gear was restarted", name)
+                return self.get_result(name)
+            before = set(os.listdir(watch_dir)) if watch_dir and self.key else set()
+            result = function()
+            made = list(outputs)
+            if watch_dir and self.key:
+                new = set(os.listdir(watch_dir)) - before
+                made += [os.path.join(watch_dir, entry) for entry in sorted(new)]
+            self.mark_done(name, fprint, made, result)
+            return result
+
+        return stage
@@ -0,0 +1,137 @@
+"""Delete large directory trees without making the gear wait for it.
+
+Deleting millions of small files (e.g. nipype work directories) can take a
+very long time on network file systems.  Instead, a tree is first renamed out
+of the way, which is atomic and fast, and then it is deleted by parallel
+workers in a background thread or in a detached process.
+"""
+
+import logging
+import os
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+TRASH_NAME = "gear-trash-"
+CLEANUP_WORKERS = 8
+
+# This file is run as a script to delete trees in a detached process
+CLEANUP_SCRIPT = Path(__file__).resolve()
+
+_cleanup_threads = []
+
+
+def move_aside(path, trash_dir=None):
+    """Rename path into a new trash directory so it can be deleted later.
+
+    Args:
+        path (Path) file or directory to move
+        trash_dir (Path) where to create the trash directory, it must be on
+            the same file system as path.  Defaults to the parent of path.
+
+    Returns:
+        trash (Path) the new trash directory that holds path or None if path
+            could not be renamed (e.g. trash_dir is on another file system)
+    """
+
+    path = Path(path)
+    if trash_dir is None:
+        trash_dir = path.parent
+
+    trash = Path(tempfile.mkdtemp(prefix=TRASH_NAME, dir=trash_dir))
+    try:
+        os.rename(path, trash / path.name)
+    except OSError as err:
+        log.debug("Could not move %s to %s: %s", path, trash, err)
+        os.rmdir(trash)
+        return None
+
+    log.debug("Moved %s to %s", path, trash)
+    return trash
+
+
+def remove_tree(path, n_workers=CLEANUP_WORKERS):
+    """Delete a directory tree, removing its subdirectories in parallel.
+
+    Symbolic links are removed, not followed.
+
+    Args:
+        path (Path) directory to delete
+        n_workers (int) number of threads deleting at the same time
+    """
+
+    if not os.path.isdir(path) or os.path.islink(path):
+        log.debug("%s is not a directory, nothing to remove", path)
+        return
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                pool.submit(shutil.rmtree, entry.path, True)
+            else:
+                os.unlink(entry.path)
+
+    shutil.rmtree(path, ignore_errors=True)
+    log.debug("Removed %s", path)
+
+
+def remove_tree_in_background(path, trash_dir=None, detach=False):
+    """Move a directory tree aside and delete it without waiting.
+
+    If path cannot be moved aside, it is deleted right away instead.
+
+    Args:
+        path (Path) directory to delete
+        trash_dir (Path) where to move path to, see move_aside()
+        detach (bool) delete in a separate process that keeps running after
+            the gear exits instead of in a background thread
+
+    Returns:
+        trash (Path) where path was moved to or None if it was deleted already
+    """
+
+    trash = move_aside(path, trash_dir)
+
+    if trash is None:
+        log.info("Removing %s", path)
+        remove_tree(path)
+
+    elif detach:
+        log.info("Removing %s in a detached process", path)
+        sp.Popen(
+            [sys.executable, str(CLEANUP_SCRIPT), str(trash)],
+            cwd="/",
+            stdin=sp.DEVNULL,
+            stdout=sp.DEVNULL,
+            stderr=sp.DEVNULL,
+            start_new_session=True,
+        )
+
+    else:
+        log.info("Removing %s in the background", path)
+        thread = threading.Thread(target=remove_tree, args=(trash,), daemon=True)
+        thread.start()
+        _cleanup_threads.append(thread)
+
+    return trash
+
+
+def wait_for_cleanup(timeout=None):
+    """Wait for background threads started by remove_tree_in_background().
+
+    Args:
+        timeout (float) seconds to wait for each thread, None waits forever
+    """
+
+    while _cleanup_threads:
+        _cleanup_threads.pop().join(timeout)
+
+
+if __name__ == "__main__":
+    remove_tree(sys.argv[1])
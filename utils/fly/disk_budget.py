@@ -0,0 +1,162 @@
+"""Check that there is enough disk space before each stage of the gear.
+
+A run holds work/bids, the BIDS App's work directory, output/<destination_id>
+and the archives made from them on disk at the same time.  Checking before
+each stage lets the gear fail fast (or save space) instead of running out of
+disk space at the very end after hours of compute.
+"""
+
+import logging
+import os
+import shutil
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# Fraction of the BIDS App's footprint that is expected to end up in output/
+# (the rest is in its work directory).
+OUTPUT_FRACTION = 0.5
+
+# Ask for this much more space than is estimated to be needed.
+SAFETY_MARGIN = 1.1
+
+
+def format_bytes(num_bytes):
+    """Return a human readable size, e.g. "1.50 GiB"."""
+
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.2f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.2f} TiB"
+
+
+def inventory_dir(path):
+    """Add up the sizes of all files under path without following symlinks.
+
+    Args:
+        path (Path) directory to measure
+
+    Returns:
+        tuple: Three values:
+
+            * total_bytes (int): sum of the file sizes
+
+            * largest_bytes (int): size of the largest file
+
+            * num_files (int): number of files
+    """
+
+    total_bytes = 0
+    largest_bytes = 0
+    num_files = 0
+
+    if Path(path).exists():
+        for root, _, files in os.walk(path):
+            for fl in files:
+                file_path = os.path.join(root, fl)
+                if os.path.islink(file_path):
+                    continue
+                size = os.lstat(file_path).st_size
+                total_bytes += size
+                largest_bytes = max(largest_bytes, size)
+                num_files += 1
+
+    return total_bytes, largest_bytes, num_files
+
+
+def get_dir_size(path):
+    """Return the total size in bytes of all files under path."""
+
+    return inventory_dir(path)[0]
+
+
+def get_free_bytes(path):
+    """Return the number of bytes available on the file system holding path."""
+
+    return shutil.disk_usage(path).free
+
+
+def estimate_run_bytes(bids_bytes, footprint_factor, save_intermediate=False):
+    """Estimate how much disk space running the BIDS App and archiving will take.
+
+    Args:
+        bids_bytes (int) size of the downloaded BIDS data
+        footprint_factor (float) expected size of the BIDS App's work and output
+            directories as a multiple of the size of the BIDS data
+        save_intermediate (bool) the work directory will also be archived
+
+    Returns:
+        estimate (dict) bytes needed by "app" (work + output), by its "work"
+            directory alone, and by "archives"
+    """
+
+    app_bytes = int(bids_bytes * footprint_factor)
+    output_bytes = int(app_bytes * OUTPUT_FRACTION)
+    work_bytes = app_bytes - output_bytes
+    archive_bytes = output_bytes
+    if save_intermediate:
+        archive_bytes += work_bytes
+
+    estimate = {"app": app_bytes, "work": work_bytes, "archives": archive_bytes}
+    log.info(
+        "Estimated disk space for BIDS App: %s, for archives: %s",
+        format_bytes(app_bytes),
+        format_bytes(archive_bytes),
+    )
+
+    return estimate
+
+
+def check_disk_budget(stage, path, needed_bytes, minimum_bytes=None):
+    """Compare the free space at path with what the next stage needs.
+
+    Args:
+        stage (str) description of the stage for the log
+        path (Path) where the stage will write
+        needed_bytes (int) space needed to run the stage normally
+        minimum_bytes (int) space needed when the stage saves space by
+            switching to a lower footprint behavior.  Defaults to needed_bytes.
+
+    Returns:
+        budget (str) "ok" if there is room to run normally, "tight" if there is
+            only room for the lower footprint behavior, or "insufficient"
+    """
+
+    if minimum_bytes is None:
+        minimum_bytes = needed_bytes
+
+    free_bytes = get_free_bytes(path)
+
+    if free_bytes >= needed_bytes * SAFETY_MARGIN:
+        budget = "ok"
+        log.info(
+            "Disk budget for %s is ok: need %s, %s free at %s",
+            stage,
+            format_bytes(needed_bytes),
+            format_bytes(free_bytes),
+            path,
+        )
+
+    elif free_bytes >= minimum_bytes * SAFETY_MARGIN:
+        budget = "tight"
+        log.warning(
+            "Disk budget for %s is tight: need %s (at least %s), %s free at %s",
+            stage,
+            format_bytes(needed_bytes),
+            format_bytes(minimum_bytes),
+            format_bytes(free_bytes),
+            path,
+        )
+
+    else:
+        budget = "insufficient"
+        log.error(
+            "Not enough disk space for %s: need at least %s, %s free at %s",
+            stage,
+            format_bytes(minimum_bytes),
+            format_bytes(free_bytes),
+            path,
+        )
+
+    return budget
@@ -23,9 +23,8 @@ def get_and_log_environment():
         environ = json.load(f)
 
         # Add environment to log if debugging
-        kv = ""
-        for k, v in environ.items():
-            kv += k + "=" + v + " "
-        log.debug("Environment: " + kv)
+        if log.isEnabledFor(logging.DEBUG):
+            kv = " ".join(k + "=" + v for k, v in environ.items())
+            log.debug("Environment: %s", kv)
 
     return environ
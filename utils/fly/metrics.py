@@ -0,0 +1,141 @@
+"""Save metrics about the run for the Prometheus node_exporter textfile collector.
+
+Metrics are collected in this module while the gear runs and are written at the
+end of the job as <gear>_<destination id>.prom in a configured directory that
+node_exporter reads.  Nothing is served, so this works without a live service.
+
+Example:
+    .. code-block:: python
+
+        set_metric("gear_bids_bytes", 1234, "Size of the downloaded BIDS data")
+        set_metric("gear_stage_seconds", 1.5, "Stage duration", {"stage": "zip"})
+        write_textfile("/var/lib/node_exporter", "my-gear_1234.prom", labels)
+"""
+
+import logging
+import math
+import os
+import resource
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# name: {"help": str, "type": str, "samples": {tuple of label items: value}}
+metrics = {}
+
+
+def set_metric(name, value, help_text, labels=None, kind="gauge"):
+    """Set the value of a metric, replacing any value with the same labels.
+
+    Args:
+        name (str) metric name, e.g. "gear_bids_bytes"
+        value (float) the value
+        help_text (str) description of the metric
+        labels (dict) labels for this value in addition to the common ones
+        kind (str) Prometheus metric type, "gauge" or "counter"
+    """
+
+    metric = metrics.setdefault(name, {"help": help_text, "type": kind, "samples": {}})
+    metric["samples"][tuple(sorted((labels or {}).items()))] = value
+
+
+def escape(value):
+    """Escape a label value for the Prometheus text format."""
+
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    """Format a sample value without losing precision.
+
+    Integers (e.g. byte counts) are written as they are and floats with all of
+    their digits, "%g" would write 1234567890 as 1.23457e+09.
+    """
+
+    if isinstance(value, int):
+        return str(int(value))  # bool too
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def format_metrics(common_labels):
+    """Return all metrics in the Prometheus text format.
+
+    Args:
+        common_labels (dict) labels added to every sample, e.g. gear name
+    """
+
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, value in metric["samples"].items():
+            all_labels = dict(common_labels, **dict(labels))
+            label_text = ",".join(
+                f'{key}="{escape(val)}"' for key, val in sorted(all_labels.items())
+            )
+            lines.append(f"{name}{{{label_text}}} {format_value(value)}")
+
+    return "".join(line + "\n" for line in lines)
+
+
+def record_app_usage():
+    """Save peak memory and CPU time used by the child processes (the BIDS App)."""
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    set_metric(
+        "gear_app_max_rss_bytes",
+        usage.ru_maxrss * 1024,  # KiB on Linux
+        "Peak resident memory of the largest child process",
+    )
+    set_metric(
+        "gear_app_cpu_seconds",
+        usage.ru_utime + usage.ru_stime,
+        "User plus system CPU time of all child processes",
+    )
+
+
+def record_output_files(output_dir):
+    """Save the size of each file at the top of the output directory."""
+
+    for path in sorted(Path(output_dir).glob("*")):
+        if path.is_file():
+            set_metric(
+                "gear_output_file_bytes",
+                path.stat().st_size,
+                "Size of each file that will be uploaded",
+                {"file": path.name},
+            )
+
+
+def write_textfile(directory, file_name, common_labels):
+    """Write all metrics to directory/file_name atomically.
+
+    The file is written under a temporary name and then renamed so the
+    collector never reads half of it.
+
+    Args:
+        directory (str) directory read by the node_exporter textfile collector
+        file_name (str) should end in ".prom"
+        common_labels (dict) labels added to every sample
+
+    Returns:
+        prom_file (Path) or None if it could not be written
+    """
+
+    prom_file = Path(directory) / file_name
+    tmp_file = Path(directory) / f".{file_name}.{os.getpid()}.tmp"
+    try:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        tmp_file.write_text(format_metrics(common_labels))
+        os.rename(tmp_file, prom_file)
+    except OSError as err:
+        log.warning("Could not write metrics to %s: %s", prom_file, err)
+        return None
+
+    log.info("Wrote metrics to %s", prom_file)
+    return prom_file
@@ -0,0 +1,198 @@
+"""Follow the progress of the BIDS App from its output.
+
+exec_supervised() passes each line the BIDS App prints to a ProgressTracker
+which looks for progress markers in formats that are known not to show up in
+other output:
+
+  * nipype nodes that finish ([Node] Finished "...")
+  * subjects that start, when the first node of a nipype workflow named
+    single_subject_<label>_wf (fMRIPrep, sMRIPrep, QSIPrep, ...) is set up
+  * percentages of tqdm progress bars (" 45%|####      |")
+
+Every REPORT_INTERVAL seconds a progress line with throughput and an estimated
+time to finish is logged and the state is saved in a JSON file.  If no markers
+are seen for stall_minutes the BIDS App is stopped instead of waiting for
+gear-timeout.
+
+Other BIDS Apps have their own markers, e.g. a line when a subject is done,
+which can be recognized by adding (regular expression, handler) pairs to
+PROGRESS_PATTERNS.  Keep them anchored to the app's exact format: any match
+counts as progress and resets the stall timer.
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# Seconds between progress lines in the log
+REPORT_INTERVAL = 300
+
+
+def on_node_finished(tracker, match):
+    tracker.nodes_finished += 1
+
+
+def on_subject_started(tracker, match):
+    tracker.subjects_started.add(f"sub-{match.group('subject')}")
+
+
+def on_subject_finished(tracker, match):
+    tracker.subjects_finished.add(f"sub-{match.group('subject')}")
+
+
+def on_percent(tracker, match):
+    percent = float(match.group("percent"))
+    if 0 <= percent <= 100:
+        tracker.percent = percent
+
+
+# (compiled regular expression, handler(tracker, match)), all that match are used.
+# "subject" groups are the label without "sub-".
+# editme: add the BIDS App's own markers, e.g. when it finishes a subject:
+#   (re.compile(r"^Participant sub-(?P<subject>[a-zA-Z0-9]+) done$"),
+#    on_subject_finished),
+PROGRESS_PATTERNS = [
+    (re.compile(r'\[Node\] Finished "(?P<node>[^"]+)"'), on_node_finished),
+    (
+        re.compile(
+            r'\[Node\] Setting-up "[^"]*\bsingle_subject_(?P<subject>[a-zA-Z0-9]+)_wf\.'
+        ),
+        on_subject_started,
+    ),
+    (re.compile(r"(?:^|: ) *(?P<percent>\d{1,3}(?:\.\d+)?)%\|"), on_percent),
+]
+
+
+def format_duration(seconds):
+    """Return seconds as H:MM:SS."""
+
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class ProgressTracker:
+    """Recognize progress markers in output lines and report on them.
+
+    Args:
+        progress_file (str) where to save the progress as JSON
+        total_subjects (int) number of subjects to be processed, if known
+        stall_minutes (float) stop the BIDS App if there is no progress for
+            this long, 0 or None to never stop it
+    """
+
+    def __init__(self, progress_file=None, total_subjects=0, stall_minutes=None):
+        self.progress_file = progress_file
+        self.total_subjects = total_subjects
+        self.stall_seconds = (stall_minutes or 0) * 60
+        self.nodes_finished = 0
+        self.subjects_started = set()
+        self.subjects_finished = set()
+        self.percent = None
+        self.start = time.monotonic()
+        self.last_progress = self.start
+        self.last_report = self.start
+        self._lock = threading.Lock()
+
+    def feed(self, line):
+        """Look for progress markers in a line of output."""
+
+        with self._lock:
+            before = self.state_key()
+            for pattern, handler in PROGRESS_PATTERNS:
+                match = pattern.search(line)
+                if match:
+                    handler(self, match)
+            if self.state_key() != before:
+                self.last_progress = time.monotonic()
+
+    def state_key(self):
+        return (
+            self.nodes_finished,
+            len(self.subjects_started),
+            len(self.subjects_finished),
+            self.percent,
+        )
+
+    def get_eta(self, elapsed):
+        """Return estimated seconds to finish or None if it can't be estimated."""
+
+        if self.percent:
+            return elapsed * (100 - self.percent) / self.percent
+        done = len(self.subjects_finished)
+        if done and self.total_subjects:
+            return elapsed * (self.total_subjects - done) / done
+        return None
+
+    def get_progress(self):
+        """Return the current progress as a dictionary."""
+
+        now = time.monotonic()
+        elapsed = now - self.start
+        eta = self.get_eta(elapsed)
+        return {
+            "elapsed_seconds": round(elapsed, 1),
+            "seconds_since_progress": round(now - self.last_progress, 1),
+            "nodes_finished": self.nodes_finished,
+            "nodes_per_minute": round(self.nodes_finished * 60 / elapsed, 2)
+            if elapsed
+            else 0,
+            "subjects_started": sorted(self.subjects_started),
+            "subjects_finished": sorted(self.subjects_finished),
+            "total_subjects": self.total_subjects,
+            "percent": self.percent,
+            "eta_seconds": round(eta) if eta is not None else None,
+        }
+
+    def report(self):
+        """Log a progress line and save the progress file."""
+
+        with self._lock:
+            progress = self.get_progress()
+
+        line = (
+            f"Progress after {format_duration(progress['elapsed_seconds'])}: "
+            f"{progress['nodes_finished']} nodes finished "
+            f"({progress['nodes_per_minute']}/min), "
+            f"{len(progress['subjects_finished'])}"
+        )
+        if self.total_subjects:
+            line += f"/{self.total_subjects}"
+        line += " subjects finished"
+        if progress["percent"] is not None:
+            line += f", {progress['percent']:g}%"
+        if progress["eta_seconds"] is not None:
+            line += f", ETA {format_duration(progress['eta_seconds'])}"
+        log.info(line)
+
+        if self.progress_file:
+            tmp_file = Path(f"{self.progress_file}.{os.getpid()}.tmp")
+            with open(tmp_file, "w") as fp:
+                json.dump(progress, fp, indent=2)
+            os.rename(tmp_file, self.progress_file)
+
+        return progress
+
+    def check(self):
+        """Report every REPORT_INTERVAL seconds and watch for stalls.
+
+        This is meant to be exec_supervised()'s watch_callback.
+
+        Returns:
+            reason (str) why the BIDS App should be stopped or None
+        """
+
+        now = time.monotonic()
+        if now - self.last_report >= REPORT_INTERVAL:
+            self.last_report = now
+            self.report()
+
+        if self.stall_seconds and now - self.last_progress > self.stall_seconds:
+            return f"it made no progress for {self.stall_seconds / 60:g} minutes"
+
+        return None
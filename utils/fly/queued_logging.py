@@ -0,0 +1,140 @@
+"""Write log messages from a background thread.
+
+The gear toolkit's handlers write each message to stdout as it is logged which
+is slow when the log is being captured.  start_queued_logging() moves the root
+logger's handlers behind a QueueHandler so logging only puts the record on a
+queue and a QueueListener thread does the writing.  flush_logging() waits until
+everything on the queue has been written and stop_queued_logging() puts the
+handlers back.  Output that is printed instead of logged (e.g. the BIDS App's)
+should be preceded and followed by flush_logging() so it stays in order.
+
+Hot paths that log once per file should use a LimitedLog so that only the
+first messages are logged at their level and the rest are counted.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+
+log = logging.getLogger(__name__)
+
+# How many per-file messages to log before they are only counted
+FIRST_N = 100
+
+_listener = None
+_handlers = []
+# stages in other threads may flush at the same time
+_lock = threading.Lock()
+
+
+def start_queued_logging():
+    """Move the root logger's handlers to a background thread.
+
+    Returns:
+        listener (logging.handlers.QueueListener) or None if already started
+    """
+
+    global _listener, _handlers
+
+    with _lock:
+        if _listener is not None:
+            return None
+
+        root = logging.getLogger()
+        _handlers = list(root.handlers)
+        log_queue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(
+            log_queue, *_handlers, respect_handler_level=True
+        )
+        for handler in _handlers:
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        _listener.start()
+        atexit.register(stop_queued_logging)
+
+        return _listener
+
+
+def _flush(handler):
+    try:
+        handler.flush()
+    except (OSError, ValueError):
+        pass  # the stream was closed, as logging.shutdown() allows
+
+
+def flush_logging():
+    """Wait until all messages logged so far have been written."""
+
+    with _lock:
+        if _listener is not None:
+            _listener.stop()  # processes everything on the queue, then returns
+            _listener.start()
+        for handler in _handlers or logging.getLogger().handlers:
+            _flush(handler)
+
+
+def stop_queued_logging():
+    """Write what is left on the queue and put the handlers back."""
+
+    global _listener, _handlers
+
+    with _lock:
+        if _listener is None:
+            return
+
+        _listener.stop()
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            if isinstance(handler, logging.handlers.QueueHandler):
+                root.removeHandler(handler)
+        for handler in _handlers:
+            root.addHandler(handler)
+            _flush(handler)
+        _listener = None
+        _handlers = []
+
+
+class LimitedLog:
+    """Log the first first_n messages at level, the rest at DEBUG.
+
+    Example:
+        .. code-block:: python
+
+            zipping = LimitedLog(log, "Zipping %s")
+            for path in paths:
+                zipping.log(path)
+            zipping.summary()
+
+    Args:
+        logger (logging.Logger) where to log
+        msg (str) message format with the arguments that will be passed to log()
+        level (int) level of the first first_n messages
+        first_n (int) how many to log at level
+    """
+
+    def __init__(self, logger, msg, level=logging.INFO, first_n=None):
+        self.logger = logger
+        self.msg = msg
+        self.level = level
+        self.first_n = FIRST_N if first_n is None else first_n
+        self.count = 0
+
+    def log(self, *args):
+        self.count += 1
+        if self.count <= self.first_n:
+            self.logger.log(self.level, self.msg, *args)
+        else:
+            self.logger.debug(self.msg, *args)
+
+    def summary(self):
+        """Log how many messages were not logged at level."""
+
+        if self.count > self.first_n:
+            self.logger.log(
+                self.level,
+                "... and %d more like '%s' (logged at DEBUG level)",
+                self.count - self.first_n,
+                self.msg,
+            )
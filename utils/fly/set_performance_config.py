@@ -1,8 +1,6 @@
 import logging
 import os
 
-import psutil
-
 log = logging.getLogger(__name__)
 
 
@@ -51,6 +49,8 @@ def set_mem_gb(mem_gb):
         mem_gb (float) which will become part of the command line command
     """
 
+    import psutil
+
     psutil_mem_gb = int(psutil.virtual_memory().available / (1024 ** 3))
     log.info("psutil.virtual_memory().available= {:5.2f} GiB".format(psutil_mem_gb))
     if mem_gb:
@@ -64,3 +64,71 @@ def set_mem_gb(mem_gb):
         log.info("using mem_gb = %d (maximum available)", psutil_mem_gb)
 
     return mem_gb
+
+
+# Environment variables that size the thread pools of numerical libraries and
+# tools BIDS Apps use.  If they are not set, each library starts a thread per
+# CPU on the host so n_cpus processes can end up running n_cpus threads each.
+THREAD_VARIABLES = [
+    "OMP_NUM_THREADS",  # OpenMP, also FSL (eddy, etc.) and AFNI
+    "MKL_NUM_THREADS",  # Intel MKL
+    "OPENBLAS_NUM_THREADS",  # OpenBLAS
+    "VECLIB_MAXIMUM_THREADS",  # Apple Accelerate
+    "NUMEXPR_NUM_THREADS",  # numexpr
+    "NUMEXPR_MAX_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",  # ITK and so ANTs
+    "MRTRIX_NTHREADS",  # MRtrix3
+]
+
+# editme: BIDS App name (BIDS_APP_NAME in run.py): {variable: number of threads}.
+# These replace the values set from n_cpus.  Apps built on nipype run up to
+# n_cpus processes at the same time and set the threads of each one themselves
+# (--omp-nthreads) so libraries should use one thread per process.
+APP_THREAD_OVERRIDES = {
+    "fmriprep": {"OMP_NUM_THREADS": 1, "MKL_NUM_THREADS": 1, "OPENBLAS_NUM_THREADS": 1},
+    "mriqc": {"OMP_NUM_THREADS": 1, "MKL_NUM_THREADS": 1, "OPENBLAS_NUM_THREADS": 1},
+    "qsiprep": {"OMP_NUM_THREADS": 1, "MKL_NUM_THREADS": 1, "OPENBLAS_NUM_THREADS": 1},
+}
+
+
+def set_thread_environment(environ, n_cpus, app=None, replace=False):
+    """Set the known thread-count environment variables from n_cpus.
+
+    Values already in environ (e.g. set in the Dockerfile or by the user) are
+    kept unless replace is True.
+
+    Args:
+        environ (dict) environment the BIDS App will be run with
+        n_cpus (int) number of CPUs the BIDS App can use
+        app (str) name of the BIDS App to look up in APP_THREAD_OVERRIDES
+        replace (bool) also change variables that are already set
+
+    Returns:
+        environ (dict) the same dictionary, changed
+    """
+
+    threads = {name: n_cpus for name in THREAD_VARIABLES}
+    overrides = APP_THREAD_OVERRIDES.get(app, {})
+    threads.update(overrides)
+
+    changed = {}
+    for name, value in threads.items():
+        if name in environ and environ[name] != str(value):
+            if not replace:
+                log.debug("Keeping %s=%s", name, environ[name])
+                continue
+            log.debug("Changing %s from %s to %s", name, environ[name], value)
+        environ[name] = str(value)
+        changed[name] = value
+
+    log.info(
+        "Thread environment for %d CPUs%s: %s",
+        n_cpus,
+        f" ({app} overrides {', '.join(overrides)})" if overrides else "",
+        " ".join(f"{name}={value}" for name, value in changed.items()),
+    )
+    kept = sorted(set(threads) - set(changed))
+    if kept:
+        log.info("Kept the values already set for %s", ", ".join(kept))
+
+    return environ
@@ -0,0 +1,335 @@
+"""Run the BIDS App and stop it before the kernel's OOM killer does.
+
+mem_gb is passed to the BIDS App but nothing makes it stay under that.  If
+it uses too much memory, the OOM killer stops the whole container: the log is
+lost and nothing is saved.  exec_supervised() runs the command like
+flywheel_gear_toolkit's exec_command() while a thread watches the memory of
+the whole process tree.  It is measured as the proportional set size (PSS),
+not the resident set size (RSS), because forked workers (e.g. nipype's) share
+copy-on-write pages that RSS counts once for each of them:
+
+  * above the soft limit (mem_gb) a warning is logged
+  * above the hard limit (just under what the container can use) a snapshot
+    of the biggest processes and their memory maps is saved, then the process
+    tree is terminated and RuntimeError is raised so the gear can still save
+    what it has.
+
+The output can also be passed to a line_callback and a watch_callback can stop
+the command for other reasons, see utils/fly/progress.py.
+"""
+
+import logging
+import os
+import signal
+import subprocess as sp
+import threading
+import time
+from pathlib import Path
+
+from .disk_budget import format_bytes
+from .metrics import set_metric
+from .queued_logging import flush_logging
+
+log = logging.getLogger(__name__)
+
+# How often to check memory use
+POLL_INTERVAL = 1.0
+
+# Stop the BIDS App when it uses this fraction of the memory the container has
+HARD_LIMIT_FRACTION = 0.95
+
+# Seconds to wait after SIGTERM before SIGKILL
+TERM_GRACE = 30
+
+# How many processes and memory maps to put in the snapshot
+SNAPSHOT_TOP_N = 10
+
+CGROUP_LIMITS = [
+    "/sys/fs/cgroup/memory.max",  # cgroup v2
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+]
+
+
+def get_memory_limit():
+    """Return the bytes of memory available to the container.
+
+    This is the smaller of the total memory and the cgroup limit, if any.
+    """
+
+    import psutil
+
+    limit = psutil.virtual_memory().total
+    for cgroup_file in CGROUP_LIMITS:
+        try:
+            value = Path(cgroup_file).read_text().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limit = min(limit, int(value))
+    return limit
+
+
+def get_memory_limits(mem_gb, hard_limit_gb=None):
+    """Return the soft and hard memory limits for the BIDS App in bytes.
+
+    Args:
+        mem_gb (float) GiB of memory the BIDS App is allowed to use
+        hard_limit_gb (float) GiB at which to stop it, by default
+            HARD_LIMIT_FRACTION of what the container can use
+
+    Returns:
+        tuple: (soft_limit, hard_limit)
+    """
+
+    soft_limit = int(mem_gb * 1024 ** 3) if mem_gb else None
+    if hard_limit_gb:
+        hard_limit = int(hard_limit_gb * 1024 ** 3)
+    else:
+        hard_limit = int(get_memory_limit() * HARD_LIMIT_FRACTION)
+    if soft_limit and soft_limit > hard_limit:
+        soft_limit = None  # the hard limit comes first, no need to warn
+    return soft_limit, hard_limit
+
+
+def get_memory_used(pp):
+    """Return the PSS of a process in bytes, its RSS where PSS is not available."""
+
+    import psutil
+
+    try:
+        return pp.memory_full_info().pss
+    except (AttributeError, psutil.AccessDenied):  # not Linux or no smaps
+        return pp.memory_info().rss
+
+
+def get_tree_pss(proc):
+    """Return (total PSS in bytes, list of processes) for proc and its children."""
+
+    import psutil
+
+    try:
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0, []
+
+    total = 0
+    alive = []
+    for pp in procs:
+        try:
+            total += get_memory_used(pp)
+            alive.append(pp)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return total, alive
+
+
+def memory_snapshot(procs):
+    """Describe the processes using the most memory and their biggest mappings.
+
+    Args:
+        procs (list of psutil.Process) processes in the tree
+
+    Returns:
+        snapshot (str)
+    """
+
+    import psutil
+
+    rows = []
+    for pp in procs:
+        try:
+            rows.append((pp.memory_info().rss, pp))
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    rows.sort(key=lambda row: row[0], reverse=True)
+
+    lines = [f"Top {SNAPSHOT_TOP_N} processes by resident memory:"]
+    for rss, pp in rows[:SNAPSHOT_TOP_N]:
+        try:
+            cmdline = " ".join(pp.cmdline())[:200]
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            cmdline = "?"
+        lines.append(f"  {pp.pid:>8}  {format_bytes(rss):>12}  {cmdline}")
+
+    if rows:
+        biggest = rows[0][1]
+        lines.append(f"Largest memory maps of process {biggest.pid}:")
+        try:
+            maps = sorted(biggest.memory_maps(), key=lambda mm: mm.rss, reverse=True)
+            for mm in maps[:SNAPSHOT_TOP_N]:
+                lines.append(f"  {format_bytes(mm.rss):>12}  {mm.path or '[anon]'}")
+        except (psutil.NoSuchProcess, psutil.AccessDenied, OSError) as err:
+            lines.append(f"  not available: {err}")
+
+    return "\n".join(lines)
+
+
+def terminate_tree(popen):
+    """Send SIGTERM to the command's process group, then SIGKILL if needed."""
+
+    # the command leads its own process group (start_new_session) and the group
+    # keeps its ID even after the leader has exited and been reaped
+    pgid = popen.pid
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+        try:
+            popen.wait(timeout=TERM_GRACE)
+        except sp.TimeoutExpired:
+            log.warning("Process did not stop after %d seconds, killing it", TERM_GRACE)
+            os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # it is already gone
+
+
+class MemoryWatcher(threading.Thread):
+    """Watch the memory used by a process tree, see the module docstring."""
+
+    def __init__(
+        self, popen, soft_limit, hard_limit, snapshot_file=None, watch_callback=None
+    ):
+        super().__init__(daemon=True)
+        self.popen = popen
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.snapshot_file = snapshot_file
+        self.watch_callback = watch_callback
+        self.peak_pss = 0
+        self.stop_reason = None
+        self._done = threading.Event()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def run(self):
+        import psutil
+
+        try:
+            proc = psutil.Process(self.popen.pid)
+        except psutil.NoSuchProcess:
+            return
+
+        warned = False
+        while not self._done.wait(POLL_INTERVAL):
+            pss, procs = get_tree_pss(proc)
+            self.peak_pss = max(self.peak_pss, pss)
+
+            if self.soft_limit and pss > self.soft_limit and not warned:
+                warned = True
+                log.warning(
+                    "BIDS App is using %s, more than mem_gb (%s)",
+                    format_bytes(pss),
+                    format_bytes(self.soft_limit),
+                )
+
+            if self.hard_limit and pss > self.hard_limit:
+                snapshot = memory_snapshot(procs)
+                log.error(
+                    "BIDS App is using %s, more than the hard limit of %s.  "
+                    "Stopping it before it is killed by the OOM killer.\n%s",
+                    format_bytes(pss),
+                    format_bytes(self.hard_limit),
+                    snapshot,
+                )
+                if self.snapshot_file:
+                    Path(self.snapshot_file).write_text(snapshot + "\n")
+                self.stop_reason = "it used too much memory"
+                terminate_tree(self.popen)
+                return
+
+            if self.watch_callback:
+                reason = self.watch_callback()
+                if reason:
+                    log.error("Stopping BIDS App because %s", reason)
+                    self.stop_reason = reason
+                    terminate_tree(self.popen)
+                    return
+
+
+def exec_supervised(
+    command,
+    environ=None,
+    shell=False,
+    soft_limit=None,
+    hard_limit=None,
+    snapshot_file=None,
+    line_callback=None,
+    watch_callback=None,
+):
+    """Run a command, printing its output as it runs, and watch its memory.
+
+    This replaces flywheel_gear_toolkit's exec_command(..., cont_output=True).
+    stderr is merged into stdout so it is seen as it happens.
+
+    Args:
+        command (list of str) command to run
+        environ (dict) environment variables for the command
+        shell (bool) run " ".join(command) in a shell
+        soft_limit (int) log a warning when the process tree uses more bytes
+        hard_limit (int) stop the process tree when it uses more bytes
+        snapshot_file (str) where to save the memory snapshot
+        line_callback (function) called with each line of output
+        watch_callback (function) called every POLL_INTERVAL seconds, if it
+            returns a reason (str) the process tree is stopped
+
+    Raises:
+        RuntimeError: if the command fails or was stopped
+    """
+
+    log.info("Executing command: \n %s \n\n", " ".join(command))
+    if soft_limit or hard_limit:
+        log.info(
+            "Memory soft limit is %s, hard limit is %s",
+            format_bytes(soft_limit or 0),
+            format_bytes(hard_limit or 0),
+        )
+
+    # the output is printed, so write what has been logged first to keep order
+    flush_logging()
+
+    run_command = " ".join(command) if shell else command
+    popen = sp.Popen(
+        run_command,
+        stdout=sp.PIPE,
+        stderr=sp.STDOUT,
+        universal_newlines=True,
+        errors="replace",  # a stray undecodable byte must not stop the gear
+        env=environ,
+        shell=shell,
+        start_new_session=True,  # so the whole tree can be stopped
+    )
+
+    watcher = MemoryWatcher(
+        popen, soft_limit, hard_limit, snapshot_file, watch_callback
+    )
+    watcher.start()
+
+    start = time.perf_counter()
+    for line in popen.stdout:
+        print(line.rstrip(), flush=True)
+        if line_callback:
+            line_callback(line)
+    returncode = popen.wait()
+    watcher.stop()
+    flush_logging()  # what the watcher logged while the output was printed
+
+    log.info("Command return code: %s", returncode)
+    log.info(
+        "Peak memory of the command: %s in %.1f seconds",
+        format_bytes(watcher.peak_pss),
+        time.perf_counter() - start,
+    )
+    set_metric(
+        "gear_app_peak_tree_pss_bytes",
+        watcher.peak_pss,
+        "Peak proportional memory (PSS) of the BIDS App's whole process tree",
+    )
+
+    if watcher.stop_reason:
+        raise RuntimeError(
+            f"The following command was stopped because {watcher.stop_reason}: "
+            f"\n{command}"
+        )
+
+    if returncode != 0:
+        raise RuntimeError("The following command has failed: \n{}".format(command))
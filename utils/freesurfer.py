@@ -1,8 +1,16 @@
 """Install Freesurfer license.txt file where algorithm expects it.
+
+Also keep a cache of completed FreeSurfer subject directories so recon-all
+does not have to be run again when the same data is re-analyzed.  Cached
+subjects are hard linked into SUBJECTS_DIR (only copied if the cache is on
+another file system) and are copied into the cache when they are harvested.
 """
 
+import gzip
+import hashlib
 import json
 import logging
+import os
 import re
 import shutil
 from pathlib import Path
@@ -60,7 +68,7 @@ def install_freesurfer_license(
             )
 
         if not Path(fs_path_only).exists():
-            Path(fs_path_only).mkdir(parents=True)
+            Path(fs_path_only).mkdir(parents=True, exist_ok=True)
             log.warning("Had to make freesurfer license path: %s", fs_license_path)
 
         shutil.copy(input_license_path, fs_license_path)
@@ -98,7 +106,7 @@ def install_freesurfer_license(
         head = Path(fs_license_path).parents[0]
 
         if not Path(head).exists():
-            Path(head).mkdir(parents=True)
+            Path(head).mkdir(parents=True, exist_ok=True)
             log.debug("Created directory %s", head)
 
         with open(fs_license_path, "w") as flp:
@@ -109,3 +117,195 @@ def install_freesurfer_license(
     else:
         msg = "Could not find FreeSurfer license anywhere"
         raise FileNotFoundError(f"{msg} ({fs_license_path}).")
+
+
+# recon-all writes this file when it finishes successfully
+RECON_ALL_DONE = "scripts/recon-all.done"
+RECON_ALL_ERROR = "scripts/recon-all.error"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_freesurfer_version(freesurfer_home):
+    """Return the FreeSurfer version found in $FREESURFER_HOME/build-stamp.txt.
+
+    Args:
+        freesurfer_home (str) path to the FreeSurfer installation
+
+    Returns:
+        version (str) contents of build-stamp.txt or "unknown" if it is missing
+    """
+
+    build_stamp = Path(freesurfer_home) / "build-stamp.txt"
+    if build_stamp.exists():
+        version = build_stamp.read_text().strip()
+    else:
+        log.warning("Could not find %s", build_stamp)
+        version = "unknown"
+    log.debug("FreeSurfer version is %s", version)
+
+    return version
+
+
+def get_subject_cache_key(bids_path, subject, fs_version):
+    """Hash the subject's T1w input files together with the FreeSurfer version.
+
+    .nii.gz files are hashed by their decompressed contents and name without
+    ".gz" so the key is the same after gear-decompress-nifti has replaced them
+    with .nii files (e.g. when the run is resumed).
+
+    Args:
+        bids_path (Path) path to BIDS formatted data (e.g. work/bids)
+        subject (str) BIDS subject directory name, e.g. "sub-TOME3024"
+        fs_version (str) version of FreeSurfer that will be run
+
+    Returns:
+        key (str) hex digest or None if the subject has no readable T1w images
+    """
+
+    t1w_files = {}
+    for t1w in (Path(bids_path) / subject).rglob("*_T1w.nii*"):
+        t1w_files[str(t1w).removesuffix(".gz")] = t1w
+    if len(t1w_files) == 0:
+        return None
+
+    sha = hashlib.sha256(fs_version.encode())
+    for name in sorted(t1w_files):
+        t1w = t1w_files[name]
+        sha.update(Path(name).name.encode())
+        opener = gzip.open if t1w.suffix == ".gz" else open
+        try:
+            with opener(t1w, "rb") as fp:
+                for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b""):
+                    sha.update(chunk)
+        except (OSError, EOFError) as err:
+            log.warning("Could not read %s: %s", t1w, err)
+            return None
+
+    return sha.hexdigest()
+
+
+def recon_all_is_done(subject_dir):
+    """Return True if recon-all completed without error in subject_dir."""
+
+    subject_dir = Path(subject_dir)
+    return (subject_dir / RECON_ALL_DONE).exists() and not (
+        subject_dir / RECON_ALL_ERROR
+    ).exists()
+
+
+def link_or_copy(src, dst):
+    """Hard link src to dst, copy it if that is not possible."""
+
+    try:
+        os.link(src, dst)
+    except OSError:  # e.g. on another file system
+        shutil.copy2(src, dst)
+
+
+def make_read_only(directory):
+    """Remove write permission from the files (not directories) in directory."""
+
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = Path(root) / name
+            if not path.is_symlink():
+                path.chmod(path.stat().st_mode & ~0o222)
+
+
+def mount_cached_subjects(cache_dir, subjects_dir, bids_path, fs_version):
+    """Link previously completed FreeSurfer subjects from the cache into SUBJECTS_DIR.
+
+    The cache is organized as <cache_dir>/<key>/<subject>/ where the key is
+    given by get_subject_cache_key().  Each cached subject's directories are
+    made in SUBJECTS_DIR and its files are hard linked so new files the BIDS
+    App writes do not go into the cache.  Subjects that are not in the cache
+    are left alone so the BIDS App will run recon-all on them as usual.
+
+    Args:
+        cache_dir (str) path to the FreeSurfer subjects cache
+        subjects_dir (Path) the SUBJECTS_DIR that the BIDS App will use
+        bids_path (Path) path to BIDS formatted data (e.g. work/bids)
+        fs_version (str) version of FreeSurfer that will be run
+
+    Returns:
+        subject_keys (dict) cache key for each subject with T1w images so that
+            newly finished subjects can be harvested later
+    """
+
+    cache_dir = Path(cache_dir)
+    subject_keys = {}
+
+    for subject_path in sorted(Path(bids_path).glob("sub-*")):
+
+        subject = subject_path.name
+        key = get_subject_cache_key(bids_path, subject, fs_version)
+        if key is None:
+            log.debug("No T1w images for %s so it cannot be cached", subject)
+            continue
+        subject_keys[subject] = key
+
+        cached = cache_dir / key / subject
+        dest = Path(subjects_dir) / subject
+        if dest.exists():
+            log.info("%s already exists, not using FreeSurfer cache", dest)
+        elif recon_all_is_done(cached):
+            log.info("Using cached FreeSurfer subject %s from %s", subject, cached)
+            shutil.copytree(cached, dest, symlinks=True, copy_function=link_or_copy)
+        else:
+            log.info("FreeSurfer subject %s is not in the cache", subject)
+
+    return subject_keys
+
+
+def harvest_subjects(cache_dir, subject_keys, search_dirs):
+    """Save newly completed FreeSurfer subjects into the cache.
+
+    Each subject is copied into a temporary directory in the cache and then
+    renamed into place so that other jobs never see a partial subject.  The
+    cached files are made read-only because mounted subjects share them.
+
+    Args:
+        cache_dir (str) path to the FreeSurfer subjects cache
+        subject_keys (dict) cache key for each subject from mount_cached_subjects()
+        search_dirs (list of Path) directories where the BIDS App might have
+            put FreeSurfer subjects, e.g. SUBJECTS_DIR and output/<id>/freesurfer
+
+    Returns:
+        harvested (list of str) subjects that were added to the cache
+    """
+
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    harvested = []
+
+    for subject, key in subject_keys.items():
+
+        cached = cache_dir / key / subject
+        if cached.exists():
+            log.debug("%s is already in the FreeSurfer cache", subject)
+            continue
+
+        for search_dir in search_dirs:
+            subject_dir = Path(search_dir) / subject
+            if not recon_all_is_done(subject_dir):
+                continue
+
+            tmp_dir = cache_dir / f".{key}.{os.getpid()}.tmp"
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir)
+            shutil.copytree(subject_dir, tmp_dir / subject, symlinks=True)
+            make_read_only(tmp_dir)
+            try:
+                os.rename(tmp_dir, cache_dir / key)
+                log.info("Saved FreeSurfer subject %s to %s", subject, cached)
+                harvested.append(subject)
+            except OSError:  # another job saved it first
+                log.info("FreeSurfer subject %s was already cached", subject)
+                shutil.rmtree(tmp_dir)
+            break
+
+        else:
+            log.debug("No completed FreeSurfer subject found for %s", subject)
+
+    return harvested
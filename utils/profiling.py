@@ -0,0 +1,246 @@
+"""Profile the Python parts of the gear: main() and each of its stages.
+
+Profiling is turned on with the gear-profile config option:
+
+    "cprofile"      cProfile statistics (.prof, open with snakeviz or pstats)
+    "pyinstrument"  pyinstrument call trees (.txt and .html), if it is installed
+    "tracemalloc"   peak Python memory and the top allocations of each stage
+
+For cprofile and pyinstrument the stacks of all threads are also sampled while
+main() runs and saved as collapsed stacks (main.collapsed) that can be turned
+into a flame graph with flamegraph.pl or speedscope.
+
+Everything is written to a scratch directory and then zipped into the output
+directory so it comes back with the job.  A stage that runs in the same thread
+as one that is already being profiled (e.g. a step in main()) is included in
+that profile instead of getting its own.
+"""
+
+import cProfile
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+from .cleanup import remove_tree
+from .fly.disk_budget import format_bytes
+from .results.zip_output import zip_output
+
+log = logging.getLogger(__name__)
+
+PROFILE_MODES = ["cprofile", "pyinstrument", "tracemalloc"]
+
+# how often to sample stacks for main.collapsed
+SAMPLE_INTERVAL = 0.005
+
+# how many allocations to list for each stage
+TOP_N = 25
+
+profile_mode = None
+profile_dir = None
+
+# stage name: peak traced memory in bytes (tracemalloc mode)
+peak_memory = {}
+
+_active = threading.local()
+
+
+def start_profiling(mode, directory=None):
+    """Turn on profiling of stages.
+
+    Args:
+        mode (str) one of PROFILE_MODES or None or "none" to not profile
+        directory (str) where to write profiles, a new temporary directory in
+            the current one by default
+
+    Returns:
+        mode (str) the mode that will be used, "cprofile" if "pyinstrument" was
+            asked for but it is not installed, or None
+    """
+
+    global profile_mode, profile_dir
+
+    if not mode or mode == "none":
+        return None
+
+    if mode not in PROFILE_MODES:
+        log.warning("Unknown gear-profile %s, not profiling", mode)
+        return None
+
+    if mode == "pyinstrument":
+        try:
+            import pyinstrument  # noqa: F401
+        except ImportError:
+            log.warning("pyinstrument is not installed, using cProfile instead")
+            mode = "cprofile"
+
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="gear-profile-", dir=os.getcwd())
+    profile_dir = Path(directory)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+
+    if mode == "tracemalloc":
+        tracemalloc.start()
+
+    profile_mode = mode
+    log.info("Profiling with %s, saving profiles in %s", mode, profile_dir)
+
+    return mode
+
+
+def stop_profiling(output_dir, name="profile"):
+    """Turn profiling off and zip the profiles into output_dir/<name>.zip.
+
+    Args:
+        output_dir (str) the gear's output directory
+        name (str) name of the zip file without ".zip"
+
+    Returns:
+        zip_file (Path) or None if profiling was not on
+    """
+
+    global profile_mode, profile_dir
+
+    if profile_mode is None:
+        return None
+
+    if profile_mode == "tracemalloc":
+        tracemalloc.stop()
+        with open(profile_dir / "peak_memory.txt", "w") as fp:
+            for stage, peak in sorted(peak_memory.items(), key=lambda kv: -kv[1]):
+                fp.write(f"{peak:14d}  {format_bytes(peak):>12}  {stage}\n")
+
+    zip_file = Path(output_dir) / f"{name}.zip"
+    zip_output(str(profile_dir.parent), profile_dir.name, str(zip_file.resolve()))
+    remove_tree(profile_dir)
+    log.info("Saved profiles in %s", zip_file)
+
+    profile_mode = None
+    profile_dir = None
+
+    return zip_file
+
+
+class StackSampler:
+    """Count the stacks of all threads every interval seconds.
+
+    Stacks are saved in the "collapsed" format used to make flame graphs:
+    one line per stack, "outer;...;inner count".
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    file_name = os.path.basename(code.co_filename)
+                    stack.append(f"{code.co_name} ({file_name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def save(self, path):
+        """Write the collapsed stacks to path."""
+
+        with open(path, "w") as fp:
+            for stack, count in sorted(self.counts.items()):
+                fp.write(f"{stack} {count}\n")
+
+
+def save_allocations(name, snapshot):
+    """Write the TOP_N places that allocated the most memory."""
+
+    with open(profile_dir / f"{name}.allocations.txt", "w") as fp:
+        fp.write(f"Peak traced memory: {format_bytes(peak_memory[name])}\n")
+        fp.write(f"Top {TOP_N} allocations still held at the end of {name}:\n")
+        for stat in snapshot.statistics("lineno")[:TOP_N]:
+            fp.write(f"{stat}\n")
+
+
+@contextmanager
+def profile_stage(name):
+    """Profile the code in this context as stage "name" if profiling is on."""
+
+    mode = profile_mode
+    if mode is None or getattr(_active, "name", None):
+        yield
+        return
+
+    _active.name = name
+    profiler = None
+    sampler = None
+    try:
+        if mode == "tracemalloc":
+            tracemalloc.reset_peak()  # shared with stages in other threads
+
+        elif mode == "cprofile":
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as err:  # another profiler is active
+                log.debug("Not profiling %s: %s", name, err)
+                profiler = None
+
+        else:
+            from pyinstrument import Profiler
+
+            profiler = Profiler(async_mode="disabled")
+            profiler.start()
+
+        if name == "main" and mode != "tracemalloc":
+            sampler = StackSampler()
+            sampler.start()
+
+        yield
+
+    finally:
+        _active.name = None
+        start = time.perf_counter()
+
+        if sampler:
+            sampler.stop()
+            sampler.save(profile_dir / f"{name}.collapsed")
+
+        if mode == "tracemalloc":
+            peak_memory[name] = tracemalloc.get_traced_memory()[1]
+            save_allocations(name, tracemalloc.take_snapshot())
+
+        elif mode == "cprofile" and profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_dir / f"{name}.prof")
+
+        elif mode == "pyinstrument":
+            profiler.stop()
+            with open(profile_dir / f"{name}.txt", "w") as fp:
+                fp.write(profiler.output_text())
+            with open(profile_dir / f"{name}.html", "w") as fp:
+                fp.write(profiler.output_html())
+
+        log.debug(
+            "Saved %s profile of %s in %.2f seconds",
+            mode,
+            name,
+            time.perf_counter() - start,
+        )
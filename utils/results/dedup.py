@@ -0,0 +1,135 @@
+"""Leave files out of output archives that previous analyses already saved.
+
+Templates, transforms and boilerplate reports are often identical across
+sessions and analyses.  A content index (a directory shared between jobs, like
+the FreeSurfer subjects cache) holds one JSON file per analysis that lists
+what was archived with its size and hash.  Files found there are not archived
+again: a pointer to the previous analysis' archive is put in manifest.json
+instead.
+
+Only files whose size matches something in the index are hashed before they
+are archived so most files are still read only once.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+from ..fly.disk_budget import format_bytes
+from .hashing import MANIFEST_HASH, hash_file
+
+log = logging.getLogger(__name__)
+
+# Smaller files are always archived, a pointer would not save much
+DEDUP_MIN_BYTES = 64 * 1024
+
+INDEX_SUFFIX = ".json"
+
+
+def load_content_index(index_dir, exclude_analysis=None):
+    """Read what previous analyses archived.
+
+    Args:
+        index_dir (str) directory holding <analysis id>.json files
+        exclude_analysis (str) ID of an analysis to ignore, e.g. this one if it
+            is being run again
+
+    Returns:
+        content_index (dict) size: {hash: pointer} where pointer (dict) has the
+            "analysis" ID, "archive" name and "path" in the archive
+    """
+
+    content_index = {}
+    num_files = 0
+    for index_file in sorted(Path(index_dir).glob("*" + INDEX_SUFFIX)):
+        if index_file.name == f"{exclude_analysis}{INDEX_SUFFIX}":
+            continue
+        try:
+            with open(index_file) as fp:
+                analysis = json.load(fp)
+        except (OSError, ValueError) as err:
+            log.warning("Could not read content index %s: %s", index_file, err)
+            continue
+        for archive, members in analysis["archives"].items():
+            for member in members:
+                pointer = {
+                    "analysis": analysis["analysis"],
+                    "archive": archive,
+                    "path": member["path"],
+                }
+                by_hash = content_index.setdefault(member["size"], {})
+                by_hash.setdefault(member[MANIFEST_HASH], pointer)
+                num_files += 1
+
+    log.info("Content index in %s lists %d files", index_dir, num_files)
+
+    return content_index
+
+
+def deduplicate_entries(entries, content_index, min_bytes=DEDUP_MIN_BYTES):
+    """Take out entries that are already in the content index.
+
+    Args:
+        entries (list) (path, arc_path, size) from list_archive_entries()
+        content_index (dict) from load_content_index()
+        min_bytes (int) smaller files are kept
+
+    Returns:
+        tuple: Two values:
+
+            * entries (list): the entries that need to be archived
+
+            * pointers (list of dict): manifest members for the files that were
+              taken out with "stored_in" telling where they can be found
+    """
+
+    kept = []
+    pointers = []
+    for fl_path, arc_path, size in entries:
+        if size and size >= min_bytes and size in content_index:
+            digest = hash_file(fl_path)
+            if digest in content_index[size]:
+                pointers.append(
+                    {
+                        "path": arc_path,
+                        "size": size,
+                        MANIFEST_HASH: digest,
+                        "stored_in": content_index[size][digest],
+                    }
+                )
+                continue
+        kept.append((fl_path, arc_path, size))
+
+    if pointers:
+        log.info(
+            "Not archiving %d files (%s) that previous analyses saved",
+            len(pointers),
+            format_bytes(sum(pointer["size"] for pointer in pointers)),
+        )
+
+    return kept, pointers
+
+
+def save_to_content_index(index_dir, destination_id, manifest):
+    """Add what this analysis archived to the content index.
+
+    Args:
+        index_dir (str) directory holding <analysis id>.json files
+        destination_id (str) ID of this analysis
+        manifest (dict) archive name: list of members (pointers are skipped)
+    """
+
+    archives = {
+        archive: [member for member in members if "stored_in" not in member]
+        for archive, members in manifest.items()
+    }
+
+    Path(index_dir).mkdir(parents=True, exist_ok=True)
+    index_file = Path(index_dir) / (destination_id + INDEX_SUFFIX)
+    tmp_file = Path(index_dir) / f".{destination_id}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as fp:
+        json.dump({"analysis": destination_id, "archives": archives}, fp)
+    os.rename(tmp_file, index_file)  # atomic so readers never see half of it
+
+    log.info("Saved archive contents to content index %s", index_file)
@@ -0,0 +1,28 @@
+"""Content hashes used in the output manifest and the content index."""
+
+import hashlib
+
+# Files are read, hashed and compressed this many bytes at a time
+CHUNK_SIZE = 1024 * 1024
+
+# Fast hash that is always computed, SHA-256 can be added
+MANIFEST_HASH = "blake2b"
+
+
+def new_hashers(sha256=False):
+    """Return {name: hashlib object} for the hashes to compute."""
+
+    hashers = {MANIFEST_HASH: hashlib.blake2b()}
+    if sha256:
+        hashers["sha256"] = hashlib.sha256()
+    return hashers
+
+
+def hash_file(path):
+    """Return the MANIFEST_HASH hex digest of a file."""
+
+    hasher = new_hashers()[MANIFEST_HASH]
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
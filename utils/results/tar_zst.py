@@ -0,0 +1,198 @@
+"""Write and read Zstandard compressed tar archives with an index.
+
+Compressing with zip is slow and uses one CPU.  Here the tar archive is
+written as one Zstandard stream by one compressor using several threads.  The
+stream is cut into frames of about FRAME_BYTES, always between members, and
+because concatenated frames decompress to one stream the result is a normal
+.tar.zst file:
+
+    tar --use-compress-program=unzstd -xf archive.tar.zst
+
+An index (archive.tar.zst.index.json) lists each member with the offset and
+length of the frame holding it and where it starts in that frame (skip) so a
+single file can be extracted by decompressing only its frame, see
+extract_member().
+
+zstandard is only needed when this format is used.
+"""
+
+import io
+import json
+import logging
+import os
+import shutil
+import tarfile
+
+from .zip_output import (
+    PARTIAL_SUFFIX,
+    check_can_delete,
+    commit_archive,
+    delete_archived,
+)
+
+log = logging.getLogger(__name__)
+
+TAR_ZST_SUFFIX = ".tar.zst"
+INDEX_SUFFIX = ".index.json"
+
+COMPRESSION_LEVEL = 3
+# Uncompressed bytes after which a frame is ended at the next member
+FRAME_BYTES = 32 * 1024 * 1024
+COPY_BUFSIZE = 1024 * 1024
+
+
+def have_zstandard():
+    """Return True if the zstandard package can be imported."""
+
+    try:
+        import zstandard  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def write_member(writer, tar, fl_path, arc_path):
+    """Write one file or directory as a tar member.
+
+    Args:
+        writer (zstandard.ZstdCompressionWriter) the compressed stream
+        tar (tarfile.TarFile) used only to create the tar header
+        fl_path (str) path to the file, directory or symbolic link
+        arc_path (str) name in the archive
+
+    Returns:
+        member (dict) name, type and size
+        written (int) uncompressed bytes written
+    """
+
+    tarinfo = tar.gettarinfo(fl_path, arc_path)
+    if tarinfo.isdir() and not tarinfo.name.endswith("/"):
+        tarinfo.name += "/"
+
+    header = tarinfo.tobuf(tarfile.PAX_FORMAT)
+    writer.write(header)
+    written = len(header)
+    if tarinfo.isreg():
+        with open(fl_path, "rb") as fp:
+            shutil.copyfileobj(fp, writer, COPY_BUFSIZE)
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder:
+            writer.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        written += blocks * tarfile.BLOCKSIZE
+
+    member = {
+        "name": tarinfo.name,
+        "type": "dir" if tarinfo.isdir() else "link" if tarinfo.issym() else "file",
+        "size": tarinfo.size,
+    }
+    return member, written
+
+
+def write_tar_zst(output_filename, entries, threads=0, delete_source=False):
+    """Write entries to a .tar.zst archive and its index.
+
+    Symbolic links are stored as links (they are not followed).
+
+    Args:
+        output_filename (str) path of the archive, should end in ".tar.zst"
+        entries (list) (path, arc_path, size) of each file and directory as
+            returned by zip_output.list_archive_entries().  size is None for
+            directories.
+        threads (int) compression threads, 0 for none, -1 for one per CPU
+        delete_source (boolean) delete files once the archive is complete and
+            safely on disk
+
+    Returns:
+        index_filename (str) path of the index
+    """
+
+    import zstandard
+
+    if delete_source:
+        check_can_delete(output_filename)
+
+    cctx = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, threads=threads)
+    tar = tarfile.TarFile(fileobj=io.BytesIO(), mode="w")
+    members = []
+    archived = []
+
+    partial_filename = f"{output_filename}{PARTIAL_SUFFIX}"
+    with open(partial_filename, "wb") as out:
+        frame = []  # members in the frame being written
+        frame_offset = 0
+        frame_bytes = 0
+
+        def end_frame():
+            for member in frame:
+                member["length"] = out.tell() - frame_offset
+            frame.clear()
+
+        with cctx.stream_writer(out, closefd=False) as writer:
+            for fl_path, arc_path, size in entries:
+                member, written = write_member(writer, tar, fl_path, arc_path)
+                member["offset"] = frame_offset
+                member["skip"] = frame_bytes
+                members.append(member)
+                frame.append(member)
+                frame_bytes += written
+
+                if frame_bytes >= FRAME_BYTES:
+                    writer.flush(zstandard.FLUSH_FRAME)
+                    end_frame()
+                    frame_offset = out.tell()
+                    frame_bytes = 0
+
+                if delete_source and size is not None:
+                    archived.append(fl_path)
+
+            # end of archive marker, two empty blocks
+            writer.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+        end_frame()
+
+    commit_archive(partial_filename, output_filename)
+
+    index_filename = output_filename + INDEX_SUFFIX
+    index = {"archive": os.path.basename(output_filename), "members": members}
+    with open(index_filename, "w") as fp:
+        json.dump(index, fp)
+
+    log.info("Wrote %d members to %s", len(members), output_filename)
+
+    if delete_source:
+        delete_archived(archived)
+
+    return index_filename
+
+
+def extract_member(archive, name, dest_dir, index_filename=None):
+    """Extract one member of a .tar.zst archive using its index.
+
+    Args:
+        archive (str) path to the archive
+        name (str) name of the member in the archive
+        dest_dir (str) where to extract it
+        index_filename (str) path to the index, defaults to archive + INDEX_SUFFIX
+
+    Raises:
+        KeyError: if the member is not in the index
+    """
+
+    import zstandard
+
+    if index_filename is None:
+        index_filename = str(archive) + INDEX_SUFFIX
+
+    with open(index_filename) as fp:
+        members = {member["name"]: member for member in json.load(fp)["members"]}
+
+    member = members[name]
+    with open(archive, "rb") as fp:
+        fp.seek(member["offset"])
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            fp, read_across_frames=False
+        )
+        reader.seek(member.get("skip", 0))  # older indexes have a frame per member
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            # "data" refuses absolute paths, ".." and links out of dest_dir
+            tar.extract(tar.next(), dest_dir, filter="data")
@@ -1,20 +1,33 @@
 """Compress HTML files."""
 
-import datetime
 import glob
 import logging
 import os
-import subprocess as sp
-from pathlib import Path
 
-FWV0 = Path.cwd()
+from .zip_output import write_archive
+
 log = logging.getLogger(__name__)
 
 
-def zip_it_zip_it_good(output_dir, destination_id, name):
+def zip_it_zip_it_good(
+    output_dir, destination_id, name, html_path=None, manifest=None, sha256=False
+):
     """Compress html file into an appropriately named archive file *.html.zip
     files are automatically shown in another tab in the browser. These are
-    saved at the top level of the output folder."""
+    saved at the top level of the output folder.
+
+    The file is stored in the archive as "index.html" so it does not need to be
+    renamed (and the current working directory is never changed) which allows
+    this to run at the same time as other packaging steps.
+
+    Args:
+        output_dir (str) where to save the archive
+        destination_id (str) ID of the destination analysis container
+        name (str) name of the html file, used to name the archive
+        html_path (str) path to the html file, defaults to name
+        manifest (dict) if given, the archive's size and hashes are added to it
+        sha256 (bool) add a SHA-256 hash to the manifest
+    """
 
     name_no_html = name[:-5]  # remove ".html" from end
 
@@ -24,15 +37,16 @@ def zip_it_zip_it_good(output_dir, destination_id, name):
 
     log.info('Creating viewable archive "' + dest_zip + '"')
 
-    command = ["zip", "-q", dest_zip, "index.html"]
-    result = sp.run(command, check=True)
+    html_path = html_path or name
+    entries = [(html_path, "index.html", os.path.getsize(html_path))]
+    write_archive(dest_zip, entries, manifest=manifest, sha256=sha256)
 
 
-def zip_htmls(output_dir, destination_id, path):
+def zip_htmls(output_dir, destination_id, path, manifest=None, sha256=False):
     """Zip all .html files at the given path so they can be displayed
     on the Flywheel platform.
-    Each html file must be converted into an archive individually:
-      rename each to be "index.html", then create a zip archive from it.
+    Each html file must be converted into an archive individually as
+    "index.html".  If manifest is given, the archives are added to it.
     """
 
     log.info("Creating viewable archives for all html files")
@@ -41,33 +55,17 @@ def zip_htmls(output_dir, destination_id, path):
 
         log.info("Found path: " + str(path))
 
-        os.chdir(path)
-
-        html_files = glob.glob("*.html")
+        html_files = sorted(glob.glob(os.path.join(path, "*.html")))
 
         if len(html_files) > 0:
 
-            # if there is an index.html, do it first and re-name it for safe
-            # keeping
-            save_name = ""
-            if os.path.exists("index.html"):
-                log.info("Found index.html")
-                zip_it_zip_it_good(output_dir, destination_id, "index.html")
-
-                now = datetime.datetime.now()
-                save_name = now.strftime("%Y-%m-%d_%H-%M-%S") + "_index.html"
-                os.rename("index.html", save_name)
-
-                html_files.remove("index.html")  # don't do this one later
-
             for h_file in html_files:
-                os.rename(h_file, "index.html")
-                zip_it_zip_it_good(output_dir, destination_id, h_file)
-                os.rename("index.html", h_file)
-
-            # reestore if necessary
-            if save_name != "":
-                os.rename(save_name, "index.html")
+                name = os.path.basename(h_file)
+                if name == "index.html":
+                    log.info("Found index.html")
+                zip_it_zip_it_good(
+                    output_dir, destination_id, name, h_file, manifest, sha256
+                )
 
         else:
             log.warning("No *.html files at " + str(path))
@@ -75,5 +73,3 @@ def zip_htmls(output_dir, destination_id, path):
     else:
 
         log.error("Path NOT found: " + str(path))
-
-    os.chdir(FWV0)
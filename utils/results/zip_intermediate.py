@@ -2,15 +2,56 @@
 
 import logging
 import os
-import shutil
 from pathlib import Path
-from zipfile import ZIP_DEFLATED, ZipFile
 
-FWV0 = Path.cwd()
+from ..fly.queued_logging import LimitedLog
+from .tar_zst import TAR_ZST_SUFFIX, have_zstandard, write_tar_zst
+from .zip_output import (
+    list_archive_entries,
+    remove_empty_dirs,
+    write_archive,
+    zip_output,
+)
+
 log = logging.getLogger(__name__)
 
+ARCHIVE_FORMATS = ["zip", "tar.zst"]
+
+
+def check_archive_format(archive_format):
+    """Return archive_format or "zip" if it is "tar.zst" but zstandard is missing."""
+
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format {archive_format}")
+
+    if archive_format == "tar.zst" and not have_zstandard():
+        log.warning("zstandard is not installed so a zip archive will be made")
+        archive_format = "zip"
+
+    return archive_format
 
-def zip_selected(root_dir, dir_name, output_filename, selected_files, selected_dirs):
+
+def write_intermediate(
+    output_filename, entries, archive_format, threads, delete_source
+):
+    """Write entries to a zip or tar.zst archive."""
+
+    if archive_format == "tar.zst":
+        write_tar_zst(output_filename, entries, threads, delete_source)
+    else:
+        write_archive(output_filename, entries, delete_source)
+
+
+def zip_selected(
+    root_dir,
+    dir_name,
+    output_filename,
+    selected_files,
+    selected_dirs,
+    delete_source=False,
+    archive_format="zip",
+    threads=0,
+):
     """Zip selected files and directories into output_filename.
 
     The resulting zip file will unzip into directory dir_name and will maintain the
@@ -29,36 +70,41 @@ def zip_selected(root_dir, dir_name, output_filename, selected_files, selected_d
         output_filename (Path) path and name of zip file to save
         selected_files (list) file names or partial paths to files
         selected_dirs (list) dir names or partial paths to dirs
+        delete_source (bool) delete the selected files once the archive is complete
+        archive_format (str) "zip" or "tar.zst"
+        threads (int) compression threads for "tar.zst"
     """
 
-    os.chdir(root_dir)
-
-    if Path(output_filename).exists():
-        Path(output_filename).unlink()
-
     files_found = []
     dirs_found = []
-    with ZipFile(output_filename, "w", ZIP_DEFLATED) as outzip:
-        for root, subdirs, files in os.walk(dir_name):
-            for fl in files:
-                matched = False
-                file_path = Path(root) / fl
-                if fl in selected_files:
-                    matched = True
-                    files_found.append(fl)
-                else:
-                    for sel in selected_files:
-                        if file_path.match(sel):
-                            matched = True
-                            files_found.append(sel)
-                if not matched:
-                    for sel in selected_dirs:
-                        if Path(root).match(sel):
-                            dirs_found.append(sel)
-                            matched = True
-                if matched:
-                    log.info("Zipping %s", file_path)
-                    outzip.write(file_path)
+    entries = []
+    zipping = LimitedLog(log, "Zipping %s")
+    for root, subdirs, files in os.walk(Path(root_dir) / dir_name):
+        # match and archive paths relative to root_dir (starting with dir_name)
+        rel_root = Path(os.path.relpath(root, root_dir))
+        for fl in files:
+            matched = False
+            file_path = rel_root / fl
+            if fl in selected_files:
+                matched = True
+                files_found.append(fl)
+            else:
+                for sel in selected_files:
+                    if file_path.match(sel):
+                        matched = True
+                        files_found.append(sel)
+            if not matched:
+                for sel in selected_dirs:
+                    if rel_root.match(sel):
+                        dirs_found.append(sel)
+                        matched = True
+            if matched:
+                zipping.log(file_path)
+                size = os.lstat(Path(root) / fl).st_size
+                entries.append((str(Path(root) / fl), str(file_path), size))
+    zipping.summary()
+
+    write_intermediate(output_filename, entries, archive_format, threads, delete_source)
 
     for sel in selected_files:
         if sel not in files_found:
@@ -67,8 +113,6 @@ def zip_selected(root_dir, dir_name, output_filename, selected_files, selected_d
         if sel not in dirs_found:
             log.warning("Looked for %s but could not find it.", sel)
 
-    os.chdir(FWV0)  # Get back to where you once belonged
-
 
 def zip_intermediate_selected(
     gear_intermediate_files,
@@ -78,6 +122,9 @@ def zip_intermediate_selected(
     output_dir,
     work_dir,
     run_label,
+    delete_source=False,
+    archive_format="zip",
+    threads=0,
 ):
     """Zip the listed files and folders in work/.
 
@@ -89,6 +136,10 @@ def zip_intermediate_selected(
         output_dir (str) path to where output will be written
         work_dir (str) path to temporary directory
         run_label (str) name of run to use in zip file name
+        delete_source (bool) delete files from work/ once they have been archived
+        archive_format (str) "zip" or "tar.zst" (a zip file is made if the
+            zstandard package is not installed)
+        threads (int) compression threads for "tar.zst", -1 for one per CPU
     """
 
     do_find = False
@@ -109,18 +160,36 @@ def zip_intermediate_selected(
     if do_find:
 
         # Name of zip file has <subject> and <analysis>
-        file_name = f"{gear_name}_work_selected_{run_label}_{destination_id}.zip"
+        archive_format = check_archive_format(archive_format)
+        file_name = f"{gear_name}_work_selected_{run_label}_{destination_id}"
+        file_name += TAR_ZST_SUFFIX if archive_format == "tar.zst" else ".zip"
         dest_zip = os.path.join(output_dir, file_name)
 
         log.info('Files and folders will be zipped to "' + dest_zip + '"')
-        zip_selected(work_dir.parents[0], work_dir.name, dest_zip, files, folders)
+        zip_selected(
+            work_dir.parents[0],
+            work_dir.name,
+            dest_zip,
+            files,
+            folders,
+            delete_source=delete_source,
+            archive_format=archive_format,
+            threads=threads,
+        )
 
     else:
         log.debug("No files or folders specified in config to zip")
 
 
 def zip_all_intermediate_output(
-    destination_id, gear_name, output_dir, work_dir, run_label
+    destination_id,
+    gear_name,
+    output_dir,
+    work_dir,
+    run_label,
+    delete_source=False,
+    archive_format="zip",
+    threads=0,
 ):
     """Zip all intermediate output in the "work/ directory into one archive.
 
@@ -130,17 +199,28 @@ def zip_all_intermediate_output(
         output_dir (str) path to where output will be written
         work_dir (str) path to temporary directory
         run_label (str) name of run to use in zip file name
+        delete_source (bool) delete files from work/ once they have been archived
+        archive_format (str) "zip" or "tar.zst" (a zip file is made if the
+            zstandard package is not installed)
+        threads (int) compression threads for "tar.zst", -1 for one per CPU
     """
 
     # Name of zip file has <subject> and <analysis>
+    archive_format = check_archive_format(archive_format)
     file_name = f"{gear_name}_work_{run_label}_{destination_id}"
+    file_name += TAR_ZST_SUFFIX if archive_format == "tar.zst" else ".zip"
     dest_zip = os.path.join(output_dir, file_name)
 
     work_path, work_dir = os.path.split(work_dir)
-    os.chdir(work_path)
 
     log.info("Zipping " + work_dir + " directory to " + dest_zip + ".")
 
-    shutil.make_archive(dest_zip, "zip", work_path, work_dir)
-
-    os.chdir(FWV0)
+    if archive_format == "tar.zst":
+        entries, _, _ = list_archive_entries(work_path, work_dir)
+        write_tar_zst(os.path.abspath(dest_zip), entries, threads, delete_source)
+        if delete_source:
+            remove_empty_dirs(os.path.join(work_path, work_dir))
+    else:
+        zip_output(
+            work_path, work_dir, os.path.abspath(dest_zip), delete_source=delete_source
+        )
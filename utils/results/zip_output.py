@@ -0,0 +1,373 @@
+"""Zip output, optionally deleting files as soon as they have been archived.
+
+While each file is compressed its content is also hashed so a manifest of the
+archive (path, size, hash and compression ratio of each member) can be saved
+without reading the output a second time.
+"""
+
+import json
+import logging
+import os
+from pathlib import PurePath
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+from ..fly.disk_budget import format_bytes, inventory_dir
+from .dedup import deduplicate_entries
+from .hashing import CHUNK_SIZE, MANIFEST_HASH, new_hashers
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+# Archives are written under this suffix and renamed when they are complete
+PARTIAL_SUFFIX = ".part"
+
+
+def commit_archive(partial_filename, output_filename):
+    """Make sure a finished archive is on disk, then give it its real name.
+
+    Args:
+        partial_filename (str) the closed archive, written under a temporary name
+        output_filename (str) its final name
+    """
+
+    with open(partial_filename, "rb") as fp:
+        os.fsync(fp.fileno())
+    os.replace(partial_filename, output_filename)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(output_filename)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)  # the rename itself
+    finally:
+        os.close(dir_fd)
+
+
+def check_can_delete(output_filename):
+    """Refuse to write an archive whose sources an earlier run may have deleted.
+
+    Sources are only deleted after their archive is complete so if the archive
+    exists, an earlier (interrupted) run may have deleted some of them and
+    writing it again would lose them.
+
+    Raises:
+        FileExistsError: if output_filename exists
+    """
+
+    if os.path.exists(output_filename):
+        raise FileExistsError(
+            f"{output_filename} already exists and the files it holds may have been "
+            "deleted when it was written.  Not writing it again from what is left.  "
+            "Check it and remove it (or restore its files) before running again."
+        )
+
+
+def delete_archived(archived):
+    """Delete files (or symlinks) that are safely in a complete archive."""
+
+    for path in archived:
+        os.remove(path)
+
+
+def remove_empty_dirs(path):
+    """Remove path and all directories under it that are (now) empty."""
+
+    for root, _, _ in os.walk(path, topdown=False):
+        try:
+            os.rmdir(root)
+        except OSError:  # not empty, something was not archived
+            pass
+
+
+def is_excluded(rel_path, size, exclude_patterns, exclude_larger_than):
+    """Decide if a file or directory should be left out of an archive.
+
+    Args:
+        rel_path (str) path relative to the directory being archived
+        size (int) size in bytes or None for directories
+        exclude_patterns (list of str) glob patterns matched against the end of
+            rel_path, e.g. "freesurfer/fsaverage*"
+        exclude_larger_than (int) files bigger than this many bytes are excluded
+
+    Returns:
+        excluded (bool)
+    """
+
+    if any(PurePath(rel_path).match(pattern) for pattern in exclude_patterns):
+        return True
+
+    if exclude_larger_than and size is not None and size > exclude_larger_than:
+        return True
+
+    return False
+
+
+def list_archive_entries(
+    root_dir,
+    source_dir,
+    exclude_files=None,
+    exclude_patterns=None,
+    exclude_larger_than=None,
+):
+    """Find what to put in an archive of <root_dir>/<source_dir>.
+
+    Symbolic links are matched by their own name and are never followed into so
+    a linked directory is skipped without looking at what it points to.
+
+    Args:
+        root_dir (str) The root directory to zip relative to.
+        source_dir (str) subdirectory (of <root_dir>) to zip.
+        exclude_files (list) paths that start with source_dir to exclude
+        exclude_patterns (list of str) glob patterns for files and directories
+            to exclude, matched against the end of their path relative to
+            <root_dir>/<source_dir>, e.g. "freesurfer/fsaverage*"
+        exclude_larger_than (int) exclude files bigger than this many bytes
+
+    Returns:
+        tuple: Three values:
+
+            * entries (list): (path, arc_path, size) for each file and directory
+              to archive in the order they are found.  size is None for
+              directories (but not for symbolic links to directories).
+
+            * skipped (int): number of files and directories excluded
+
+            * skipped_bytes (int): size of everything that was excluded
+    """
+
+    if not exclude_files:
+        exclude_files = []
+
+    if not exclude_patterns:
+        exclude_patterns = []
+
+    source_path = os.path.join(root_dir, source_dir)
+    entries = []
+    skipped = 0
+    skipped_bytes = 0
+    for root, subdirs, files in os.walk(source_path):
+        for fl in files + subdirs:
+            fl_path = os.path.join(root, fl)
+            arc_path = os.path.relpath(fl_path, root_dir)
+            # only if the file is not to be excluded from output
+            if arc_path in exclude_files:
+                continue
+
+            is_link = os.path.islink(fl_path)
+            is_dir = fl in subdirs and not is_link
+            if is_dir:
+                size = None
+            elif is_link and os.path.isdir(fl_path):
+                size = 0  # it will only be a directory entry
+            elif os.path.exists(fl_path):  # size of the file links point to
+                size = os.stat(fl_path).st_size
+            else:
+                size = os.lstat(fl_path).st_size
+            rel_path = os.path.relpath(fl_path, source_path)
+            if is_excluded(rel_path, size, exclude_patterns, exclude_larger_than):
+                if is_dir:
+                    subdirs.remove(fl)  # don't walk into it
+                    size = inventory_dir(fl_path)[0]
+                log.debug("Excluding %s (%s)", arc_path, format_bytes(size))
+                skipped += 1
+                skipped_bytes += size
+                continue
+
+            entries.append((fl_path, arc_path, size))
+
+    return entries, skipped, skipped_bytes
+
+
+def write_hashed(outzip, fl_path, arc_path, sha256=False):
+    """Compress a file into an open zip archive and hash it in the same pass.
+
+    Args:
+        outzip (ZipFile) open zip archive
+        fl_path (str) the file to add (symbolic links are followed)
+        arc_path (str) its name in the archive
+        sha256 (bool) also compute a SHA-256 hash
+
+    Returns:
+        member (dict) path, size, compressed_size, ratio and hashes
+    """
+
+    zinfo = ZipInfo.from_file(fl_path, arc_path)
+    zinfo.compress_type = ZIP_DEFLATED
+
+    hashes = new_hashers(sha256)
+
+    with open(fl_path, "rb") as src, outzip.open(zinfo, "w") as dest:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            for hasher in hashes.values():
+                hasher.update(chunk)
+            dest.write(chunk)
+
+    member = {
+        "path": arc_path,
+        "size": zinfo.file_size,
+        "compressed_size": zinfo.compress_size,
+        "ratio": round(zinfo.compress_size / zinfo.file_size, 4)
+        if zinfo.file_size
+        else 1.0,
+    }
+    for name, hasher in hashes.items():
+        member[name] = hasher.hexdigest()
+
+    return member
+
+
+def write_archive(
+    output_zip_filename, entries, delete_source=False, manifest=None, sha256=False
+):
+    """Write entries found by list_archive_entries() to a zip file.
+
+    The zip file is written under a temporary name and renamed when it is
+    complete so an interrupted run never leaves a partial archive behind.
+
+    Args:
+        output_zip_filename (str) path of the zip file to create
+        entries (list) (path, arc_path, size) of each file and directory
+        delete_source (boolean) delete files (not directories) once the archive
+            is complete and on disk
+        manifest (dict) if given, a list of the files in the archive with their
+            sizes and hashes is saved here using the archive's name as the key
+        sha256 (bool) add SHA-256 hashes to the manifest
+
+    Raises:
+        FileExistsError: if delete_source is set and the archive already exists
+    """
+
+    if delete_source:
+        check_can_delete(output_zip_filename)
+
+    partial_filename = f"{output_zip_filename}{PARTIAL_SUFFIX}"
+    members = []
+    archived = []
+    with ZipFile(partial_filename, "w", ZIP_DEFLATED) as outzip:
+        for fl_path, arc_path, size in entries:
+            if os.path.isdir(fl_path):
+                outzip.write(fl_path, arc_path)
+            else:
+                members.append(write_hashed(outzip, fl_path, arc_path, sha256))
+
+            if delete_source and size is not None:
+                archived.append(fl_path)
+
+    commit_archive(partial_filename, output_zip_filename)
+
+    if manifest is not None:
+        manifest[os.path.basename(output_zip_filename)] = members
+
+    if delete_source:
+        delete_archived(archived)
+
+
+def write_manifest(output_dir, manifest, sha256=False):
+    """Save the manifest of all archives as output_dir/manifest.json.
+
+    Args:
+        output_dir (str) where to save it
+        manifest (dict) archive name: list of members filled in by write_archive()
+        sha256 (bool) SHA-256 hashes were computed
+    """
+
+    manifest_file = os.path.join(output_dir, MANIFEST_NAME)
+    hashes = [MANIFEST_HASH, "sha256"] if sha256 else [MANIFEST_HASH]
+    with open(manifest_file, "w") as fp:
+        json.dump({"hashes": hashes, "archives": manifest}, fp, indent=1)
+
+    num_members = sum(len(members) for members in manifest.values())
+    log.info("Wrote %s listing %d archived files", manifest_file, num_members)
+
+
+def log_skipped(skipped, skipped_bytes, output_zip_filename):
+    """Log how much was excluded from an archive."""
+
+    if skipped:
+        log.info(
+            "Excluded %d files or directories (%s) from %s",
+            skipped,
+            format_bytes(skipped_bytes),
+            output_zip_filename,
+        )
+
+
+def zip_output(
+    root_dir,
+    source_dir,
+    output_zip_filename,
+    dry_run=False,
+    exclude_files=None,
+    delete_source=False,
+    exclude_patterns=None,
+    exclude_larger_than=None,
+    manifest=None,
+    sha256=False,
+    content_index=None,
+):
+    """Zip an output directory.
+
+    Zips <root_dir>/<source_dir> so that it will unzip into <source_dir>.  This
+    is a drop-in replacement for flywheel_gear_toolkit.utils.zip_tools.zip_output
+    that does not change the current working directory and that can delete the
+    archived files as soon as the archive is complete and safely on disk.  To
+    keep the output from existing twice on disk, split it into parts (see
+    zip_parts.py) so each part's files are deleted when that part is done.
+
+    Files and directories can also be left out by glob pattern or size, e.g. to
+    skip reference data like FreeSurfer's fsaverage subjects.  Nothing that is
+    excluded is deleted.
+
+    Args:
+        root_dir (str) The root directory to zip relative to.
+        source_dir (str) subdirectory (of <root_dir>) to zip.
+        output_zip_filename (str) path of the resulting zip file, relative to
+            root_dir if it is not absolute.
+        dry_run (boolean) only log what would be done
+        exclude_files (list) Files in <root_dir>/<source_dir> to exclude from the
+            zip file, given as paths that start with source_dir
+        delete_source (boolean) delete files once the archive is complete and then
+            remove directories that are left empty
+        exclude_patterns (list of str) glob patterns for files and directories
+            to exclude, matched against the end of their path relative to
+            <root_dir>/<source_dir>, e.g. "freesurfer/fsaverage*"
+        exclude_larger_than (int) exclude files bigger than this many bytes
+        manifest (dict) if given, the archive's members, sizes and hashes are
+            added to it, see write_archive()
+        sha256 (bool) add SHA-256 hashes to the manifest
+        content_index (dict) files in this index of what previous analyses
+            archived are not archived again, a pointer to where they are is put
+            in the manifest instead, see dedup.load_content_index()
+
+    Returns:
+        skipped_bytes (int) size of everything that was excluded
+
+    Raises:
+        FileNotFoundError: If `root_dir` does not exist.
+    """
+
+    if not os.path.exists(root_dir):
+        raise FileNotFoundError(f"The directory, {root_dir}, does not exist.")
+
+    output_zip_filename = os.path.join(root_dir, output_zip_filename)
+
+    log.info("Zipping output file %s", output_zip_filename)
+    if delete_source:
+        log.info("Deleting files in %s as they are archived", source_dir)
+
+    if dry_run:
+        return 0
+
+    entries, skipped, skipped_bytes = list_archive_entries(
+        root_dir, source_dir, exclude_files, exclude_patterns, exclude_larger_than
+    )
+    pointers = []
+    if content_index:
+        entries, pointers = deduplicate_entries(entries, content_index)
+    write_archive(output_zip_filename, entries, delete_source, manifest, sha256)
+    if manifest is not None:
+        manifest[os.path.basename(output_zip_filename)] += pointers
+    log_skipped(skipped, skipped_bytes, output_zip_filename)
+
+    if delete_source:
+        remove_empty_dirs(os.path.join(root_dir, source_dir))
+
+    return skipped_bytes
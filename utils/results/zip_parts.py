@@ -0,0 +1,219 @@
+"""Split output into several archives and pass very large files through as is.
+
+One archive of a project level run can be tens of GB which is slow to upload
+and to download again.  Here output is split into numbered parts, each holding
+whole subjects, that are no bigger than a given size (unless a single subject
+is bigger) and that can be written (and uploaded) in parallel.  Files over a
+threshold are not compressed again but are moved to the top of the output
+directory.
+"""
+
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from ..fly.disk_budget import format_bytes
+from .dedup import deduplicate_entries
+from .zip_output import (
+    check_can_delete,
+    list_archive_entries,
+    log_skipped,
+    remove_empty_dirs,
+    write_archive,
+)
+
+log = logging.getLogger(__name__)
+
+SUBJECT_RE = re.compile(r"sub-[a-zA-Z0-9]+")
+
+# Output that does not belong to a subject, e.g. dataset_description.json
+COMMON_GROUP = "common"
+
+
+def get_group(arc_path):
+    """Return the subject (e.g. "sub-01") an archive path belongs to."""
+
+    match = SUBJECT_RE.search(arc_path)
+    if match:
+        return match.group()
+    return COMMON_GROUP
+
+
+def plan_parts(entries, max_part_bytes):
+    """Put entries in parts so each subject is in one part.
+
+    Args:
+        entries (list) (path, arc_path, size) from list_archive_entries()
+        max_part_bytes (int) the most (uncompressed) bytes per part or 0 for
+            no limit.  A subject that is bigger than this gets a part to itself.
+
+    Returns:
+        parts (list of dict) "groups": subjects in the part and "entries"
+    """
+
+    groups = {}
+    for entry in entries:
+        groups.setdefault(get_group(entry[1]), []).append(entry)
+
+    parts = []
+    part_bytes = 0
+    # common output first, then subjects in order
+    for group in sorted(groups, key=lambda name: (name != COMMON_GROUP, name)):
+        group_entries = groups[group]
+        group_bytes = sum(size or 0 for _, _, size in group_entries)
+        too_big = part_bytes + group_bytes > max_part_bytes
+        if not parts or (max_part_bytes and part_bytes > 0 and too_big):
+            parts.append({"groups": [], "entries": []})
+            part_bytes = 0
+        parts[-1]["groups"].append(group)
+        parts[-1]["entries"] += group_entries
+        part_bytes += group_bytes
+
+    return parts
+
+
+def pass_through(entry, output_dir, source_dir, delete_source):
+    """Put a large file at the top of output_dir instead of in an archive.
+
+    Args:
+        entry (tuple) (path, arc_path, size) of the file
+        output_dir (str) where to put it
+        source_dir (str) the directory being archived
+        delete_source (bool) move the file instead of linking or copying it
+
+    Returns:
+        name (str) the new file name, the archive path with "/" replaced by "_"
+    """
+
+    fl_path, arc_path, size = entry
+    name = os.path.relpath(arc_path, source_dir).replace(os.sep, "_")
+    name = f"{source_dir}_{name}"
+    dest = os.path.join(output_dir, name)
+
+    log.info("Passing through %s (%s) as %s", arc_path, format_bytes(size), name)
+    if delete_source and not os.path.islink(fl_path):
+        os.rename(fl_path, dest)
+    else:
+        try:
+            os.link(fl_path, dest)
+        except OSError:
+            shutil.copy2(fl_path, dest)
+
+    return name
+
+
+def zip_output_parts(
+    root_dir,
+    source_dir,
+    output_zip_filename,
+    max_part_bytes=0,
+    pass_through_larger_than=0,
+    delete_source=False,
+    exclude_patterns=None,
+    exclude_larger_than=None,
+    max_workers=1,
+    manifest=None,
+    sha256=False,
+    content_index=None,
+):
+    """Zip <root_dir>/<source_dir> into parts.
+
+    Parts are named like output_zip_filename with "_part-01" etc. added before
+    ".zip" unless there is only one part, which gets output_zip_filename.
+
+    Args:
+        root_dir (str) The root directory to zip relative to.  Archives and
+            passed through files are put here.
+        source_dir (str) subdirectory (of <root_dir>) to zip.
+        output_zip_filename (str) name of the archive
+        max_part_bytes (int) the most (uncompressed) bytes per part, 0 for one
+            archive
+        pass_through_larger_than (int) files bigger than this are put in
+            root_dir as they are instead of in an archive, 0 to archive all files
+        delete_source (boolean) delete files once their part is complete
+        exclude_patterns (list of str) see zip_output()
+        exclude_larger_than (int) see zip_output()
+        max_workers (int) how many parts to write at the same time
+        manifest (dict) see zip_output()
+        sha256 (bool) see zip_output()
+        content_index (dict) see zip_output()
+
+    Returns:
+        index (dict) "parts": {archive name: [subjects it holds]} and
+            "passed_through": {file name: original path}
+    """
+
+    if not os.path.exists(root_dir):
+        raise FileNotFoundError(f"The directory, {root_dir}, does not exist.")
+
+    entries, skipped, skipped_bytes = list_archive_entries(
+        root_dir,
+        source_dir,
+        exclude_patterns=exclude_patterns,
+        exclude_larger_than=exclude_larger_than,
+    )
+
+    # parts may be numbered differently from what is left so check them all
+    stem = output_zip_filename[: -len(".zip")]
+    if delete_source:
+        for name in os.listdir(root_dir):
+            if name == output_zip_filename or re.match(
+                re.escape(stem) + r"_part-\d+\.zip$", name
+            ):
+                check_can_delete(os.path.join(root_dir, name))
+
+    index = {"parts": {}, "passed_through": {}}
+
+    if pass_through_larger_than:
+        large = [e for e in entries if e[2] and e[2] > pass_through_larger_than]
+        for entry in large:
+            name = pass_through(entry, root_dir, source_dir, delete_source)
+            index["passed_through"][name] = entry[1]
+        large_paths = {entry[1] for entry in large}
+        entries = [entry for entry in entries if entry[1] not in large_paths]
+
+    parts = plan_parts(entries, max_part_bytes)
+    for num, part in enumerate(parts, start=1):
+        if len(parts) == 1:
+            part["name"] = output_zip_filename
+        else:
+            part["name"] = f"{stem}_part-{num:02d}.zip"
+        part["pointers"] = []
+        if content_index:
+            part["entries"], part["pointers"] = deduplicate_entries(
+                part["entries"], content_index
+            )
+        index["parts"][part["name"]] = part["groups"]
+        log.info(
+            "Zipping output file %s with %s",
+            part["name"],
+            ", ".join(part["groups"]),
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(
+                write_archive,
+                os.path.join(root_dir, part["name"]),
+                part["entries"],
+                delete_source,
+                manifest,
+                sha256,
+            )
+            for part in parts
+        ]
+        for future in futures:
+            future.result()  # raise any exception
+
+    if manifest is not None:
+        for part in parts:
+            manifest[part["name"]] += part["pointers"]
+
+    log_skipped(skipped, skipped_bytes, output_zip_filename)
+
+    if delete_source:
+        remove_empty_dirs(os.path.join(root_dir, source_dir))
+
+    return index
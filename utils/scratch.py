@@ -0,0 +1,259 @@
+"""Choose fast places for the gear's scratch and work directories.
+
+By default the scratch directory is created in /tmp, whatever that happens to
+be backed by.  Here candidate directories are checked for free space and given
+a quick write test so the fastest one that is big enough can be used.  The
+work directory can also be put on tmpfs (/dev/shm) when there is enough
+memory left over after what the BIDS App is allowed to use.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from .bids.archive_input import BIDS_ARCHIVE_INPUT, find_bids_archive, get_archive_size
+from .fly.disk_budget import SAFETY_MARGIN, estimate_run_bytes, format_bytes
+
+log = logging.getLogger(__name__)
+
+# Places to look for a scratch directory, the first one is the default.
+# $TMPDIR is added to the front when it is set.
+SCRATCH_CANDIDATES = ["/tmp", "/scratch", "/local/scratch", "/mnt/nvme"]
+# Free space needed when the run's footprint can't be estimated
+SCRATCH_MIN_FREE_BYTES = 1024 ** 3
+
+TMPFS = "/dev/shm"
+TMPFS_WORK_NAME = "gear-work-"
+
+PROBE_BYTES = 16 * 1024 * 1024
+PROBE_CHUNK = b"\0" * (1024 * 1024)
+
+
+def read_config(config_file="config.json"):
+    """Return the "config" of config.json, {} if it can't be read.
+
+    This is read directly because it is needed before the gear toolkit
+    context is created.
+    """
+
+    try:
+        with open(config_file) as fp:
+            return json.load(fp)["config"]
+    except (OSError, KeyError, ValueError) as err:
+        log.debug("Could not read the config from %s: %s", config_file, err)
+        return {}
+
+
+def get_scratch_candidates(config_file="config.json"):
+    """Get "gear-scratch-dirs" from config.json.
+
+    Args:
+        config_file (str) path to the gear's config.json
+
+    Environment variables (e.g. $TMPDIR) and ~ are expanded, directories with
+    variables that are not set are left out.
+
+    Returns:
+        candidates (list of str) directories or None to use the defaults
+    """
+
+    scratch_dirs = read_config(config_file).get("gear-scratch-dirs")
+
+    candidates = []
+    for scratch_dir in (scratch_dirs or "").split():
+        expanded = os.path.expanduser(os.path.expandvars(scratch_dir))
+        if "$" in expanded:
+            log.info("Not using %s: the variable is not set", scratch_dir)
+            continue
+        candidates.append(expanded)
+
+    return candidates or None
+
+
+def estimate_scratch_bytes(config_file="config.json", input_dir=BIDS_ARCHIVE_INPUT):
+    """Estimate how much free space the scratch directory needs.
+
+    Before the gear toolkit context is created the size of the BIDS data is
+    only known if it comes from the bids_archive input, and the footprint only
+    if gear-disk-budget-factor is set.  Otherwise SCRATCH_MIN_FREE_BYTES is
+    returned.
+
+    Args:
+        config_file (str) path to the gear's config.json
+        input_dir (str) where the bids_archive input is
+
+    Returns:
+        needed_bytes (int) for the BIDS data, the BIDS App and the archives
+    """
+
+    config = read_config(config_file)
+    footprint_factor = config.get("gear-disk-budget-factor")
+    archive = find_bids_archive(input_dir)
+    if not footprint_factor or not archive:
+        return SCRATCH_MIN_FREE_BYTES
+
+    bids_bytes = get_archive_size(archive)
+    estimate = estimate_run_bytes(
+        bids_bytes, footprint_factor, config.get("gear-save-intermediate-output")
+    )
+    needed_bytes = bids_bytes + estimate["app"] + estimate["archives"]
+
+    return max(SCRATCH_MIN_FREE_BYTES, needed_bytes)
+
+
+def probe_write_speed(directory, probe_bytes=PROBE_BYTES):
+    """Time writing and syncing a small file to see how fast a directory is.
+
+    Args:
+        directory (Path) where to write the test file
+        probe_bytes (int) size of the test file
+
+    Returns:
+        speed (float) bytes per second or 0.0 if the directory is not writeable
+    """
+
+    try:
+        fd, probe_file = tempfile.mkstemp(prefix=".gear-probe-", dir=directory)
+    except OSError as err:
+        log.debug("Cannot write to %s: %s", directory, err)
+        return 0.0
+
+    try:
+        start = time.perf_counter()
+        with os.fdopen(fd, "wb") as fp:
+            for _ in range(probe_bytes // len(PROBE_CHUNK)):
+                fp.write(PROBE_CHUNK)
+            fp.flush()
+            os.fsync(fp.fileno())
+        elapsed = time.perf_counter() - start
+    finally:
+        os.remove(probe_file)
+
+    return probe_bytes / max(elapsed, 1e-6)
+
+
+def choose_scratch_parent(candidates=None, min_free_bytes=SCRATCH_MIN_FREE_BYTES):
+    """Pick the fastest candidate directory that has enough free space.
+
+    Args:
+        candidates (list of str) directories to consider, defaults to $TMPDIR
+            and SCRATCH_CANDIDATES.  Ones that do not exist are skipped.
+        min_free_bytes (int) the least amount of free space that is acceptable,
+            see estimate_scratch_bytes()
+
+    Returns:
+        scratch_parent (Path) where to create the scratch directory.  This is
+            the first candidate if none of them are suitable.
+    """
+
+    if not candidates:
+        candidates = SCRATCH_CANDIDATES
+        if os.environ.get("TMPDIR"):
+            candidates = [os.environ["TMPDIR"]] + candidates
+
+    existing = []
+    for candidate in candidates:
+        path = Path(candidate).resolve()
+        if path.is_dir() and path not in existing:
+            existing.append(path)
+
+    if len(existing) == 0:
+        log.warning("None of %s exist, using %s", candidates, candidates[0])
+        return Path(candidates[0])
+
+    if len(existing) == 1:
+        log.debug("Scratch directory will be in %s", existing[0])
+        return existing[0]
+
+    best = None
+    best_speed = 0.0
+    for path in existing:
+        free_bytes = shutil.disk_usage(path).free
+        if free_bytes < min_free_bytes:
+            log.info("Not using %s: only %s free", path, format_bytes(free_bytes))
+            continue
+        speed = probe_write_speed(path)
+        log.info(
+            "%s: %s free, writes %s/s",
+            path,
+            format_bytes(free_bytes),
+            format_bytes(speed),
+        )
+        if speed > best_speed:
+            best = path
+            best_speed = speed
+
+    if best is None:
+        best = existing[0]
+        log.warning("No scratch candidate has enough free space, using %s", best)
+    else:
+        log.info("Scratch directory will be in %s", best)
+
+    return best
+
+
+def place_work_on_tmpfs(work_dir, mem_gb, needed_bytes):
+    """Move the work directory to tmpfs if there is enough memory to spare.
+
+    The memory used by tmpfs is not available to the BIDS App so this is only
+    done if what is available, less mem_gb that the app is allowed to use,
+    leaves enough room for the work directory.  work_dir is replaced by a
+    symbolic link to the new directory.
+
+    Args:
+        work_dir (Path) the gear's work directory
+        mem_gb (float) GiB of memory the BIDS App is allowed to use
+        needed_bytes (int) estimated size the work directory will grow to or
+            None if it is not known, then work/ is not moved
+
+    Returns:
+        tmpfs_work (Path) new location of work/ or None if it was not moved
+    """
+
+    if not needed_bytes:
+        log.warning(
+            "Not putting work/ on tmpfs: there is no estimate of how big it will "
+            "grow (set gear-disk-budget-factor)"
+        )
+        return None
+
+    if not Path(TMPFS).is_dir():
+        log.info("Not putting work/ on tmpfs: %s does not exist", TMPFS)
+        return None
+
+    import psutil
+
+    headroom = psutil.virtual_memory().available - mem_gb * 1024 ** 3
+    tmpfs_free = shutil.disk_usage(TMPFS).free
+    needed = needed_bytes * SAFETY_MARGIN
+    if headroom < needed or tmpfs_free < needed:
+        log.info(
+            "Not putting work/ on tmpfs: need %s, memory headroom is %s, "
+            "%s free in %s",
+            format_bytes(needed),
+            format_bytes(headroom),
+            format_bytes(tmpfs_free),
+            TMPFS,
+        )
+        return None
+
+    tmpfs_work = Path(tempfile.mkdtemp(prefix=TMPFS_WORK_NAME, dir=TMPFS))
+    shutil.copytree(work_dir, tmpfs_work, symlinks=True, dirs_exist_ok=True)
+    if Path(work_dir).is_symlink():
+        Path(work_dir).unlink()
+    else:
+        shutil.rmtree(work_dir)
+    Path(work_dir).symlink_to(tmpfs_work)
+
+    log.info(
+        "Put work/ on tmpfs at %s: need %s, memory headroom is %s",
+        tmpfs_work,
+        format_bytes(needed),
+        format_bytes(headroom),
+    )
+
+    return tmpfs_work
@@ -4,10 +4,18 @@
 import logging
 import os
 import re
-import shutil
 import tempfile
 from pathlib import Path
 
+from .checkpoint import CHECKPOINT_NAME, read_key
+from .cleanup import TRASH_NAME, remove_tree_in_background
+from .scratch import (
+    SCRATCH_MIN_FREE_BYTES,
+    TMPFS,
+    TMPFS_WORK_NAME,
+    choose_scratch_parent,
+)
+
 log = logging.getLogger(__name__)
 
 
@@ -15,9 +23,49 @@ FWV0 = "/flywheel/v0"
 SCRATCH_NAME = "gear-temp-dir-"
 
 
-def run_in_tmp_dir():
+def find_previous_run(previous_runs, resume_key):
+    """Return the scratch directory of a previous run of this job or None.
+
+    Args:
+        previous_runs (list of Path) scratch directories of previous runs
+        resume_key (str) see utils.checkpoint.get_run_key()
+    """
+
+    for prev in previous_runs:
+        if read_key(prev / FWV0.lstrip("/") / CHECKPOINT_NAME) == resume_key:
+            return prev
+    return None
+
+
+def get_tmpfs_work(scratch_dir):
+    """Return the directory on tmpfs that a previous run's work/ links to or None."""
+
+    work = Path(scratch_dir) / FWV0.lstrip("/") / "work"
+    if not work.is_symlink():
+        return None
+    target = Path(os.path.realpath(work))
+    if target.parent == Path(TMPFS) and target.name.startswith(TMPFS_WORK_NAME):
+        return target
+    return None
+
+
+def run_in_tmp_dir(
+    candidates=None, resume_key=None, min_free_bytes=SCRATCH_MIN_FREE_BYTES
+):
     """Copy gear to a temporary directory and cd to there.
 
+    The temporary directory is created in the fastest of the candidate
+    directories that has enough free space for the run (usually just /tmp).
+
+    Args:
+        candidates (list of str) directories where the temporary directory
+            could be created, see utils.scratch.choose_scratch_parent()
+        resume_key (str) if a previous run's checkpoint has this key, its
+            scratch directory is used again instead of being removed, see
+            utils.checkpoint
+        min_free_bytes (int) free space the run needs, see
+            utils.scratch.estimate_scratch_bytes()
+
     Returns:
         tmp_path (path) The path to the temporary directory so it can be deleted
     """
@@ -43,26 +91,51 @@ def run_in_tmp_dir():
     else:
         log.debug("Running in %s", running_in)
 
-    # remove any previous runs (possibly left over from previous testing)
+    # remove any previous runs (possibly left over from previous testing) and
+    # anything previous runs did not finish removing.  This happens in the
+    # background so the gear does not have to wait for it.  Only node-local /tmp
+    # is cleaned: a shared scratch directory may hold other jobs' directories.
+    scratch_parent = choose_scratch_parent(candidates, min_free_bytes)
     previous_runs = list(Path("/tmp").glob(f"{SCRATCH_NAME}*"))
+    previous_runs += list(Path("/tmp").glob(f"{TRASH_NAME}*"))
     log.debug("previous_runs = %s", previous_runs)
+
+    resumed = None
+    if resume_key:
+        scratch_dirs = set(Path("/tmp").glob(f"{SCRATCH_NAME}*"))
+        scratch_dirs |= set(scratch_parent.glob(f"{SCRATCH_NAME}*"))
+        resumed = find_previous_run(sorted(scratch_dirs), resume_key)
+    if resumed:
+        log.info("Resuming the previous run of this job in %s", resumed)
+        previous_runs = [prev for prev in previous_runs if prev != resumed]
+
     for prev in previous_runs:
         log.debug("rm %s", prev)
-        shutil.rmtree(prev)
+        tmpfs_work = get_tmpfs_work(prev)
+        if tmpfs_work:
+            log.debug("rm %s", tmpfs_work)
+            remove_tree_in_background(tmpfs_work)
+        remove_tree_in_background(prev)
 
-    # Create temporary place to run gear
-    WD = tempfile.mkdtemp(prefix=SCRATCH_NAME, dir="/tmp")
+    # Create temporary place to run gear (or use the one being resumed)
+    if resumed:
+        WD = str(resumed)
+    else:
+        WD = tempfile.mkdtemp(prefix=SCRATCH_NAME, dir=scratch_parent)
     log.debug("Gear scratch directory is %s", WD)
 
     new_FWV0 = Path(WD + FWV0)
-    new_FWV0.mkdir(parents=True)
+    new_FWV0.mkdir(parents=True, exist_ok=True)
     abs_path = Path(".").resolve()
     names = list(Path(FWV0).glob("*"))
     for name in names:
+        link = new_FWV0 / name.name
+        if os.path.lexists(link):
+            continue  # made by the run being resumed
         if name.name == "gear_environ.json":  # always use real one, not dev
-            (new_FWV0 / name.name).symlink_to(Path(FWV0) / name.name)
+            link.symlink_to(Path(FWV0) / name.name)
         else:
-            (new_FWV0 / name.name).symlink_to(abs_path / name.name)
+            link.symlink_to(abs_path / name.name)
     os.chdir(new_FWV0)  # run in /tmp/... directory so it is writeable
     log.debug("cwd is %s", Path.cwd())
 
@@ -0,0 +1,131 @@
+"""Run stages of the gear, at the same time when they do not depend on each other.
+
+Stages are given as a dictionary of name: (function, [names of stages it
+depends on]).  A stage starts as soon as all of its dependencies have finished
+successfully.  Return values are saved in a results dictionary as stages
+finish so a stage can use the results of the stages it depends on.  Exceptions
+raised by a stage are added to the gear's list of errors and stages that
+depend on it are skipped.
+
+How long each stage took is saved in stage_times so it can be reported at the
+end of the run.
+
+Example:
+    .. code-block:: python
+
+        stages = {
+            "environ": (get_and_log_environment, []),
+            "hierarchy": (partial(get_hierarchy, fw, destination_id), []),
+            "subjects_dir": (
+                lambda: set_up_subjects_dir(results["environ"]), ["environ"]
+            ),
+        }
+        results = {}
+        run_stages(stages, errors, results=results)
+        environ = results["environ"]
+"""
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from .profiling import profile_stage
+
+log = logging.getLogger(__name__)
+
+# name: seconds for every stage that has been run
+stage_times = {}
+
+
+@contextmanager
+def timed_stage(name):
+    """Record how long the code in this context takes as stage "name".
+
+    The stage is also profiled if profiling has been turned on.
+    """
+
+    start = time.perf_counter()
+    try:
+        with profile_stage(name):
+            yield
+    finally:
+        stage_times[name] = time.perf_counter() - start
+        log.debug("Stage %s took %.2f seconds", name, stage_times[name])
+
+
+def run_stage(name, function):
+    """Call function() and record how long it took."""
+
+    with timed_stage(name):
+        return function()
+
+
+def run_stages(stages, errors, max_workers=4, results=None):
+    """Run stages concurrently while respecting their dependencies.
+
+    Args:
+        stages (dict) name: (function, list of names of stages it depends on).
+            Functions are called with no arguments.
+        errors (list) exceptions raised by stages and descriptions of skipped
+            stages are appended to this list
+        max_workers (int) maximum number of stages to run at the same time
+        results (dict) if given, return values are saved here as soon as each
+            stage finishes
+
+    Returns:
+        results (dict) name: return value of each stage that succeeded
+    """
+
+    for name, (_, depends_on) in stages.items():
+        unknown = [dep for dep in depends_on if dep not in stages]
+        if unknown:
+            raise ValueError(f"Stage {name} depends on unknown stages {unknown}")
+
+    if results is None:
+        results = {}
+    failed = set()
+    pending = dict(stages)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+
+            for name, (function, depends_on) in list(pending.items()):
+                if any(dep in failed for dep in depends_on):
+                    del pending[name]
+                    failed.add(name)
+                    msg = f"Stage {name} was skipped because a stage it needs failed"
+                    log.error(msg)
+                    errors.append(msg)
+                elif all(dep in results for dep in depends_on):
+                    del pending[name]
+                    log.debug("Starting stage %s", name)
+                    running[pool.submit(run_stage, name, function)] = name
+
+            if not running:
+                if pending:  # nothing can run, so there must be a cycle
+                    raise ValueError(f"Stages {list(pending)} depend on each other")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                exc = future.exception()
+                if exc is None:
+                    results[name] = future.result()
+                else:
+                    failed.add(name)
+                    log.error("Stage %s failed", name, exc_info=exc)
+                    errors.append(exc)
+
+    return results
+
+
+def log_stage_times():
+    """Log how long each stage took, longest first."""
+
+    msg = "Stage times (seconds):\n"
+    for name, seconds in sorted(stage_times.items(), key=lambda kv: -kv[1]):
+        msg += f"  {seconds:8.2f}  {name}\n"
+    log.info(msg)